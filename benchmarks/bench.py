@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+"""Offline benchmarks of the hot paths of tvsubtitles_api, run against
+the recorded pages of tests/fixtures.
+
+Results are printed and can be saved as JSON with --output. Passing a
+previous output with --baseline compares both runs, the exit status is 1
+if a benchmark got slower than the allowed --tolerance.
+
+Usage: python benchmarks/bench.py [--output FILE] [--baseline FILE] [--tolerance 0.2]
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import platform
+import optparse
+import timeit
+import subprocess
+
+# Force parent and tests directories onto path
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'tests'))
+
+import lxml.html
+
+import tvsubtitles_api
+from tvsubtitles_api import api
+from tvsubtitles_api.parsers import TvShowSearchParser, TvSowParser, EpisodeParser
+from tvsubtitles_api.ranking import BigramRanker
+from stubs import FIXTURES, fixture_tvsubtitles
+
+def fixture(name):
+    return open(os.path.join(FIXTURES, name), 'rb').read()
+
+def fixture_doc(name):
+    return lxml.html.fromstring(api.decode_html(fixture(name)))
+
+def bench_decode():
+    html = fixture('tvshow-51-1.html')
+    return lambda: api.decode_html(html)
+
+def site_page(name):
+    """Fixture followed by a sidebar listing every recorded show, the size
+    of a page of the site (the fixtures only keep the content box)
+    """
+    names = [line.strip() for line in open(os.path.join(FIXTURES, 'shows.txt'))]
+    links = ''.join('<li><a href="/tvshow-%d.html">%s</a></li>\n' % (i, name)
+                    for i, name in enumerate(names * 4) if name)
+    return fixture(name).replace('</body>', '<div id="right"><ul>\n%s</ul></div>\n</body>' % links)
+
+def bench_decode_parse(html):
+    return lambda: lxml.html.fromstring(api.decode_html(html))
+
+def bench_fast_html(html):
+    return lambda: api.fast_html(html, 'text/html; charset=windows-1251')
+
+def bench_parser(parser_class, name):
+    doc = fixture_doc(name)
+    return lambda: parser_class(doc).parse()
+
+def bench_dice_ranking():
+    names = [line.strip() for line in open(os.path.join(FIXTURES, 'shows.txt'))]
+    names = [name.lower() for name in names if name]
+    def rank():
+        return sorted(names, key = lambda name: api.dice_coefficient(u'the office', name),
+                      reverse = True)[:10]
+    return rank
+
+def bench_catalog_ranking(use_numpy):
+    """Ranks a query against 20000 names made from the recorded ones"""
+    names = [line.strip().lower() for line in open(os.path.join(FIXTURES, 'shows.txt'))]
+    names = [unicode(name) for name in names if name]
+    catalog = ['%s %s' % (a, b) for a in names for b in names][:20000]
+    ranker = BigramRanker(catalog, use_numpy = use_numpy)
+    ranker.top(u'the office scrubs') # builds the postings arrays
+    return lambda: ranker.top(u'the office scrubs', k = 10)
+
+def bench_show_loading():
+    def load():
+        t, handler = fixture_tvsubtitles()
+        return t[51]
+    return load
+
+def bench_snapshot_load():
+    """Loads a snapshot of 20000 shows and accesses one of them"""
+    t, handler = fixture_tvsubtitles()
+    show = t[51]
+    for sid in range(100000, 120000):
+        t.shows[sid] = show
+    location = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, location)
+    path = os.path.join(location, 'shows.snap')
+    t.dump_snapshot(path)
+    def load():
+        t, handler = fixture_tvsubtitles()
+        t.load_snapshot(path)
+        return t.shows[110000][1][1]
+    return load
+
+def bench_show_search():
+    t, handler = fixture_tvsubtitles()
+    show = t[51]
+    return lambda: show.search('my first', key = 'episodename')
+
+def bench_select():
+    """Chooses the releases of 5000 video files of loaded episodes"""
+    t, handler = fixture_tvsubtitles()
+    show = t[51]
+    names = ['Scrubs.S%02dE%02d.%s.mkv' % (season, num, tags)
+             for season in show for num in show[season]
+             for tags in ('720p.HDTV.x264-LOL', 'DVDRip.XviD-TOPAZ', 'WEB-DL')]
+    names = (names * (5000 / len(names) + 1))[:5000]
+    t.select(names) # loads the episode pages
+    return lambda: t.select(names)
+
+def bench_import():
+    """Starts an interpreter importing the package, only the parsing
+    and network modules are expected to be deferred"""
+    command = [sys.executable, '-c', 'import sys; sys.path.insert(0, %r); '
+               'import tvsubtitles_api; tvsubtitles_api.TvSubtitles()' % root]
+    return lambda: subprocess.check_call(command)
+
+def bench_python_startup():
+    """Reference for bench_import, an interpreter doing nothing"""
+    command = [sys.executable, '-c', 'pass']
+    return lambda: subprocess.check_call(command)
+
+BENCHMARKS = [
+    ('python startup', bench_python_startup),
+    ('import tvsubtitles_api', bench_import),
+    ('decode_html', bench_decode),
+    ('decode_html + lxml', lambda: bench_decode_parse(fixture('tvshow-51-1.html'))),
+    ('fast_html', lambda: bench_fast_html(fixture('tvshow-51-1.html'))),
+    ('decode_html + lxml site page', lambda: bench_decode_parse(site_page('tvshow-51-1.html'))),
+    ('fast_html site page', lambda: bench_fast_html(site_page('tvshow-51-1.html'))),
+    ('TvShowSearchParser.parse', lambda: bench_parser(TvShowSearchParser, 'search.html')),
+    ('TvSowParser.parse', lambda: bench_parser(TvSowParser, 'tvshow-51-1.html')),
+    ('EpisodeParser.parse', lambda: bench_parser(EpisodeParser, 'episode-1001.html')),
+    ('dice_coefficient ranking', bench_dice_ranking),
+    ('BigramRanker.top 20k', lambda: bench_catalog_ranking(None)),
+    ('BigramRanker.top 20k python', lambda: bench_catalog_ranking(False)),
+    ('_getShowData population', bench_show_loading),
+    ('Show.search', bench_show_search),
+    ('load_snapshot 20k shows', bench_snapshot_load),
+    ('TvSubtitles.select 5000 files', bench_select),
+]
+
+def run(func, min_time = 0.5, min_runs = 5):
+    """Calls func repeatedly for at least min_time seconds, returns
+    throughput and latency statistics in milliseconds
+    """
+    timer = timeit.default_timer
+    func() # warm up
+    latencies = []
+    started = timer()
+    while len(latencies) < min_runs or timer() - started < min_time:
+        t0 = timer()
+        func()
+        latencies.append((timer() - t0) * 1000.0)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'runs': len(latencies),
+        'ops_per_sec': len(latencies) / (total / 1000.0),
+        'mean_ms': total / len(latencies),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'min_ms': latencies[0],
+    }
+
+def compare(results, baseline, tolerance):
+    """Prints the change of each benchmark against baseline, returns the
+    names of the benchmarks slower than tolerance allows
+    """
+    regressions = []
+    print
+    print "%-28s %12s %12s %8s" % ('benchmark', 'baseline ms', 'current ms', 'change')
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before, now = baseline[name]['p50_ms'], stats['p50_ms']
+        change = (now - before) / before if before else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = ' SLOWER'
+            regressions.append(name)
+        print "%-28s %12.4f %12.4f %+7.1f%%%s" % (name, before, now, change * 100, flag)
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n')[-1])
+    parser.add_option('--output', help = 'save results as JSON to this file')
+    parser.add_option('--baseline', help = 'compare with results saved by --output')
+    parser.add_option('--tolerance', type = 'float', default = 0.2,
+                      help = 'allowed slowdown against the baseline (default 0.2)')
+    parser.add_option('--min-time', type = 'float', default = 0.5,
+                      help = 'seconds spent on each benchmark (default 0.5)')
+    parser.add_option('--filter', help = 'only run benchmarks containing this text')
+    opts, args = parser.parse_args()
+
+    results = {}
+    print "%-28s %10s %10s %10s %10s" % ('benchmark', 'ops/s', 'mean ms', 'p50 ms', 'p95 ms')
+    for name, setup in BENCHMARKS:
+        if opts.filter and opts.filter not in name:
+            continue
+        stats = run(setup(), min_time = opts.min_time)
+        results[name] = stats
+        print "%-28s %10.1f %10.4f %10.4f %10.4f" % (
+            name, stats['ops_per_sec'], stats['mean_ms'], stats['p50_ms'], stats['p95_ms'])
+
+    if opts.output:
+        f = open(opts.output, 'w')
+        try:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'version': tvsubtitles_api.__version__,
+                'results': results,
+            }, f, indent = 2, sort_keys = True)
+        finally:
+            f.close()
+
+    if opts.baseline:
+        baseline = json.load(open(opts.baseline))['results']
+        if compare(results, baseline, opts.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+"""Compares the memory used by the default dict episode tree and by
+the compact (CompactEpisode) tree, before and after the search indexes
+of the shows are built by a first search.
+
+Usage: python benchmarks/memory.py [--shows N] [--seasons N] [--episodes N]
+"""
+
+import os
+import sys
+import optparse
+
+# Force parent directory onto path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tvsubtitles_api
+
+def deep_size(obj, seen):
+    """Size in bytes of obj and of every object it references"""
+    if id(obj) in seen or isinstance(obj, tvsubtitles_api.TvSubtitles):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+    return size
+
+def populate(t, shows, seasons, episodes):
+    """Fills t with synthetic shows, the way _getShowData does"""
+    eid = 0
+    for sid in range(shows):
+        t._setShowData(sid, 'seriesname', 'Show %d' % sid)
+        for season in range(1, seasons + 1):
+            eps = []
+            for num in range(1, episodes + 1):
+                eid += 1
+                eps.append({'num': num, 'id': eid, 'lang': ['en', 'fr'],
+                            'name': 'Episode name %d' % eid})
+            for episode in t._setSeason(sid, season, eps):
+                pass
+        t._complete.add(sid)
+
+def measure(compact, shows, seasons, episodes):
+    """Returns the size of the shows, without and with their search indexes"""
+    t = tvsubtitles_api.TvSubtitles(compact = compact)
+    populate(t, shows, seasons, episodes)
+    size = deep_size(t.shows, set([id(t.config)]))
+    for show in t.shows.values():
+        show.search('episode')
+    return size, deep_size(t.shows, set([id(t.config)]))
+
+def main():
+    parser = optparse.OptionParser(usage = __doc__.strip().split('\n')[-1])
+    parser.add_option('--shows', type = 'int', default = 50)
+    parser.add_option('--seasons', type = 'int', default = 8)
+    parser.add_option('--episodes', type = 'int', default = 22)
+    opts, args = parser.parse_args()
+
+    count = opts.shows * opts.seasons * opts.episodes
+    print "%d shows, %d episodes" % (opts.shows, count)
+    sizes = {}
+    for name, compact in (('dict', False), ('compact', True)):
+        sizes[name] = measure(compact, opts.shows, opts.seasons, opts.episodes)
+        for label, size in zip(('', '+index'), sizes[name]):
+            print "%-14s %10d bytes  %6.1f bytes/episode" % (
+                name + label, size, size / float(count))
+    for i, label in enumerate(('', ' with indexes')):
+        print "compact saves %.1f%%%s" % (
+            100.0 * (1 - sizes['compact'][i] / float(sizes['dict'][i])), label)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
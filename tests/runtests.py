@@ -10,10 +10,12 @@ import sys
 import unittest
 
 import test_tvsubtitles_api
+import test_offline
 
 def main():
     suite = unittest.TestSuite([
-        unittest.TestLoader().loadTestsFromModule(test_tvsubtitles_api)
+        unittest.TestLoader().loadTestsFromModule(test_tvsubtitles_api),
+        unittest.TestLoader().loadTestsFromModule(test_offline),
     ])
     
     runner = unittest.TextTestRunner(verbosity=2)
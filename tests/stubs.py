@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+"""urllib2 stub serving the recorded tvsubtitles.net pages of the
+fixtures directory, and a Redis stand-in, shared by the offline tests
+and the benchmarks
+"""
+
+import os
+import re
+import sys
+import time
+import hashlib
+import urllib
+import urllib2
+import threading
+import SocketServer
+from StringIO import StringIO
+
+# Force parent directory onto path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tvsubtitles_api
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def fixture_for(url):
+    """Maps a tvsubtitles.net URL to the fixture file serving it"""
+    path = url.split('/')[-1]
+    if path == 'search.php':
+        return 'search.html'
+    if re.match(r'episode-\d+\.html$', path):
+        # Every episode page is served by the same recording
+        return 'episode-1001.html'
+    if re.match(r'download-\d+\.html$', path):
+        # Subtitles are downloaded as zip archives
+        return 'download.zip'
+    return path
+
+class FixtureHandler(urllib2.BaseHandler):
+    """urllib2 handler answering requests from the fixtures directory,
+    every requested URL is recorded in self.requests. Pages can be
+    replaced by setting self.overrides[fixture name] to another body.
+    """
+    handler_order = 100 # before urllib2.HTTPHandler
+
+    def __init__(self):
+        self.requests = []
+        self.overrides = {}
+        self.lock = threading.Lock()
+
+    def http_open(self, req):
+        url = req.get_full_url()
+        self.lock.acquire()
+        try:
+            self.requests.append(url)
+        finally:
+            self.lock.release()
+        name = fixture_for(url)
+        path = os.path.join(FIXTURES, name)
+        if name in self.overrides:
+            body = self.overrides[name]
+        elif os.path.exists(path):
+            body = open(path, 'rb').read()
+        else:
+            raise urllib2.HTTPError(url, 404, 'Not Found', {}, StringIO(''))
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if req.get_header('If-none-match') == etag:
+            raise urllib2.HTTPError(url, 304, 'Not Modified',
+                urllib2.httplib.HTTPMessage(StringIO('ETag: %s\r\n\r\n' % etag)),
+                StringIO(''))
+        headers = urllib2.httplib.HTTPMessage(StringIO(
+            'Content-Type: text/html; charset=windows-1251\r\n'
+            'ETag: %s\r\n'
+            'Content-Length: %d\r\n\r\n' % (etag, len(body))))
+        resp = urllib.addinfourl(StringIO(body), headers, url)
+        resp.code, resp.msg = 200, 'OK'
+        return resp
+
+def fixture_tvsubtitles(cls = tvsubtitles_api.TvSubtitles, **kwargs):
+    """Returns a (TvSubtitles, FixtureHandler) pair, requests are not
+    throttled"""
+    handler = FixtureHandler()
+    kwargs.setdefault('rate_limit', None)
+    t = cls(urlopener = urllib2.build_opener(handler), **kwargs)
+    return t, handler
+
+
+class RedisStub:
+    """Local server speaking the Redis protocol, keeping its keys in a
+    dict. Supports PING, AUTH, SELECT, GET, SET (with EX), DEL and
+    FLUSHDB. The received commands are recorded in self.commands, the
+    number of open client connections in self.connections.
+    """
+    def __init__(self, password = None):
+        stub = self
+        self.password = password
+        self.data = {} # (db, key) -> (value, expires)
+        self.commands = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                state = {'db': 0, 'auth': stub.password is None}
+                stub._count(1)
+                try:
+                    while True:
+                        args = stub._read(self.rfile)
+                        if args is None:
+                            return
+                        self.wfile.write(stub._answer(state, args))
+                        self.wfile.flush()
+                finally:
+                    stub._count(-1)
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target = self.server.serve_forever, args = (0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def _count(self, delta):
+        self.lock.acquire()
+        try:
+            self.connections += delta
+        finally:
+            self.lock.release()
+
+    def _read(self, rfile):
+        line = rfile.readline()
+        if not line.startswith('*'):
+            return None
+        args = []
+        for i in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    def _answer(self, state, args):
+        command = args[0].upper()
+        self.lock.acquire()
+        try:
+            self.commands.append([command] + args[1:])
+            if command == 'AUTH':
+                if args[1] != self.password:
+                    return '-ERR invalid password\r\n'
+                state['auth'] = True
+                return '+OK\r\n'
+            if not state['auth']:
+                return '-NOAUTH Authentication required.\r\n'
+            if command == 'PING':
+                return '+PONG\r\n'
+            if command == 'SELECT':
+                state['db'] = int(args[1])
+                return '+OK\r\n'
+            if command == 'FLUSHDB':
+                for key in [key for key in self.data if key[0] == state['db']]:
+                    del self.data[key]
+                return '+OK\r\n'
+            if command == 'GET':
+                value, expires = self.data.get((state['db'], args[1]), (None, None))
+                if value is None or (expires is not None and expires <= time.time()):
+                    return '$-1\r\n'
+                return '$%d\r\n%s\r\n' % (len(value), value)
+            if command == 'SET':
+                expires = None
+                if len(args) == 5 and args[3].upper() == 'EX':
+                    expires = time.time() + int(args[4])
+                self.data[(state['db'], args[1])] = (args[2], expires)
+                return '+OK\r\n'
+            if command == 'DEL':
+                count = 0
+                for key in args[1:]:
+                    count += self.data.pop((state['db'], key), None) is not None
+                return ':%d\r\n' % count
+            return "-ERR unknown command '%s'\r\n" % args[0]
+        finally:
+            self.lock.release()
+
+    def url(self, db = 0):
+        return 'redis://127.0.0.1:%d/%d' % (self.port, db)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
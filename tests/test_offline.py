@@ -0,0 +1,1639 @@
+#!/usr/bin/env python
+#encoding:utf-8
+
+"""Offline unittests for tvsubtiles_api, served from recorded HTML
+fixtures instead of www.tvsubtitles.net
+"""
+
+import os
+import sys
+import time
+import json
+import array
+import datetime
+import shutil
+import subprocess
+import tempfile
+import urllib2
+import unittest
+import threading
+import gzip
+import zipfile
+import BaseHTTPServer
+from StringIO import StringIO
+
+# Force parent directory onto path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tvsubtitles_api
+import tvsubtitles_api.crawler
+import tvsubtitles_api.download
+import tvsubtitles_api.selection
+import tvsubtitles_api.backends
+import tvsubtitles_api.cache
+import tvsubtitles_api.atomicfile
+from stubs import FIXTURES, fixture_for, FixtureHandler, fixture_tvsubtitles, RedisStub
+
+def dump_show(show):
+    """Plain representation of a Show, used to compare loading modes"""
+    return dict(
+        (season, dict(
+            (num, dict((k, v) for k, v in ep.items() if k != 'languages'))
+            for num, ep in show[season].items()))
+        for season in show.keys())
+
+class test_offline_loading(unittest.TestCase):
+    def test_serial_load(self):
+        """Checks a show is loaded from the fixtures"""
+        t, handler = fixture_tvsubtitles()
+        self.assertEquals(t['scrubs']['seriesname'], 'Scrubs')
+        self.assertEquals(t['scrubs'][1][4]['episodename'], 'My Old Lady')
+        self.assertEquals(len(t['scrubs']), 3)
+        self.assertEquals(len(handler.requests), 4)
+
+    def test_parallel_load(self):
+        """Checks parallel season loading builds the same tree"""
+        serial, _ = fixture_tvsubtitles()
+        parallel, handler = fixture_tvsubtitles(max_workers = 4)
+        self.assertEquals(dump_show(parallel['scrubs']),
+                          dump_show(serial['scrubs']))
+        self.assertEquals(len(handler.requests), 4)
+
+    def test_parallel_errors(self):
+        """Checks errors in a worker thread reach the caller"""
+        def func(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        self.assertRaises(ValueError, lambda:
+            list(tvsubtitles_api.api.threaded_imap(func, range(6), 3)))
+        self.assertEquals(
+            list(tvsubtitles_api.api.threaded_imap(lambda x: x * 2, range(6), 3)),
+            [0, 2, 4, 6, 8, 10])
+
+class test_offline_streaming(unittest.TestCase):
+    def test_iter_episodes(self):
+        """Checks episodes are yielded before later seasons are loaded"""
+        t, handler = fixture_tvsubtitles()
+        episodes = t.iter_episodes('scrubs')
+        self.assertEquals(episodes.next()['episodename'], 'My First Day')
+        self.assertEquals(len(handler.requests), 2)
+        rest = list(episodes)
+        self.assertEquals(len(rest), 18)
+        self.assertEquals(rest[-1]['episodename'], 'My Fault')
+        self.assertEquals(len(handler.requests), 4)
+        # Loaded shows are iterated from memory
+        self.assertEquals(len(list(t.iter_episodes(51))), 19)
+        t['scrubs']
+        self.assertEquals(len(handler.requests), 4)
+
+    def test_partial_iteration(self):
+        """Checks a partially iterated show is completed on access"""
+        t, handler = fixture_tvsubtitles()
+        t.iter_episodes(51).next()
+        self.assertEquals(len(t[51]), 3)
+
+    def test_iter_search(self):
+        """Checks iter_search yields the same results as search"""
+        t, handler = fixture_tvsubtitles()
+        show = t['scrubs']
+        self.assertEquals(list(show.iter_search('my first')), show.search('my first'))
+        self.assertEquals(len(show.search('my first')), 2)
+        self.assertRaises(TypeError, lambda: show[1].search())
+
+class test_offline_index(unittest.TestCase):
+    def setUp(self):
+        self.t, self.handler = fixture_tvsubtitles()
+        self.show = self.t['scrubs']
+
+    def linear_search(self, term, key = None):
+        results = []
+        for season in sorted(self.show.keys()):
+            for num in sorted(self.show[season].keys()):
+                if self.show[season][num].search(term, key = key) is not None:
+                    results.append(self.show[season][num])
+        return results
+
+    def test_same_results(self):
+        """Checks indexed search matches the linear scan"""
+        for term, key in [('my first', None), ('MENTOR', 'episodename'),
+                          ('y', 'episodename'), ('fr', 'available_languages'),
+                          ('1', 'seasonnumber'), ('nothing here', None),
+                          ('2003', None)]:
+            self.assertEquals(self.show.search(term, key = key),
+                              self.linear_search(term, key = key))
+        self.assertEquals(len(self.show.search('mentor', key = 'episodename')), 2)
+
+    def test_season_search(self):
+        """Checks season searches only return episodes of the season"""
+        self.assertEquals([repr(ep) for ep in self.show[3].search('my')],
+            ['<Episode 03x01 - My Own Private Practice>', '<Episode 03x02 - My Journey>',
+             '<Episode 03x03 - My Tormented Mentor>', '<Episode 03x04 - My First Step>',
+             '<Episode 03x05 - My Fault>'])
+
+    def test_tokens_and_updates(self):
+        """Checks whole word search and reindexing of updated fields"""
+        self.assertEquals(len(self.show.search_tokens('my', key = 'episodename')), 19)
+        self.assertEquals(self.show.search_tokens('ment', key = 'episodename'), [])
+        self.t._setItem(51, 1, 2, 'episodename', 'Renamed')
+        self.assertEquals(len(self.show.search('mentor', key = 'episodename')), 1)
+        self.assertEquals(self.show.search('renamed'), [self.show[1][2]])
+
+    def test_global_search(self):
+        """Checks TvSubtitles.search covers every loaded show"""
+        self.assertEquals(self.t.search('my first'), self.show.search('my first'))
+
+    def test_lazy_index(self):
+        """Checks the index is built by the first search and frees removed episodes"""
+        self.assertEquals(self.show._index, None)
+        self.show.search('my first')
+        index = self.show._index
+        self.assertEquals(len(index), 19)
+        episode = self.show[1][2]
+        for attrib in episode.keys():
+            index.remove(episode, attrib)
+        self.assertEquals(len(index), 18)
+        self.assertFalse(id(episode) in index._docids)
+        keys = index._keys(None)
+        keys.append('changed')
+        self.assertFalse('changed' in index._values)
+
+    def test_text_postings(self):
+        """Checks only text fields get postings, the others are scanned"""
+        self.show.search('my first')
+        index = self.show._index
+        self.assertEquals(index._grams.keys(), [u'episodename'])
+        self.assertEquals(index._tokens.keys(), [u'episodename'])
+        self.assertTrue(isinstance(index._grams[u'episodename'][u'men'], array.array))
+        self.assertEquals(self.show.search_tokens('en', key = 'available_languages'),
+                          self.show.search('en', key = 'available_languages'))
+
+class test_offline_compact(unittest.TestCase):
+    def test_compact_episodes(self):
+        """Checks compact episodes behave like the dict episodes"""
+        t, _ = fixture_tvsubtitles()
+        compact, _ = fixture_tvsubtitles(compact = True)
+        show = compact['scrubs']
+        self.assertEquals(dump_show(show), dump_show(t['scrubs']))
+        episode = show[1][4]
+        self.assertTrue(isinstance(episode, tvsubtitles_api.api.CompactEpisode))
+        self.assertEquals(episode['episodename'], 'My Old Lady')
+        self.assertEquals(repr(episode), '<Episode 01x04 - My Old Lady>')
+        self.assertEquals(episode.season.show, show)
+        self.assertEquals(episode['languages']['en'][0]['good'], 30)
+        self.assertEquals(episode.search('old', key = 'episodename'), episode)
+        self.assertEquals(len(show.search('my first')), 2)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_attributenotfound,
+                          lambda: episode['afakeattributething'])
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_episodenotfound,
+                          lambda: show[1][30])
+        episode['extra'] = 1
+        self.assertEquals(dict(episode)['extra'], 1)
+
+class test_offline_fast_parse(unittest.TestCase):
+    def test_same_tree(self):
+        """Checks fast parsing builds the same tree as legacy parsing"""
+        legacy, _ = fixture_tvsubtitles()
+        fast, _ = fixture_tvsubtitles(fast_parse = True)
+        self.assertEquals(dump_show(fast['scrubs']), dump_show(legacy['scrubs']))
+        self.assertEquals(fast['scrubs'][1][1]['languages'].loaded(),
+                          legacy['scrubs'][1][1]['languages'].loaded())
+        self.assertEquals(fast.metrics.timing('tvsubtitles_decode_seconds',
+                                              method = 'unicodedammit')['count'], 0)
+
+    def test_charset(self):
+        """Checks the charset is taken from headers, then meta tags"""
+        html_charset = tvsubtitles_api.api.html_charset
+        page = '<html><head><meta charset="utf-8"></head></html>'
+        self.assertEquals(html_charset(page, 'text/html; charset=ISO-8859-1'), 'iso-8859-1')
+        self.assertEquals(html_charset(page, 'text/html'), 'utf-8')
+        self.assertEquals(html_charset('<html></html>'), None)
+        self.assertEquals(tvsubtitles_api.api.fast_html(page, 'text/html; charset=bogus'), None)
+
+    def test_content_only(self):
+        """Checks the page is only parsed up to the content box"""
+        page = open(os.path.join(FIXTURES, 'tvshow-51-1.html'), 'rb').read()
+        page = page.replace('</body>', '<div id="footer">%s</div></body>' % ('<p>x</p>' * 5000))
+        doc = tvsubtitles_api.api.fast_html(page)
+        self.assertTrue(len(doc.xpath('//div[@id="footer"]/p')) < 1000)
+        parsed = tvsubtitles_api.parsers.TvSowParser(doc).parse()
+        self.assertEquals(len(parsed['seasons'][1]), 8)
+        # Pages without a content box use the legacy path
+        self.assertEquals(tvsubtitles_api.api.fast_html(
+            '<html><head><meta charset="utf-8"></head><body></body></html>'), None)
+
+class test_offline_prefetch(unittest.TestCase):
+    def test_prefetch_languages(self):
+        """Checks episode pages are loaded in bulk"""
+        t, handler = fixture_tvsubtitles(max_workers = 4)
+        show = t['scrubs']
+        del handler.requests[:]
+        self.assertEquals(t.prefetch_languages(51, seasons = [1], languages = ['de']), 3)
+        self.assertEquals(len(handler.requests), 3)
+        loaded = [ep for ep in show[1].values() if ep['languages'].loaded()]
+        self.assertEquals(len(loaded), 3)
+        self.assertEquals(t.prefetch_languages('scrubs'), 16)
+        self.assertEquals(t.prefetch_languages('scrubs'), 0)
+        self.assertEquals(show[2][3]['languages']['fr'][0]['good'], 7)
+        self.assertEquals(len(handler.requests), 19)
+
+class FixtureServer(BaseHTTPServer.HTTPServer):
+    """Local HTTP/1.1 server answering from the fixtures directory with
+    gzip compressed bodies. Counts the accepted connections and the most
+    requests handled at the same time, each one takes delay seconds.
+    """
+    def __init__(self, delay = 0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FixtureRequestHandler)
+        self.connections = 0
+        self.delay = delay
+        self.active = self.max_active = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], path)
+
+    def configure(self, t):
+        """Points a TvSubtitles instance to this server"""
+        t.config['url_searchSeries'] = self.url('search.php')
+        t.config['url_serie_season'] = self.url('tvshow-%s-%s.html')
+        t.config['url_episode'] = self.url('episode-%s.html')
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        # Handle connections in threads, keep-alive blocks the handler
+        thread = threading.Thread(target = BaseHTTPServer.HTTPServer.process_request,
+                                  args = (self, request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FixtureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        server.lock.acquire()
+        server.active += 1
+        server.max_active = max(server.max_active, server.active)
+        server.lock.release()
+        try:
+            time.sleep(server.delay)
+            self.answer()
+        finally:
+            server.lock.acquire()
+            server.active -= 1
+            server.lock.release()
+
+    def answer(self):
+        path = os.path.join(FIXTURES, fixture_for(self.path))
+        if not os.path.exists(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = open(path, 'rb').read()
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj = buf, mode = 'wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=windows-1251')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+class test_offline_transport(unittest.TestCase):
+    def setUp(self):
+        self.server = FixtureServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_keep_alive(self):
+        """Checks connections are reused and gzip bodies decoded"""
+        t = tvsubtitles_api.TvSubtitles()
+        self.server.configure(t)
+        self.assertEquals(t['scrubs'][3][4]['episodename'], 'My First Step')
+        self.assertEquals(t['scrubs'][1][1]['languages']['en'][0]['good'], 30)
+        self.assertEquals(self.server.connections, 1)
+        host = '127.0.0.1:%d' % self.server.server_address[1]
+        timing = t.metrics.timing
+        self.assertEquals(timing('tvsubtitles_http_seconds', phase = 'connect', host = host)['count'], 1)
+        self.assertEquals(timing('tvsubtitles_http_seconds', phase = 'transfer', host = host)['count'], 5)
+        self.assertTrue(t.metrics.counter('tvsubtitles_http_bytes_total', host = host) > 0)
+
+    def test_streaming_read(self):
+        """Checks a response can be read in chunks and by lines"""
+        opener = urllib2.build_opener(tvsubtitles_api.transport.KeepAliveHandler())
+        resp = opener.open(self.server.url('tvshow-51-1.html'))
+        self.assertEquals(resp.readline(), '<html>\n')
+        body = '<html>\n' + resp.read(10) + resp.read()
+        self.assertEquals(body, open(os.path.join(FIXTURES, 'tvshow-51-1.html')).read())
+        self.assertRaises(urllib2.HTTPError, lambda: opener.open(self.server.url('missing.html')))
+        self.assertEquals(self.server.connections, 1)
+
+    def test_small_chunks(self):
+        """Checks bodies read in many small chunks"""
+        opener = urllib2.build_opener(tvsubtitles_api.transport.KeepAliveHandler())
+        response_class = tvsubtitles_api.transport._PooledResponse
+        response_class.chunk_size = 7
+        try:
+            resp = opener.open(self.server.url('tvshow-51-1.html'))
+            body = resp.readline() + resp.read(1000) + resp.read()
+        finally:
+            response_class.chunk_size = 16 * 1024
+        self.assertEquals(body, open(os.path.join(FIXTURES, 'tvshow-51-1.html')).read())
+
+    def test_error_release(self):
+        """Checks the connection of an error answer is reused"""
+        t = tvsubtitles_api.TvSubtitles()
+        self.server.configure(t)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_error,
+                          lambda: t._openUrl(self.server.url('missing.html')))
+        self.assertEquals(t['scrubs'][1][1]['episodename'], 'My First Day')
+        self.assertEquals(self.server.connections, 1)
+
+    def test_stale_connection(self):
+        """Checks only GET requests are retried on a closed idle connection"""
+        handler = tvsubtitles_api.transport.KeepAliveHandler()
+        opener = urllib2.build_opener(handler)
+        def close_idle():
+            for conns in handler.pool._idle.values():
+                for conn in conns:
+                    conn.sock.close()
+        url = self.server.url('tvshow-51-1.html')
+        body = opener.open(url).read()
+        close_idle()
+        self.assertEquals(opener.open(url).read(), body)
+        close_idle()
+        self.assertRaises(urllib2.URLError,
+                          lambda: opener.open(self.server.url('search.php'), 'q=scrubs'))
+        self.assertEquals(self.server.connections, 2)
+
+class test_offline_metrics(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_cache_and_parse_metrics(self):
+        """Checks cache, decode and parse metrics are collected"""
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        events = []
+        t.metrics.add_listener(lambda *event: events.append(event))
+        t['scrubs']
+        metrics = t.metrics
+        self.assertEquals(metrics.counter('tvsubtitles_cache_total', tier = 'raw', result = 'miss'), 4)
+        self.assertEquals(metrics.timing('tvsubtitles_parse_seconds', parser = 'TvSowParser')['count'], 3)
+        self.assertEquals(metrics.timing('tvsubtitles_fetch_seconds', page = 'season')['count'], 3)
+        self.assertEquals(metrics.timing('tvsubtitles_decode_seconds', method = 'unicodedammit')['count'], 4)
+        self.assertTrue(metrics.counter('tvsubtitles_fetch_bytes_total', page = 'search') > 0)
+        self.assertTrue(('counter', 'tvsubtitles_cache_total', 1,
+                         {'tier': 'parsed', 'result': 'miss'}) in events)
+
+        t2, handler = fixture_tvsubtitles(cache = self.location)
+        t2['scrubs']
+        self.assertEquals(t2.metrics.counter('tvsubtitles_cache_total', tier = 'parsed', result = 'hit'), 4)
+        text = t2.metrics.prometheus()
+        self.assertTrue('# TYPE tvsubtitles_cache_total counter' in text)
+        self.assertTrue('tvsubtitles_cache_total{result="hit",tier="parsed"} 4' in text)
+        text = metrics.prometheus()
+        self.assertTrue('# TYPE tvsubtitles_fetch_seconds_max gauge' in text)
+        self.assertTrue('tvsubtitles_fetch_seconds_max{page="search"} ' in text)
+
+class test_offline_async(unittest.TestCase):
+    def setUp(self):
+        self.server = FixtureServer(delay = 0.05)
+        self.t = tvsubtitles_api.AsyncTvSubtitles(max_per_host = 2, rate_limit = None)
+        self.server.configure(self.t)
+
+    def tearDown(self):
+        self.t.close()
+        self.server.stop()
+
+    def test_get_series(self):
+        """Checks search results are returned through a future"""
+        self.assertEquals(self.t.get_series('Scrubs').result(5)['id'], '51')
+
+    def test_get_show_data(self):
+        """Checks concurrent show and language lookups on one thread"""
+        threads = []
+        show = self.t.get_show_data(51)
+        languages = self.t.load_languages(1001)
+        show.add_done_callback(lambda f: threads.append(threading.current_thread()))
+        self.assertEquals(self.t.run([show, languages], 5), True)
+        self.assertEquals(threads, [threading.current_thread()])
+        self.assertEquals(show.result()[1][1]['episodename'], 'My First Day')
+        self.assertEquals(len(show.result()), 3)
+        self.assertTrue(51 in self.t._complete)
+        self.assertEquals(languages.result()['en'][0]['good'], 30)
+        # Seasons 2 and 3 and the languages are loaded together
+        self.assertEquals(self.server.max_active, 2)
+        episode = show.result()[1][1]
+        self.assertEquals(self.t.load_languages(episode).result(5).keys(),
+                          episode['languages'].loaded().keys())
+
+    def test_shared_requests(self):
+        """Checks lookups needing the same page share its request"""
+        futures = [self.t.load_languages(1001) for i in range(3)]
+        futures.append(self.t.get_show('scrubs'))
+        self.t.run(futures, 5)
+        self.assertEquals(self.server.connections, 5)
+        self.assertEquals(futures[3].result()[3][4]['episodename'], 'My First Step')
+
+    def test_blocking_interface(self):
+        """Checks the dict interface runs the event loop"""
+        self.assertEquals(self.t['scrubs'][2][1]['episodename'], 'My Overkill')
+        self.assertEquals(self.t.search('my first', key = 'episodename')[0]['id'], 1001)
+
+    def test_callback_and_errors(self):
+        """Checks callbacks run and errors are raised by result()"""
+        called = []
+        future = self.t.get_show_data(404)
+        future.add_done_callback(called.append)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_error,
+                          lambda: future.result(5))
+        self.assertEquals(called, [future])
+
+class test_offline_cache(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_cache_hit(self):
+        """Checks a second instance is served from the disk cache"""
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        t['scrubs']
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        self.assertEquals(t['scrubs'][2][1]['episodename'], 'My Overkill')
+        self.assertEquals(handler.requests, [])
+
+    def test_revalidation(self):
+        """Checks expired pages are revalidated with their ETag"""
+        t, handler = fixture_tvsubtitles(cache = self.location,
+            cache_ttl = {'search': 0, 'season': 0})
+        t['scrubs']
+        t, handler = fixture_tvsubtitles(cache = self.location,
+            cache_ttl = {'search': 0, 'season': 0})
+        self.assertEquals(t['scrubs'][2][1]['episodename'], 'My Overkill')
+        self.assertEquals(len(handler.requests), 4)
+
+    def test_recache(self):
+        """Checks recache downloads the page again"""
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        url = t.config['url_serie_season'] % (51, 1)
+        t._loadUrl(url, None)
+        t._loadUrl(url, None)
+        self.assertEquals(len(handler.requests), 1)
+        t._loadUrl(url, None, recache = True)
+        self.assertEquals(len(handler.requests), 2)
+
+    def test_parsed_cache(self):
+        """Checks parsed results are cached and stamped with the parser
+        version"""
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        t['scrubs']
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        parsed = []
+        loadPage = t._loadPage
+        def counting_loadPage(*args, **kwargs):
+            parsed.append(args[0])
+            return loadPage(*args, **kwargs)
+        t._loadPage = counting_loadPage
+        self.assertEquals(t['scrubs'][3][4]['episodename'], 'My First Step')
+        self.assertEquals(parsed, [])
+
+        parser = tvsubtitles_api.parsers.TvSowParser
+        parser.version += 1
+        try:
+            t.shows.clear()
+            t._getShowData(51)
+        finally:
+            parser.version -= 1
+        self.assertEquals(len(parsed), 3)
+        self.assertEquals(handler.requests, [])
+
+    def test_lru_eviction(self):
+        """Checks the cache size is capped"""
+        cache = tvsubtitles_api.cache.DiskCache(self.location, max_size = 10000)
+        for i in range(10):
+            cache.set(cache.key(str(i)), {'body': 'x' * 2000})
+        self.assertTrue(cache.size() <= 10000)
+        self.assertEquals(cache.get(cache.key('0')), None)
+        self.assertEquals(cache.get(cache.key('9')), {'body': 'x' * 2000})
+
+    def test_eviction_batches(self):
+        """Checks entries are evicted in batches and the size recounted"""
+        scans = []
+        class CountingCache(tvsubtitles_api.cache.DiskCache):
+            def _files(self):
+                scans.append(1)
+                return tvsubtitles_api.cache.DiskCache._files(self)
+        cache = CountingCache(self.location, max_size = 10000, low_water = 0.5)
+        for i in range(20):
+            cache.set(cache.key(str(i)), {'body': 'x' * 1000})
+        self.assertTrue(cache.size() <= 10000)
+        # One scan for the initial size, then one per batch of evictions
+        self.assertTrue(len(scans) <= 5, scans)
+        # Another process emptying the cache makes the count drift
+        tvsubtitles_api.cache.DiskCache(self.location).clear()
+        count = len(scans)
+        for i in range(8):
+            cache.set(cache.key('new%d' % i), {'body': 'x' * 1000})
+        self.assertEquals(len(scans), count + 1)
+        self.assertEquals(cache.size(), sum(f[1] for f in cache._files()))
+        self.assertEquals(cache.get(cache.key('new0')), {'body': 'x' * 1000})
+
+    def test_json_entries(self):
+        """Checks entries are stored as JSON, and pickled files are never
+        loaded"""
+        cache = tvsubtitles_api.cache.DiskCache(self.location)
+        entry = {'body': '\xff\xfe', 'name': u'caf\xe9', 'seasons': {1: [2, None]},
+                 'uploaded': datetime.datetime(2010, 2, 4, 21, 15, 40)}
+        cache.set('a', entry)
+        self.assertEquals(cache.get('a'), entry)
+        json.loads(open(cache._path('a')).read())
+
+        marker = os.path.join(self.location, 'marker')
+        f = open(cache._path('a'), 'wb')
+        f.write("cos\nsystem\n(S'touch %s'\ntR." % marker)
+        f.close()
+        self.assertEquals(cache.get('a'), None)
+        self.assertFalse(os.path.exists(marker))
+        self.assertFalse(os.path.exists(cache._path('a')))
+
+    def test_private_directory(self):
+        """Checks the default cache directory belongs to the user and is
+        not accessible to others"""
+        gettempdir = tvsubtitles_api.cache.tempfile.gettempdir
+        tvsubtitles_api.cache.tempfile.gettempdir = lambda: self.location
+        try:
+            t = tvsubtitles_api.TvSubtitles(cache = True, catalog = True)
+            path = tvsubtitles_api.cache.user_directory()
+        finally:
+            tvsubtitles_api.cache.tempfile.gettempdir = gettempdir
+        self.assertEquals(os.path.dirname(t.cache.location), path)
+        self.assertEquals(os.path.dirname(t.catalog.path), path)
+        self.assertEquals(os.stat(path).st_mode & 0777, 0700)
+        self.assertEquals(os.stat(t.cache.location).st_mode & 0777, 0700)
+
+        os.chmod(path, 0777)
+        tvsubtitles_api.cache.private_directory(path)
+        self.assertEquals(os.stat(path).st_mode & 0777, 0700)
+        link = os.path.join(self.location, 'link')
+        os.symlink(path, link)
+        self.assertRaises(OSError, tvsubtitles_api.cache.private_directory, link)
+
+    def test_atomic_write(self):
+        """Checks a failed write keeps the previous file and no temporary
+        file"""
+        path = os.path.join(self.location, 'data.json')
+        tvsubtitles_api.atomicfile.replace_file(path, lambda f: f.write('old'))
+        def fail(f):
+            f.write('partial')
+            raise IOError('disk full')
+        self.assertRaises(IOError, tvsubtitles_api.atomicfile.replace_file, path, fail)
+        self.assertEquals(open(path).read(), 'old')
+        self.assertEquals(os.listdir(self.location), ['data.json'])
+
+    def test_invalid_cache_option(self):
+        """Checks invalid cache values are refused"""
+        self.assertRaises(ValueError, lambda: tvsubtitles_api.TvSubtitles(cache = 2.3))
+
+class FlakyHandler(FixtureHandler):
+    """FixtureHandler failing the first requests with the given errors,
+    a status code or None for a connection error
+    """
+    def __init__(self, failures, retry_after = None):
+        FixtureHandler.__init__(self)
+        self.failures = list(failures)
+        self.retry_after = retry_after
+
+    def http_open(self, req):
+        if not self.failures:
+            return FixtureHandler.http_open(self, req)
+        self.requests.append(req.get_full_url())
+        code = self.failures.pop(0)
+        if code is None:
+            raise urllib2.URLError('timed out')
+        headers = ''
+        if self.retry_after is not None:
+            headers = 'Retry-After: %s\r\n' % self.retry_after
+        raise urllib2.HTTPError(req.get_full_url(), code, 'Unavailable',
+            urllib2.httplib.HTTPMessage(StringIO(headers + '\r\n')), StringIO(''))
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class test_offline_scheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def scheduled(self, handler, **kwargs):
+        kwargs.setdefault('rate', None)
+        scheduler = tvsubtitles_api.scheduler.RequestScheduler(
+            clock = self.clock, sleep = self.clock.sleep, **kwargs)
+        return tvsubtitles_api.TvSubtitles(
+            urlopener = urllib2.build_opener(handler), scheduler = scheduler)
+
+    def test_token_bucket(self):
+        """Checks requests are throttled once the burst is used"""
+        bucket = tvsubtitles_api.scheduler.TokenBucket(
+            2, burst = 3, clock = self.clock, sleep = self.clock.sleep)
+        for i in range(5):
+            bucket.acquire()
+        self.assertEquals(self.clock.sleeps, [0.5, 0.5])
+        self.clock.now += 10
+        bucket.acquire()
+        self.assertEquals(len(self.clock.sleeps), 2)
+
+    def test_retries(self):
+        """Checks 502 and 503 answers are retried"""
+        handler = FlakyHandler([502, 503])
+        t = self.scheduled(handler, backoff = 1)
+        self.assertEquals(t._getSeries('scrubs')['id'], '51')
+        self.assertEquals(len(handler.requests), 3)
+        self.assertEquals(len(self.clock.sleeps), 2)
+        self.assertTrue(0 <= self.clock.sleeps[0] <= 1)
+        self.assertTrue(0 <= self.clock.sleeps[1] <= 2)
+
+    def test_retry_after(self):
+        """Checks the Retry-After delay of the server is honored"""
+        handler = FlakyHandler([429], retry_after = 7)
+        t = self.scheduled(handler)
+        t._getSeries('scrubs')
+        self.assertEquals(self.clock.sleeps, [7])
+
+    def test_no_retry(self):
+        """Checks other HTTP errors are not retried"""
+        handler = FlakyHandler([404, 404])
+        t = self.scheduled(handler)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_error,
+                          lambda: t._getSeries('scrubs'))
+        self.assertEquals(len(handler.requests), 1)
+        self.assertEquals(t.scheduler.last_failure('www.tvsubtitles.net'), None)
+
+    def test_no_post_retry(self):
+        """Checks connection errors of a search POST are not retried"""
+        handler = FlakyHandler([None])
+        t = self.scheduled(handler)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_error,
+                          lambda: t._getSeries('scrubs'))
+        self.assertEquals(len(handler.requests), 1)
+        self.assertEquals(self.clock.sleeps, [])
+        self.assertNotEquals(t.scheduler.last_failure('www.tvsubtitles.net'), None)
+
+    def test_circuit_breaker(self):
+        """Checks a failing host is left alone until reset_timeout"""
+        handler = FlakyHandler([503] * 4)
+        t = self.scheduled(handler, retries = 1, failure_threshold = 3,
+                           reset_timeout = 60)
+        error = tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_error
+        self.assertRaises(error, lambda: t._getSeries('scrubs'))
+        self.assertRaises(error, lambda: t._getSeries('scrubs'))
+        self.assertEquals(len(handler.requests), 3)
+        self.assertTrue(t.scheduler.is_open('www.tvsubtitles.net'))
+        self.assertRaises(error, lambda: t._getSeries('scrubs'))
+        self.assertEquals(len(handler.requests), 3)
+
+        self.clock.now += 60
+        self.assertRaises(error, lambda: t._getSeries('scrubs'))
+        self.assertEquals(len(handler.requests), 4)
+        self.clock.now += 60
+        self.assertEquals(t._getSeries('scrubs')['id'], '51')
+        self.assertFalse(t.scheduler.is_open('www.tvsubtitles.net'))
+
+    def test_single_probe(self):
+        """Checks a single request probes a host after reset_timeout"""
+        scheduler = tvsubtitles_api.scheduler.RequestScheduler(
+            rate = None, retries = 0, failure_threshold = 2, reset_timeout = 60,
+            clock = self.clock, sleep = self.clock.sleep)
+        error = tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_error
+        def fail():
+            raise tvsubtitles_api.scheduler.RetryableError('timed out')
+        for i in range(2):
+            self.assertRaises(error, lambda: scheduler.call('host', fail))
+        self.clock.now += 60
+        started, finish = threading.Event(), threading.Event()
+        def probe():
+            started.set()
+            finish.wait(5)
+            return 'probe'
+        results = []
+        thread = threading.Thread(target = lambda: results.append(scheduler.call('host', probe)))
+        thread.start()
+        started.wait(5)
+        self.assertTrue(scheduler.is_open('host'))
+        self.assertRaises(error, lambda: scheduler.call('host', lambda: 'other'))
+        finish.set()
+        thread.join(5)
+        self.assertEquals(results, ['probe'])
+        self.assertEquals(scheduler.call('host', lambda: 'other'), 'other')
+
+class SlowHandler(FixtureHandler):
+    """FixtureHandler taking some time to answer, so that concurrent
+    requests overlap
+    """
+    def http_open(self, req):
+        time.sleep(0.05)
+        return FixtureHandler.http_open(self, req)
+
+class test_offline_singleflight(unittest.TestCase):
+    def concurrently(self, func, count = 8):
+        results, errors = [], []
+        def run():
+            try:
+                results.append(func())
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results, errors
+
+    def test_concurrent_show_lookups(self):
+        """Checks concurrent lookups of a show fetch its pages once"""
+        handler = SlowHandler()
+        t = tvsubtitles_api.TvSubtitles(urlopener = urllib2.build_opener(handler),
+                                        rate_limit = None)
+        results, errors = self.concurrently(lambda: t['scrubs'])
+        self.assertEquals(errors, [])
+        self.assertEquals(len(handler.requests), 4)
+        self.assertTrue(all(show is t.shows[51] for show in results))
+        self.assertEquals(len(t[51][1]), 8)
+
+    def test_concurrent_language_lookups(self):
+        """Checks concurrent lookups of an episode share one request"""
+        handler = SlowHandler()
+        t = tvsubtitles_api.TvSubtitles(urlopener = urllib2.build_opener(handler),
+                                        rate_limit = None)
+        getters = [tvsubtitles_api.api.LanguageGetter(t, 1001) for i in range(8)]
+        results, errors = self.concurrently(lambda: getters.pop()['en'])
+        self.assertEquals(errors, [])
+        self.assertEquals(len(handler.requests), 1)
+        self.assertEquals(len(results), 8)
+
+    def test_shared_errors(self):
+        """Checks waiting callers get the exception of the shared call"""
+        flight = tvsubtitles_api.singleflight.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('failed')
+        leader = threading.Thread(target = lambda: self.assertRaises(
+            ValueError, lambda: flight.do('key', fail)))
+        leader.start()
+        started.wait(5)
+        errors = []
+        def follow():
+            try:
+                flight.do('key', lambda: 'not called')
+            except ValueError, e:
+                errors.append(e)
+        follower = threading.Thread(target = follow)
+        follower.start()
+        while not flight.waiters('key'):
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEquals([str(e) for e in errors], ['failed'])
+        self.assertEquals(flight.do('key', lambda: 'again'), 'again')
+
+class test_offline_refresh(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.t, self.handler = fixture_tvsubtitles(cache = self.location)
+        self.t['scrubs']
+        del self.handler.requests[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def new_episodes(self):
+        """Renames 3x02, adds french subtitles to 3x05, a 3x06 episode
+        and a fourth season"""
+        page = open(os.path.join(FIXTURES, 'tvshow-51-3.html')).read()
+        row = [line for line in page.splitlines() if '3x05' in line][0]
+        french = row.replace('<td>1</td>', '<td>2</td>').replace('</a></nobr>',
+            '</a> <a href="subtitle-3005-fr.html"><img src="images/flags/fr.gif" '
+            'width=18 height=12 alt="fr"></a></nobr>')
+        added = row.replace('3x05', '3x06').replace('3005', '3006').replace(
+            'My Fault', 'My Lucky Charm')
+        season3 = page.replace(row, added + '\n' + french).replace(
+            'My Journey', 'My Long Journey').replace(
+            '<font class="w"><b>Season 3</b></font>',
+            '<font class="w"><b>Season 3</b></font> | '
+            '<a href="tvshow-51-4.html"><b>Season 4</b></a>')
+        season4 = page.replace('3x0', '4x0').replace('-300', '-400').replace(
+            '<a href="tvshow-51-2.html"><b>Season 2</b></a> | '
+            '<font class="w"><b>Season 3</b></font>',
+            '<a href="tvshow-51-2.html"><b>Season 2</b></a> | '
+            '<a href="tvshow-51-3.html"><b>Season 3</b></a> | '
+            '<font class="w"><b>Season 4</b></font>')
+        self.handler.overrides['tvshow-51-3.html'] = season3
+        self.handler.overrides['tvshow-51-4.html'] = season4
+
+    def test_unchanged(self):
+        """Checks an unchanged show is revalidated with the newest season"""
+        self.assertEquals(self.t.refresh('scrubs'), [])
+        self.assertEquals(self.handler.requests,
+                          ['http://www.tvsubtitles.net/tvshow-51-3.html'])
+        self.assertEquals(self.t.metrics.counter('tvsubtitles_cache_total',
+                          tier = 'parsed', result = 'revalidated'), 1)
+
+    def test_changes(self):
+        """Checks new and changed episodes are applied in place"""
+        show = self.t[51]
+        episode = show[3][5]
+        languages = episode['available_languages']
+        episode['languages']['en']
+        del self.handler.requests[:]
+        self.new_episodes()
+
+        changes = self.t.refresh(51)
+        self.assertEquals(self.handler.requests, [
+            'http://www.tvsubtitles.net/tvshow-51-3.html',
+            'http://www.tvsubtitles.net/tvshow-51-4.html'])
+        self.assertEquals(sorted((change, ep['seasonnumber'], ep['episodenumber'])
+                                 for change, ep in changes),
+            [('added', 3, 6)] + [('added', 4, num) for num in range(1, 6)] +
+            [('updated', 3, 2), ('updated', 3, 5)])
+        self.assertTrue(show[3][5] is episode)
+        self.assertTrue(episode['available_languages'] is languages)
+        self.assertEquals(sorted(languages), ['en', 'fr'])
+        self.assertEquals(episode['languages'].loaded(), None)
+        self.assertEquals(show[3][4]['languages'].loaded(), None)
+        self.assertEquals(show[3][2]['episodename'], 'My Long Journey')
+        self.assertEquals(show.search('long journey'), [show[3][2]])
+        self.assertEquals(len(show[4]), 5)
+
+    def test_all_seasons(self):
+        """Checks all_seasons revalidates every season and removals"""
+        page = open(os.path.join(FIXTURES, 'tvshow-51-2.html')).read()
+        row = [line for line in page.splitlines() if '2x06' in line][0]
+        self.handler.overrides['tvshow-51-2.html'] = page.replace(row + '\n', '')
+        episode = self.t[51][2][6]
+        changes = self.t.refresh(51, all_seasons = True)
+        self.assertEquals(len(self.handler.requests), 3)
+        self.assertEquals(changes, [('removed', episode)])
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_episodenotfound,
+                          lambda: self.t[51][2][6])
+        self.assertEquals(self.t[51].search(episode['episodename']), [])
+
+class test_offline_catalog(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.path = os.path.join(self.location, 'catalog.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def seeded(self):
+        catalog = tvsubtitles_api.catalog.ShowCatalog(self.path)
+        names = [line.strip() for line in open(os.path.join(FIXTURES, 'shows.txt'))]
+        catalog.seed((sid, name) for sid, name in enumerate(names, 1000)
+                     if name and 'Scrubs' not in name)
+        catalog.seed([(51, 'Scrubs (2001-2010)', ['en', 'fr']),
+                      {'id': 1262, 'name': 'Scrubs: Interns (2009-2009)'}])
+        return catalog
+
+    def test_lookup(self):
+        """Checks exact, fuzzy and ambiguous catalog lookups"""
+        catalog = self.seeded()
+        self.assertEquals(catalog.lookup('Scrubs'), 51)
+        self.assertEquals(catalog.lookup('scrubs (2001-2010)'), 51)
+        self.assertEquals(catalog.lookup('scrubs  interns'), 1262)
+        self.assertEquals(catalog.lookup('scrubs'), 51)
+        self.assertEquals(catalog.lookup('arrested developement'), 1003)
+        self.assertEquals(catalog.lookup('unknown show'), None)
+        self.assertEquals(catalog.search('scrub', k = 2)[0][1:], (51, 'Scrubs (2001-2010)'))
+        catalog.add(52, 'Scrubs (1990-1991)')
+        self.assertEquals(catalog.lookup('scrubs'), None)
+        catalog.alias('scrubs', 51)
+        self.assertEquals(catalog.lookup('scrubs'), 51)
+
+    def test_persistence(self):
+        """Checks the catalog is saved and loaded as JSON"""
+        catalog = self.seeded()
+        catalog.alias('jd show', 51)
+        catalog.save()
+        loaded = tvsubtitles_api.catalog.ShowCatalog(self.path)
+        self.assertEquals(len(loaded), len(catalog))
+        self.assertFalse(loaded.changed)
+        self.assertEquals(loaded.get(51), {'id': 51, 'name': 'Scrubs (2001-2010)',
+                                           'languages': ['en', 'fr']})
+        self.assertEquals(loaded.lookup('jd show'), 51)
+
+    def test_offline_resolution(self):
+        """Checks known names are resolved without searching the site"""
+        t, handler = fixture_tvsubtitles(catalog = self.path)
+        self.assertEquals(t._nameToSid('scrubs', load = False), 51)
+        self.assertEquals(len(handler.requests), 1)
+        # Changes are saved in batches
+        self.assertFalse(os.path.exists(self.path))
+        t.close()
+        self.assertTrue(os.path.exists(self.path))
+
+        t, handler = fixture_tvsubtitles(catalog = self.path)
+        self.assertEquals(t._nameToSid('scrubs', load = False), 51)
+        self.assertEquals(t._nameToSid('scrubs: interns', load = False), 1262)
+        self.assertEquals(handler.requests, [])
+        t._nameToSid('lost', load = False)
+        self.assertEquals(handler.requests, ['http://www.tvsubtitles.net/search.php'])
+
+    def test_flush(self):
+        """Checks catalog changes are saved every save_interval seconds"""
+        catalog = tvsubtitles_api.catalog.ShowCatalog(self.path, save_interval = 3600)
+        catalog.add(51, 'Scrubs (2001-2010)')
+        catalog.flush()
+        self.assertFalse(os.path.exists(self.path))
+        catalog.save_interval = 0
+        catalog.flush()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(catalog.changed)
+
+class test_offline_ranking(unittest.TestCase):
+    def setUp(self):
+        names = [line.strip() for line in open(os.path.join(FIXTURES, 'shows.txt'))]
+        self.names = [unicode(name.lower()) for name in names if name]
+
+    def rankers(self):
+        ranking = tvsubtitles_api.ranking
+        rankers = [ranking.BigramRanker(self.names, use_numpy = False)]
+        if ranking._numpy() is not None:
+            rankers.append(ranking.BigramRanker(self.names, use_numpy = True))
+        return rankers
+
+    def test_same_scores(self):
+        """Checks batched scores match dice_coefficient"""
+        dice = tvsubtitles_api.api.dice_coefficient
+        for term in (u'the office', u'scrubs', u'x', u''):
+            expected = [dice(term, name) for name in self.names]
+            self.assertEquals(tvsubtitles_api.ranking.dice_scores(term, self.names), expected)
+            for ranker in self.rankers():
+                scores = [round(score, 9) for score in ranker.scores(term)]
+                self.assertEquals(scores, [round(score, 9) for score in expected])
+
+    def test_top(self):
+        """Checks top returns the best scores first"""
+        dice = tvsubtitles_api.api.dice_coefficient
+        expected = sorted(((dice(u'the ofice', name), index)
+                           for index, name in enumerate(self.names)),
+                          key = lambda match: (-match[0], match[1]))[:5]
+        for ranker in self.rankers():
+            top = ranker.top(u'the ofice', k = 5)
+            self.assertEquals([index for score, index in top],
+                              [index for score, index in expected])
+            self.assertEquals(self.names[top[0][1]], u'the office (uk)')
+            ranker.add(u'the ofice')
+            self.assertEquals(ranker.top(u'the ofice', k = 1), [(1.0, len(self.names))])
+
+    def test_rank(self):
+        """Checks rank keeps the order of names scoring the same"""
+        names = [u'lost', u'scrubs: interns', u'x', u'scrubs', u'y']
+        self.assertEquals(tvsubtitles_api.ranking.rank(u'scrubs', names), [3, 1, 0, 2, 4])
+
+class test_offline_crawler(unittest.TestCase):
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def crawl(self, keys, **kwargs):
+        results = []
+        checkpoint = tvsubtitles_api.crawler.crawl(keys, self.store, processes = 2,
+            rate_limit = None, progress = lambda *result: results.append(result),
+            tvsubtitles = {'urlopener': urllib2.build_opener(FixtureHandler())},
+            **kwargs)
+        return checkpoint, results
+
+    def test_crawl(self):
+        """Checks shows are crawled into the store by several processes"""
+        checkpoint, results = self.crawl(['scrubs', '51', 'scrubs', '404'],
+                                         languages = True)
+        self.assertEquals(len(results), 3)
+        self.assertEquals(checkpoint['done'], {'scrubs': 51, '51': 51})
+        self.assertEquals(checkpoint['failed'].keys(), ['404'])
+        self.assertEquals(sorted(os.listdir(self.store)), ['51.json', 'checkpoint.json'])
+
+        show = json.load(open(os.path.join(self.store, '51.json')))
+        self.assertEquals(show['seriesname'], 'Scrubs')
+        self.assertEquals(sorted(show['seasons']), ['1', '2', '3'])
+        episode = show['seasons']['1']['1']
+        self.assertEquals(episode['episodename'], 'My First Day')
+        self.assertEquals(episode['subtitles']['en'][0]['good'], 30)
+
+    def test_resume(self):
+        """Checks a crawl resumes from its checkpoint"""
+        self.crawl(['51', '404'])
+        checkpoint, results = self.crawl(['51', '404', 'scrubs'])
+        self.assertEquals([result[0] for result in results], ['scrubs'])
+        self.assertFalse('subtitles' in json.load(open(os.path.join(
+            self.store, '51.json')))['seasons']['1']['1'])
+        checkpoint, results = self.crawl(['51', '404'], retry_failed = True)
+        self.assertEquals([result[0] for result in results], ['404'])
+        self.assertEquals(tvsubtitles_api.crawler.load_checkpoint(self.store), checkpoint)
+
+    def test_checkpoint_log(self):
+        """Checks results are logged, and the checkpoint written once at
+        each end of the crawl"""
+        crawler = tvsubtitles_api.crawler
+        writes = []
+        write_json = crawler.write_json
+        def counting_write_json(path, data):
+            writes.append(os.path.basename(path))
+            write_json(path, data)
+        crawler.write_json = counting_write_json
+        try:
+            self.crawl(['scrubs', '51', '404'])
+        finally:
+            crawler.write_json = write_json
+        self.assertEquals(writes.count('checkpoint.json'), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.store, 'checkpoint.log')))
+
+        # Results logged by an interrupted crawl, the last line is cut
+        f = open(os.path.join(self.store, 'checkpoint.log'), 'w')
+        f.write('["lost", 9, null]\n["404", 51, null]\n["the off')
+        f.close()
+        checkpoint = crawler.load_checkpoint(self.store)
+        self.assertEquals(checkpoint['done'], {'scrubs': 51, '51': 51, 'lost': 9, '404': 51})
+        self.assertEquals(checkpoint['failed'], {})
+
+    def test_rate_limit(self):
+        """Checks the rate limit is shared by the processes"""
+        crawler = tvsubtitles_api.crawler
+        try:
+            crawler._init_worker({'processes': 4, 'rate_limit': 8.0})
+            self.assertEquals(crawler._tvsubtitles.scheduler.rate, 2.0)
+        finally:
+            crawler._tvsubtitles = crawler._options = None
+
+class test_offline_snapshot(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.path = os.path.join(self.location, 'shows.snap')
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_round_trip(self):
+        """Checks shows and loaded subtitles are restored from a snapshot"""
+        t, handler = fixture_tvsubtitles()
+        show = t['scrubs']
+        subtitles = show[1][1]['languages']['en']
+        t.dump_snapshot(self.path)
+
+        t2, handler = fixture_tvsubtitles()
+        snapshot = t2.load_snapshot(self.path)
+        self.assertEquals(len(snapshot), 1)
+        self.assertEquals(t2.shows.keys(), [51])
+        self.assertEquals(t2.search('first day'), [])
+        self.assertFalse(t2.shows.materialized(51))
+        loaded = t2[51]
+        self.assertEquals(dump_show(loaded), dump_show(show))
+        self.assertEquals(loaded.data, show.data)
+        self.assertEquals(loaded[1][1]['languages']['en'], subtitles)
+        self.assertEquals(loaded.search('first day'), [loaded[1][1]])
+        self.assertEquals(handler.requests, [])
+        loaded[1][2]['languages']['en']
+        self.assertEquals(len(handler.requests), 1)
+
+    def test_compact_and_copy(self):
+        """Checks compact episodes and dumps of unaccessed snapshot shows"""
+        t, handler = fixture_tvsubtitles()
+        show = t[51]
+        t.dump_snapshot(self.path)
+        t2, handler = fixture_tvsubtitles(compact = True)
+        t2.load_snapshot(self.path)
+        copy = os.path.join(self.location, 'copy.snap')
+        t2.dump_snapshot(copy)
+        self.assertFalse(t2.shows.materialized(51))
+        self.assertEquals(open(copy, 'rb').read(), open(self.path, 'rb').read())
+        self.assertTrue(isinstance(t2[51][1][1], tvsubtitles_api.api.CompactEpisode))
+        self.assertEquals(dump_show(t2[51]), dump_show(show))
+        t2.shows.pop(51)
+        self.assertFalse(51 in t2.shows)
+        self.assertEquals(t2.shows.keys(), [])
+
+    def test_partial_show(self):
+        """Checks the season list of a partially loaded show is kept"""
+        t, handler = fixture_tvsubtitles(lazy = True)
+        t.episode('scrubs', 2, 1)
+        t.dump_snapshot(self.path)
+        t2, handler2 = fixture_tvsubtitles(lazy = True)
+        t2.load_snapshot(self.path)
+        show = t2.shows[51]
+        self.assertEquals((show.keys(), len(show)), ([1, 2, 3], 3))
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_seasonnotfound,
+                          lambda: show[7])
+        self.assertEquals(handler2.requests, [])
+        self.assertEquals(show[3][4]['episodename'], 'My First Step')
+        self.assertEquals(handler2.requests, ['http://www.tvsubtitles.net/tvshow-51-3.html'])
+
+    def test_invalid_file(self):
+        """Checks files which are not snapshots are refused"""
+        open(self.path, 'wb').write('not a snapshot' * 10)
+        t, handler = fixture_tvsubtitles()
+        self.assertRaises(ValueError, lambda: t.load_snapshot(self.path))
+
+class CountingHandler(SlowHandler):
+    """SlowHandler recording the highest number of concurrent requests"""
+    def __init__(self):
+        SlowHandler.__init__(self)
+        self.running = self.highest = 0
+
+    def http_open(self, req):
+        self.lock.acquire()
+        self.running += 1
+        self.highest = max(self.highest, self.running)
+        self.lock.release()
+        try:
+            return SlowHandler.http_open(self, req)
+        finally:
+            self.lock.acquire()
+            self.running -= 1
+            self.lock.release()
+
+class test_offline_download(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        archive = zipfile.ZipFile(os.path.join(FIXTURES, 'download.zip'))
+        self.contents = dict((name, archive.read(name)) for name in archive.namelist())
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def stored(self):
+        return sorted(name for path, dirs, names in os.walk(self.location)
+                      for name in names)
+
+    def test_download(self):
+        """Checks the files of the downloaded archives are stored once"""
+        t, handler = fixture_tvsubtitles()
+        releases = t['scrubs'][1][1]['languages']['en']
+        results = t.download(releases, self.location)
+        self.assertEquals([r['url'] for r in results],
+                          [r['download_url'] for r in releases])
+        self.assertEquals([r['error'] for r in results], [None, None])
+        for result in results:
+            files = result['files']
+            self.assertEquals(sorted(f['name'] for f in files), sorted(self.contents))
+            for f in files:
+                self.assertEquals(open(f['path'], 'rb').read(), self.contents[f['name']])
+                self.assertEquals(f['size'], len(self.contents[f['name']]))
+                self.assertTrue(f['digest'] in os.path.basename(f['path']))
+        self.assertEquals(results[0]['files'], [dict(f, url = results[0]['url'])
+                                                for f in results[1]['files']])
+        self.assertEquals(len(self.stored()), 2)
+        self.assertTrue(self.stored()[0].endswith(('.srt', '.txt')))
+
+    def test_errors(self):
+        """Checks a failed download does not stop the others"""
+        t, handler = fixture_tvsubtitles()
+        results = t.download(['http://www.tvsubtitles.net/download-9001.html',
+                              'http://www.tvsubtitles.net/missing-1.html'], self.location)
+        self.assertEquals(len(results[0]['files']), 2)
+        self.assertEquals(results[1]['files'], [])
+        self.assertTrue('404' in results[1]['error'])
+        self.assertEquals(len(self.stored()), 2)
+
+    def test_not_zip(self):
+        """Checks other payloads are stored as they are"""
+        t, handler = fixture_tvsubtitles()
+        handler.overrides['download.zip'] = '1\r\n00:00:01,000 --> 00:00:02,000\r\nHi\r\n'
+        downloader = tvsubtitles_api.download.SubtitleDownloader(t, self.location)
+        files = downloader.download('http://www.tvsubtitles.net/download-9001.html')
+        self.assertEquals(len(files), 1)
+        self.assertEquals(open(files[0]['path'], 'rb').read(),
+                          handler.overrides['download.zip'])
+
+    def test_per_host_limit(self):
+        """Checks at most max_per_host downloads run on a host at once"""
+        handler = CountingHandler()
+        t = tvsubtitles_api.TvSubtitles(urlopener = urllib2.build_opener(handler),
+                                        rate_limit = None)
+        urls = ['http://www.tvsubtitles.net/download-%d.html' % i for i in range(8)]
+        results = t.download(urls, self.location, max_workers = 8, max_per_host = 2)
+        self.assertEquals([len(r['files']) for r in results], [2] * 8)
+        self.assertEquals(handler.highest, 2)
+
+    def test_keep_alive_server(self):
+        """Checks archives are streamed through the default opener"""
+        server = FixtureServer()
+        try:
+            t = tvsubtitles_api.TvSubtitles()
+            downloader = tvsubtitles_api.download.SubtitleDownloader(t, self.location)
+            downloader.chunk_size = 256
+            urls = [server.url('download-%d.html' % i) for i in range(3)]
+            results = downloader.download_all(urls, max_workers = 1)
+        finally:
+            server.stop()
+        self.assertEquals([len(r['files']) for r in results], [2] * 3)
+        self.assertEquals(len(self.stored()), 2)
+        self.assertEquals(server.connections, 1)
+        self.assertEquals(t.metrics.counter('tvsubtitles_download_bytes_total'),
+                          3 * os.path.getsize(os.path.join(FIXTURES, 'download.zip')))
+
+    def test_async_client(self):
+        """Checks archives are streamed through AsyncTvSubtitles"""
+        t, handler = fixture_tvsubtitles(tvsubtitles_api.AsyncTvSubtitles,
+                                         max_per_host = 1)
+        try:
+            downloader = tvsubtitles_api.download.SubtitleDownloader(t, self.location)
+            downloader.chunk_size = 256
+            results = downloader.download_all(
+                ['http://www.tvsubtitles.net/download-%d.html' % i for i in range(3)],
+                max_workers = 3)
+            self.assertEquals([r['error'] for r in results], [None] * 3)
+            self.assertEquals([len(r['files']) for r in results], [2] * 3)
+        finally:
+            t.close()
+
+class test_offline_selection(unittest.TestCase):
+    def setUp(self):
+        self.t, self.handler = fixture_tvsubtitles()
+        self.languages = self.t['scrubs'][1][1]['languages']
+
+    def test_parse_filename(self):
+        """Checks episode, group, source and resolution tokens"""
+        parse_filename = tvsubtitles_api.selection.parse_filename
+        info = parse_filename('/videos/Scrubs.S01E01.720p.HDTV.x264-LOL.mkv')
+        self.assertEquals((info['show'], info['season'], info['episode'], info['group'],
+                           info['source'], info['resolution']),
+                          ('scrubs', 1, 1, 'lol', 'hdtv', '720p'))
+        self.assertTrue('x264' in info['tokens'])
+        info = parse_filename('scrubs 3x04 dvdrip xvid-topaz.avi')
+        self.assertEquals((info['show'], info['season'], info['episode'], info['group'],
+                           info['source'], info['resolution']),
+                          ('scrubs', 3, 4, 'topaz', 'dvd', None))
+        info = parse_filename('The.Office.US.S02E10.1080p.WEB-DL-NTb.mkv')
+        self.assertEquals((info['show'], info['group'], info['source'], info['resolution']),
+                          ('the office us', 'ntb', 'web', '1080p'))
+        self.assertEquals(parse_filename('notes.txt')['season'], None)
+
+    def test_unrated(self):
+        """Checks releases without rating are parsed and sorted last"""
+        self.assertEquals([r['good'] for r in self.languages['en']], [30, 12])
+        self.assertFalse('good' in self.languages['de'][0])
+        self.assertEquals(self.languages['de'][0]['downloaded'], 95)
+
+    def test_best(self):
+        """Checks the release matching the file wins over ratings"""
+        selector = tvsubtitles_api.selection.ReleaseSelector(self.languages['en'])
+        best = lambda name: selector.best(name)['release']
+        self.assertEquals(best('Scrubs.S01E01.720p.HDTV.x264-LOL.mkv'),
+                          'Scrubs.S01E01.720p.HDTV.x264-LOL')
+        self.assertEquals(best('scrubs.s01e01.dvdrip.xvid-topaz.avi'),
+                          'Scrubs.S01E01.DVDRip.XviD-TOPAZ')
+        self.assertEquals(best('scrubs.1x01.dvdrip.avi'), 'Scrubs.S01E01.DVDRip.XviD-TOPAZ')
+        # Nothing matches: the best rated and most downloaded release
+        self.assertEquals(best('scrubs.s01e01.avi'), 'Scrubs.S01E01.720p.HDTV.x264-LOL')
+        scores = selector.scores('scrubs.s01e01.avi')
+        self.assertEquals(len(scores), 2)
+        self.assertTrue(scores[0][0] > scores[1][0])
+        self.assertEquals(tvsubtitles_api.selection.ReleaseSelector([]).best('a.avi'), None)
+
+    def test_batch(self):
+        """Checks batches load each episode once and keep their order"""
+        names = ['Scrubs.S01E01.720p.HDTV.x264-LOL.mkv', 'scrubs.s09e01.avi',
+                 'scrubs.1x01.dvdrip-topaz.avi', 'readme.txt'] * 500
+        requests = len(self.handler.requests)
+        best = self.t.select(names)
+        self.assertEquals(len(best), 2000)
+        self.assertEquals([r and r['release'] for r in best[:4]],
+                          ['Scrubs.S01E01.720p.HDTV.x264-LOL', None,
+                           'Scrubs.S01E01.DVDRip.XviD-TOPAZ', None])
+        self.assertEquals(best[4:8], best[:4])
+        self.assertEquals(self.handler.requests[requests:],
+                          ['http://www.tvsubtitles.net/episode-1001.html'])
+        self.assertEquals(self.t.select(['Scrubs.S01E01.mkv'], 'de')[0]['release'],
+                          'Scrubs.S01E01.GERMAN.1080p.WEB-DL.h264-RSG')
+        self.assertEquals(self.t.select(['Scrubs.S01E01.mkv'], 'it'), [None])
+
+    def test_pages(self):
+        """Checks only the season and episode pages of a file are loaded"""
+        t, handler = fixture_tvsubtitles()
+        best = t.select(['Scrubs.S03E04.mkv'])
+        self.assertEquals(best[0]['release'], 'Scrubs.S01E01.720p.HDTV.x264-LOL')
+        self.assertEquals(handler.requests[1:],
+                          ['http://www.tvsubtitles.net/tvshow-51-3.html',
+                           'http://www.tvsubtitles.net/episode-3004.html'])
+
+class test_offline_episode(unittest.TestCase):
+    def setUp(self):
+        self.t, self.handler = fixture_tvsubtitles()
+
+    def test_single_season(self):
+        """Checks episode() only fetches the page of its season"""
+        episode = self.t.episode('scrubs', 3, 4)
+        self.assertEquals(episode['episodename'], 'My First Step')
+        self.assertEquals(self.handler.requests[1:],
+                          ['http://www.tvsubtitles.net/tvshow-51-3.html'])
+        show = self.t.shows[51]
+        self.assertEquals(show[2][1]['seasonnumber'], 2)
+        self.assertEquals(len(self.handler.requests), 3)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_seasonnotfound, lambda: show[9])
+        self.assertEquals(len(self.handler.requests), 3)
+        # The rest of the show is loaded, seasons loaded already are kept
+        self.assertTrue(self.t['scrubs'][3][4] is episode)
+        self.assertEquals(self.handler.requests[3:],
+                          ['http://www.tvsubtitles.net/tvshow-51-1.html'])
+        self.assertEquals(sorted(self.t[51].keys()), [1, 2, 3])
+        self.assertEquals(len(self.t[51].search('my first')), 2)
+
+    def test_not_found(self):
+        """Checks missing seasons and episodes"""
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_episodenotfound,
+                          lambda: self.t.episode(51, 3, 99))
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_seasonnotfound,
+                          lambda: self.t.episode(51, 9, 1))
+        self.assertEquals(len(self.handler.requests), 1)
+
+    def test_loaded_show(self):
+        """Checks loaded shows are served from memory"""
+        show = self.t['scrubs']
+        requests = len(self.handler.requests)
+        self.assertTrue(self.t.episode('scrubs', 1, 1) is show[1][1])
+        self.assertEquals(len(self.handler.requests), requests)
+
+class test_offline_lazy(unittest.TestCase):
+    def setUp(self):
+        self.t, self.handler = fixture_tvsubtitles(lazy = True)
+
+    def test_lazy_seasons(self):
+        """Checks seasons are listed before they are loaded"""
+        show = self.t['scrubs']
+        self.assertEquals(self.handler.requests[1:],
+                          ['http://www.tvsubtitles.net/tvshow-51-1.html'])
+        self.assertEquals((len(show), show.keys(), list(show)), (3, [1, 2, 3], [1, 2, 3]))
+        self.assertTrue(3 in show)
+        self.assertFalse(9 in show)
+        self.assertRaises(tvsubtitles_api.tvsubtitles_exceptions.tvsubtitles_seasonnotfound,
+                          lambda: show[9])
+        self.assertEquals(show.get(9), None)
+        self.assertEquals(len(self.handler.requests), 2)
+        self.assertEquals(show[3][4]['episodename'], 'My First Step')
+        self.assertEquals(self.handler.requests[2:],
+                          ['http://www.tvsubtitles.net/tvshow-51-3.html'])
+        self.assertFalse(51 in self.t._complete)
+        # Loading every season
+        self.assertEquals([len(season) for season in show.values()], [8, 6, 5])
+        self.assertEquals(len(self.handler.requests), 4)
+        self.assertTrue(51 in self.t._complete)
+        eager, handler = fixture_tvsubtitles()
+        self.assertEquals(dump_show(show), dump_show(eager['scrubs']))
+
+    def test_streaming_search(self):
+        """Checks iter_search yields the matches of a season as soon as
+        its page is parsed"""
+        show = self.t['scrubs']
+        results = show.iter_search('my')
+        self.assertEquals(results.next()['episodename'], 'My First Day')
+        self.assertEquals(len(self.handler.requests), 2)
+        rest = list(results)
+        self.assertEquals(len(self.handler.requests), 4)
+        self.assertEquals(len(rest), 18)
+        self.assertTrue(51 in self.t._complete)
+        self.assertEquals(show.search('my'), [show[1][1]] + rest)
+
+    def test_lazy_search(self):
+        """Checks a show search loads the missing seasons"""
+        show = self.t['scrubs']
+        self.assertEquals(len(self.handler.requests), 2)
+        self.assertEquals([ep['seasonnumber'] for ep in show.search('my first')], [1, 3])
+        self.assertEquals(len(self.handler.requests), 4)
+        eager, handler = fixture_tvsubtitles()
+        self.assertEquals([repr(ep) for ep in show.search('my first')],
+                          [repr(ep) for ep in eager['scrubs'].search('my first')])
+
+    def test_search_partial_show(self):
+        """Checks TvSubtitles.search does not load seasons"""
+        t, handler = fixture_tvsubtitles()
+        t.episode('scrubs', 1, 1)
+        requests = len(handler.requests)
+        self.assertEquals(t.search('first', key = 'episodename'), [t.shows[51][1][1]])
+        self.assertEquals(len(handler.requests), requests)
+
+    def test_lazy_refresh(self):
+        """Checks refresh only checks the loaded seasons"""
+        self.t['scrubs'][3]
+        self.assertEquals(self.t.refresh('scrubs', all_seasons = True), [])
+        self.assertEquals(self.handler.requests[3:],
+                          ['http://www.tvsubtitles.net/tvshow-51-1.html',
+                           'http://www.tvsubtitles.net/tvshow-51-3.html'])
+        self.assertEquals(sorted(dict.keys(self.t.shows[51])), [1, 3])
+
+class test_offline_backends(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.redis = RedisStub()
+
+    def tearDown(self):
+        self.redis.stop()
+        shutil.rmtree(self.location)
+
+    def check_backend(self, backend):
+        value = {'seasons': {1: [{'num': 1, 'name': u'My First Day'}]}}
+        self.assertEquals(backend.get('a'), None)
+        backend.set('a', value)
+        self.assertEquals(backend.get('a'), value)
+        self.assertFalse(backend.get('a') is backend.get('a'))
+        backend.set(u'sid:caf\xe9', 51, ttl = 60)
+        self.assertEquals(backend.get(u'sid:caf\xe9'), 51)
+        backend.delete('a')
+        backend.delete('a')
+        self.assertEquals(backend.get('a'), None)
+
+    def test_json_values(self):
+        """Checks values are stored as JSON and pickles are not loaded"""
+        backend = tvsubtitles_api.backends.MemoryBackend()
+        backend.set('a', {'seasons': {1: []}})
+        json.loads(backend._get(backend._key('a')))
+        backend._set(backend._key('a'), "cos\nsystem\n(S'true'\ntR.", None)
+        self.assertEquals(backend.get('a'), None)
+        self.assertEquals(backend._get(backend._key('a')), None)
+
+    def test_memory(self):
+        """Checks the in-process backend evicts old and expired values"""
+        clock = FakeClock()
+        backend = tvsubtitles_api.backends.MemoryBackend(max_entries = 2, clock = clock)
+        self.check_backend(backend)
+        backend.set('b', 2, ttl = 10)
+        backend.get(u'sid:caf\xe9')
+        backend.set('c', 3)
+        self.assertEquals((backend.get('b'), backend.get(u'sid:caf\xe9')), (None, 51))
+        clock.now += 61
+        self.assertEquals(backend.get(u'sid:caf\xe9'), None)
+        self.assertEquals(len(backend), 1)
+
+    def test_sqlite(self):
+        """Checks the SQLite backend is shared by processes"""
+        path = os.path.join(self.location, 'cache.db')
+        backend = tvsubtitles_api.backends.from_url('sqlite:///' + path)
+        self.check_backend(backend)
+        script = ('import sys; sys.path.insert(0, %r); import tvsubtitles_api.backends\n'
+                  'tvsubtitles_api.backends.SQLiteBackend(%r).set("shared", [1, 2])' % (
+                  os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path))
+        subprocess.check_call([sys.executable, '-W', 'ignore', '-c', script])
+        self.assertEquals(backend.get('shared'), [1, 2])
+        backend.set('old', 1, ttl = -1)
+        self.assertEquals(backend.get('old'), None)
+        backend.close()
+
+    def test_redis(self):
+        """Checks the Redis client against the local stand-in"""
+        backend = tvsubtitles_api.backends.from_url(self.redis.url(db = 2))
+        self.check_backend(backend)
+        self.assertEquals(backend.command('PING'), 'PONG')
+        self.assertEquals(self.redis.commands[0], ['SELECT', '2'])
+        self.assertTrue(['SET', 'tvsubtitles:sid:caf\xc3\xa9',
+                         self.redis.data[(2, 'tvsubtitles:sid:caf\xc3\xa9')][0], 'EX', '60']
+                        in self.redis.commands)
+        # One connection is reused, also after an error answer
+        self.assertRaises(tvsubtitles_api.backends.BackendError,
+                          lambda: backend.command('NOPE'))
+        self.assertEquals(backend.command('PING'), 'PONG')
+        self.assertEquals(len(backend._idle), 1)
+        backend.close()
+
+        redis = RedisStub(password = 'secret')
+        try:
+            backend = tvsubtitles_api.backends.RedisBackend(port = redis.port)
+            self.assertRaises(tvsubtitles_api.backends.BackendError, lambda: backend.get('a'))
+            backend = tvsubtitles_api.backends.RedisBackend(port = redis.port,
+                                                            password = 'secret')
+            self.check_backend(backend)
+            backend.close()
+        finally:
+            redis.stop()
+
+    def test_redis_failed_auth(self):
+        """Checks connections failing the AUTH handshake are closed"""
+        backends = tvsubtitles_api.backends
+        base = backends._RedisConnection
+        closed = []
+        class Connection(base):
+            def close(self):
+                closed.append(self)
+                base.close(self)
+        redis = RedisStub(password = 'secret')
+        backends._RedisConnection = Connection
+        try:
+            backend = backends.RedisBackend(port = redis.port, password = 'wrong')
+            for i in range(3):
+                self.assertRaises(backends.BackendError, lambda: backend.get('a'))
+            self.assertEquals(backend._idle, [])
+            self.assertEquals(len(closed), 3)
+            self.assertEquals([args[0] for args in redis.commands], ['AUTH'] * 3)
+            deadline = time.time() + 2
+            while redis.connections and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEquals(redis.connections, 0)
+        finally:
+            backends._RedisConnection = base
+            redis.stop()
+
+    def test_shared_cache(self):
+        """Checks instances sharing a backend do not fetch pages again"""
+        t1, handler1 = fixture_tvsubtitles(backend = self.redis.url())
+        self.assertEquals(t1['scrubs'][1][1]['languages']['en'][0]['good'], 30)
+        t2, handler2 = fixture_tvsubtitles(backend = self.redis.url())
+        self.assertEquals(dump_show(t2['scrubs']), dump_show(t1['scrubs']))
+        self.assertEquals(t2['scrubs'][1][1]['languages']['en'][0]['good'], 30)
+        self.assertEquals(handler2.requests, [])
+        self.assertEquals(t2.metrics.counter('tvsubtitles_cache_total',
+                                             tier = 'backend', result = 'hit'), 4)
+
+    def test_unreachable(self):
+        """Checks lookups still work when the backend is down"""
+        url = self.redis.url()
+        self.redis.stop()
+        t, handler = fixture_tvsubtitles(backend = url)
+        self.assertEquals(t['scrubs'][3][4]['episodename'], 'My First Step')
+        self.assertTrue(t.metrics.counter('tvsubtitles_backend_errors_total') > 0)
+        self.assertRaises(ValueError, lambda: fixture_tvsubtitles(backend = 'ftp://x'))
+        self.assertRaises(ValueError, lambda: fixture_tvsubtitles(backend = object()))
+
+class test_offline_imports(unittest.TestCase):
+    """Parsing and network modules are only imported when needed"""
+    heavy = ('lxml', 'BeautifulSoup', 'urllib2', 'httplib', 'numpy')
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def imported(self, code):
+        """Runs code in a new interpreter, returns the heavy modules it
+        imported"""
+        script = ('import sys; sys.path.insert(0, %r); import tvsubtitles_api\n%s\n'
+                  'print " ".join(m for m in %r if m in sys.modules)' % (
+                  os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                  code, self.heavy))
+        process = subprocess.Popen([sys.executable, '-W', 'ignore', '-c', script],
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEquals(process.returncode, 0, err)
+        return out.split()
+
+    def test_import(self):
+        """Checks importing the package does not load lxml or urllib2"""
+        self.assertEquals(self.imported('t = tvsubtitles_api.TvSubtitles()'), [])
+
+    def test_cached_show(self):
+        """Checks a show served from the parsed cache does not load lxml"""
+        t, handler = fixture_tvsubtitles(cache = self.location)
+        t[51]
+        self.assertEquals(self.imported(
+            't = tvsubtitles_api.TvSubtitles(cache = %r)\n'
+            'assert t[51][1][1]["episodename"] == "My First Day"' % self.location), [])
+
+    def test_first_request(self):
+        """Checks the default opener is built on the first request"""
+        t = tvsubtitles_api.TvSubtitles()
+        self.assertEquals(t.urlopener, None)
+        self.assertTrue(t._getOpener() is t._getOpener())
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity = 2)
+    unittest.main(testRunner = runner)
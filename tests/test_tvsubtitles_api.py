@@ -18,7 +18,7 @@ import unittest
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import tvsubtitles_api
-from tvsubtitles_exceptions import (tvsubtitles_shownotfound, tvsubtitles_seasonnotfound,
+from tvsubtitles_api.tvsubtitles_exceptions import (tvsubtitles_shownotfound, tvsubtitles_seasonnotfound,
 tvsubtitles_episodenotfound, tvsubtitles_attributenotfound)
 
 class test_tvsubtitles_basic(unittest.TestCase):
@@ -19,9 +19,10 @@
 #       MA 02110-1301, USA.
 
 from tvsubtitles_api.api import TvSubtitles
+from tvsubtitles_api.async_client import AsyncTvSubtitles
 
 __version__ = '1a'
 __maintainer__ = 'Nicolas Duhamel'
 __license__ = 'GPLv2'
 
-__all__ = ['TvSubtitles']
+__all__ = ['TvSubtitles', 'AsyncTvSubtitles']
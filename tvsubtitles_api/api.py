@@ -17,19 +17,33 @@
 #       along with this program; if not, write to the Free Software
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
-import urllib2
-import urllib
 import logging
-import datetime
 import os
+import re
+import sys
+import time
+import zlib
+import hashlib
+import threading
+import urlparse
+import Queue
 
-import lxml.html
-from BeautifulSoup import UnicodeDammit
+# lxml, BeautifulSoup and urllib2 are imported on the first parse or
+# request, processes serving from a cache or a snapshot never load them
 
 from tvsubtitles_exceptions import (tvsubtitles_error, tvsubtitles_shownotfound,
     tvsubtitles_seasonnotfound, tvsubtitles_episodenotfound, tvsubtitles_languagenotfound,
      tvsubtitles_attributenotfound)
-from parsers import (TvShowSearchParser, TvSowParser, EpisodeParser)
+from parsers import (TvShowSearchParser, TvSowParser, EpisodeParser,
+                     content_document)
+from cache import DiskCache, user_directory
+from index import SearchIndex, matches
+from metrics import Metrics
+from scheduler import RequestScheduler, RetryableError, HostError, parse_retry_after
+from singleflight import SingleFlight
+from catalog import ShowCatalog
+from ranking import dice_scores
+import serialize
 
 
 __license__ = 'GPLv2'
@@ -37,7 +51,8 @@ __version__ = '0.1a'
 __maintainer__ = 'Nicolas Duhamel'
 
 
-lastTimeout = None
+# HTTP answers worth retrying after a while
+RETRY_CODES = (429, 500, 502, 503, 504)
 
 def log():
     return logging.getLogger("tvsubtitles_api")
@@ -65,6 +80,7 @@ def dice_coefficient(a, b):
 
 def decode_html(html_string):
     """ Used for correctly decode html"""
+    from BeautifulSoup import UnicodeDammit
     converted = UnicodeDammit(html_string, isHTML=True)
     if not converted.unicode:
         raise UnicodeDecodeError(
@@ -72,6 +88,114 @@ def decode_html(html_string):
             ', '.join(converted.triedEncodings))
     return converted.unicode
 
+def discard_response(resp, limit = 64 * 1024):
+    """Reads the rest of the body of resp, up to limit bytes, and closes
+    it. The connection of a keep-alive response goes back to its pool if
+    the body was entirely read, it is closed otherwise.
+    """
+    if getattr(resp, 'fp', None) is None:
+        return
+    try:
+        try:
+            resp.read(limit)
+        finally:
+            resp.close()
+    except Exception, e:
+        log().debug("Could not discard the response body: %s", e)
+
+_charset_header = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+_charset_meta = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+def html_charset(html_string, content_type = None):
+    """Returns the charset given by the Content-Type header, or by the
+    meta tags of the page, or None
+    """
+    if content_type:
+        match = _charset_header.search(content_type)
+        if match:
+            return match.group(1).lower()
+    match = _charset_meta.search(html_string[:4096])
+    if match:
+        return match.group(1).lower()
+
+def fast_html(html_string, content_type = None):
+    """Parses the content box of html with its declared charset, without
+    UnicodeDammit detection and without building the rest of the page.
+    Returns None if the charset is unknown or the content box was not
+    found, decode_html must then be used.
+    """
+    charset = html_charset(html_string, content_type)
+    if charset is None:
+        return None
+    from lxml import etree
+    try:
+        return content_document(html_string, charset)
+    except (LookupError, ValueError, etree.LxmlError):
+        return None
+
+def is_opener(value):
+    """True if value is an urllib2 opener. urllib2 does not need to be
+    imported for this: an opener cannot exist before it is.
+    """
+    urllib2 = sys.modules.get('urllib2')
+    return urllib2 is not None and isinstance(value, urllib2.OpenerDirector)
+
+def threaded_imap(func, items, max_workers = 1):
+    """Apply func to every item using at most max_workers threads.
+    Results are yielded in the order of items, as soon as they are
+    available. An exception raised by func is re-raised in the caller.
+    """
+    items = list(items)
+    if max_workers is None or max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    jobs, Empty = Queue.Queue(), Queue.Empty
+    for job in enumerate(items):
+        jobs.put(job)
+    results = {}
+    done = threading.Condition()
+    stop = []
+
+    def worker():
+        while not stop:
+            try:
+                idx, item = jobs.get_nowait()
+            except Empty:
+                return
+            try:
+                res = (True, func(item))
+            except Exception:
+                res = (False, sys.exc_info())
+            done.acquire()
+            try:
+                results[idx] = res
+                done.notify_all()
+            finally:
+                done.release()
+
+    for i in range(min(max_workers, len(items))):
+        thread = threading.Thread(target = worker)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for idx in range(len(items)):
+            done.acquire()
+            try:
+                while idx not in results:
+                    done.wait()
+                ok, value = results.pop(idx)
+            finally:
+                done.release()
+            if not ok:
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        # Consumer stopped early or failed, let the workers drain
+        stop.append(True)
+
     
 class BaseUI:
     """Default non-interactive UI, which auto-selects first results
@@ -89,10 +213,19 @@ class ShowContainer(dict):
 
 class Show(dict):
     """Holds a dict of seasons, and show data.
+
+    Once the season numbers of the show are known, the seasons which are
+    not loaded yet are still listed by keys(), len() and iteration, and
+    loaded when accessed.
     """
     def __init__(self):
         dict.__init__(self)
         self.data = {}
+        self._index = None # SearchIndex of the episodes, built by the first search
+        self._index_lock = threading.Lock()
+        self._seasons = None # Every season number, once a season page is parsed
+        self._loader = None # Called with a list of season numbers to load
+        self._stream = None # Iterates the episodes, loading the missing seasons
 
     def __repr__(self):
         return "<Show %s (containing %s seasons)>" % (
@@ -101,7 +234,7 @@ class Show(dict):
         )
 
     def __getitem__(self, key):
-        if key in self:
+        if dict.__contains__(self, key):
             # Key is an episode, return it
             return dict.__getitem__(self, key)
 
@@ -109,6 +242,13 @@ class Show(dict):
             # Non-numeric request is for show-data
             return dict.__getitem__(self.data, key)
 
+        if (isinstance(key, (int, long)) and self._loader is not None
+                and (self._seasons is None or key in self._seasons)):
+            # Season not loaded yet
+            self._loader([key])
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+
         # Data wasn't found, raise appropriate error
         if isinstance(key, int) or key.isdigit():
             # Episode number x was not found
@@ -118,6 +258,56 @@ class Show(dict):
             # doesn't exist, so attribute error.
             raise tvsubtitles_attributenotfound("Cannot find attribute %s" % (repr(key)))
 
+    def _loadMissing(self):
+        """Loads the known seasons which are not loaded yet
+        """
+        if self._seasons is None or self._loader is None:
+            return
+        missing = [season for season in self._seasons
+                   if not dict.__contains__(self, season)]
+        if missing:
+            self._loader(missing)
+
+    def keys(self):
+        if self._seasons is None:
+            return dict.keys(self)
+        return sorted(set(self._seasons).union(dict.keys(self)))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (
+            self._seasons is not None and key in self._seasons)
+
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        self._loadMissing()
+        return [dict.__getitem__(self, season) for season in self.keys()
+                if dict.__contains__(self, season)]
+
+    def items(self):
+        self._loadMissing()
+        return [(season, dict.__getitem__(self, season)) for season in self.keys()
+                if dict.__contains__(self, season)]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
     def search(self, term = None, key = None):
         """
         Search all episodes in show. Can search all data, or a specific key (for
@@ -169,12 +359,71 @@ class Show(dict):
         My First Kill
         >>>
         """
-        results = []
-        for cur_season in self.values():
-            searchresult = cur_season.search(term = term, key = key)
-            if len(searchresult) != 0:
-                results.extend(searchresult)
-        return results
+        return list(self.iter_search(term = term, key = key))
+
+    def iter_search(self, term = None, key = None):
+        """Same as search, but yields matching Episode instances one by one.
+        When seasons are not loaded yet, the matches of a season are
+        yielded as soon as its page is parsed.
+        """
+        if term == None:
+            raise TypeError("must supply string to search for (contents)")
+        if self._stream is not None and self._seasons is not None and any(
+                not dict.__contains__(self, season) for season in self._seasons):
+            for episode in self._stream():
+                if matches(episode, term, key = key):
+                    yield episode
+            return
+        for episode in self._searchIndex().search(term, key = key):
+            yield episode
+
+    def _searchIndex(self):
+        """Returns the SearchIndex of the loaded episodes, it is built the
+        first time the show is searched and kept up to date afterwards
+        """
+        self._index_lock.acquire()
+        try:
+            if self._index is None:
+                index = SearchIndex()
+                for season in dict.values(self):
+                    for episode in list(dict.values(season)):
+                        for attrib, value in episode.items():
+                            index.add(episode, attrib, value)
+                self._index = index
+            return self._index
+        finally:
+            self._index_lock.release()
+
+    def _indexField(self, episode, attrib, value):
+        """Indexes a field of episode, if the index is built
+        """
+        self._index_lock.acquire()
+        try:
+            if self._index is not None:
+                self._index.add(episode, attrib, value)
+        finally:
+            self._index_lock.release()
+
+    def _unindex(self, episode):
+        """Removes episode from the index, if it is built
+        """
+        self._index_lock.acquire()
+        try:
+            if self._index is not None:
+                for attrib in episode.keys():
+                    self._index.remove(episode, attrib)
+        finally:
+            self._index_lock.release()
+
+    def search_tokens(self, term, key = None):
+        """Returns the episodes having every word of term as a whole word,
+        in any field or in the key field
+
+        >>> t['scrubs'].search_tokens('first day', key = 'episodename')
+        [<Episode 01x01 - My First Day>]
+        """
+        self._loadMissing()
+        return self._searchIndex().search_tokens(term, key = key)
 
 class Season(dict):
     def __init__(self, show = None):
@@ -204,14 +453,22 @@ class Season(dict):
 
         See Show.search documentation for further information on search
         """
-        results = []
+        return list(self.iter_search(term = term, key = key))
+
+    def iter_search(self, term = None, key = None):
+        """Same as search, but yields matching Episode instances one by one
+        """
+        if term == None:
+            raise TypeError("must supply string to search for (contents)")
+        if self.show is not None:
+            for ep in self.show._searchIndex().search(term, key = key):
+                if ep.season is self:
+                    yield ep
+            return
         for ep in self.values():
             searchresult = ep.search(term = term, key = key)
             if searchresult is not None:
-                results.append(
-                    searchresult
-                )
-        return results
+                yield searchresult
 
 class Episode(dict):
     def __init__(self, season = None):
@@ -261,65 +518,334 @@ class Episode(dict):
 
         term = unicode(term).lower()
         for cur_key, cur_value in self.items():
-            cur_key, cur_value = unicode(cur_key).lower(), unicode(cur_value).lower()
+            cur_key = unicode(cur_key).lower()
             if key is not None and cur_key != key:
                 # Do not search this key
                 continue
-            if cur_value.find( unicode(term).lower() ) > -1:
+            if unicode(cur_value).lower().find(term) > -1:
                 return self
 
-class LanguageGetter:
-    def __init__(self, tvsubtitles, eid):
+_missing = object()
+
+class CompactEpisode(object):
+    """Episode storing its fields in __slots__ instead of a dict, used
+    when TvSubtitles is created with compact = True. It behaves like
+    Episode for reading: ep['episodename'], keys(), items(), search()...
+    Unknown keys are kept in a dict created on first use.
+    """
+    fields = ('seasonnumber', 'episodenumber', 'id', 'episodename',
+              'available_languages', 'languages')
+    __slots__ = ('season', '_extra') + tuple('_' + field for field in fields)
+
+    def __init__(self, season = None):
+        self.season = season
+        self._extra = None
+
+    __repr__ = Episode.__dict__['__repr__']
+    search = Episode.__dict__['search']
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, '_' + key, _missing)
+        elif self._extra is not None:
+            value = self._extra.get(key, _missing)
+        else:
+            value = _missing
+        if value is _missing:
+            raise tvsubtitles_attributenotfound("Cannot find attribute %s" % (repr(key)))
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, '_' + key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.fields:
+            delattr(self, '_' + key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except tvsubtitles_attributenotfound:
+            return False
+        return True
+
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except tvsubtitles_attributenotfound:
+            return default
+
+    def keys(self):
+        keys = [field for field in self.fields
+                if getattr(self, '_' + field, _missing) is not _missing]
+        if self._extra is not None:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, CompactEpisode)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+class LanguageGetter(object):
+    __slots__ = ('_tvsubtitles', 'config', '_eid', '_data')
+
+    def __init__(self, tvsubtitles, eid, data = None):
         self._tvsubtitles = tvsubtitles
         self.config = tvsubtitles.config 
         self._eid =eid
-        self._data = False
+        self._data = data or False
         
     def __getitem__(self, key):
         if not self._data:
-            log().debug('Getting all series language for %s' % (self._eid))
+            log().debug('Getting all series language for %s', self._eid)
             self._load()
         return self._data[key]
     
     def _load(self):
-        log().debug('Loading language for episode %s' % (self._eid ) )
-        html = self._tvsubtitles._getetsrc(
-            self.config['url_episode'] % (self._eid)
-        )
-        parser = EpisodeParser(html)
-        self._data = parser.parse()
+        log().debug('Loading language for episode %s', self._eid)
+        self._data = self._tvsubtitles._getLanguages(self._eid)
+
+    def loaded(self):
+        """Returns the subtitles by language if they were loaded already,
+        or None
+        """
+        return self._data or None
+
+    def load(self):
+        """Returns the subtitles by language, loading them if needed
+        """
+        if not self._data:
+            self._load()
+        return self._data
         
     
 
 class TvSubtitles:
         
-    def __init__(self, language = None, custom_ui= None, urlopener = None):
+    def __init__(self, language = None, custom_ui= None, urlopener = None,
+                 max_workers = 1, cache = False, cache_ttl = None,
+                 cache_max_size = 100 * 1024 * 1024, cache_parsed = True,
+                 connections_per_host = 4, fast_parse = False, compact = False,
+                 metrics = None, rate_limit = 5.0, retries = 3, scheduler = None,
+                 catalog = None, lazy = False, backend = None):
         """
         language (2 character language abbreviation):
             The language of the returned data. Is also the language search
             uses. Default is "en" (English).
+
+        max_workers (int):
+            Number of threads used to fetch the season pages of a show.
+            Default is 1 (serial loading).
+
+        cache (True/False/str/DiskCache/urllib2.OpenerDirector):
+            Retrieved pages are cached on disk. If False, the cache is
+            disabled. If True, pages are cached in a tvsubtitles_api-<uid>
+            folder of the system temp directory, only accessible to the
+            current user. A string is used as the cache
+            location. For compatibility, an urllib2 opener is used as
+            urlopener.
+
+        cache_ttl (dict):
+            Lifetime in seconds of cached pages, by page type: 'search',
+            'season', 'episode' and 'other'. Expired pages are revalidated
+            with their ETag/Last-Modified validators.
+
+        cache_max_size (int):
+            Size in bytes of the on disk cache, least recently used pages
+            are evicted first.
+
+        cache_parsed (True/False):
+            When the cache is enabled, also cache the parsed content of
+            pages. Default is True.
+
+        connections_per_host (int):
+            Number of idle keep-alive connections kept open to each host
+            by the default urlopener. Default is 4.
+
+        fast_parse (True/False):
+            Parse pages with the charset declared in the HTTP headers or
+            meta tags instead of guessing it with UnicodeDammit, and stop
+            at the end of the part of the page the parsers read. Pages
+            which cannot be parsed this way use the default path.
+
+        compact (True/False):
+            Store episodes as CompactEpisode instances (fields held in
+            __slots__) instead of dicts, to save memory when many shows
+            are loaded. Default is False.
+
+        metrics (Metrics):
+            Registry receiving request, decode, parse and cache metrics.
+            A new one is created by default, see the metrics attribute.
+
+        rate_limit (float):
+            Maximum number of requests per second sent to a host, bursts
+            of twice as many requests are allowed. None disables it.
+            Default is 5.
+
+        retries (int):
+            Number of times a request failing with a connection error or
+            a 429/5xx answer is retried, with a jittered exponential
+            backoff or after the Retry-After delay sent by the server.
+            Default is 3.
+
+        scheduler (RequestScheduler):
+            Scheduler used in place of the one built from rate_limit and
+            retries, it also stops sending requests to a host after
+            repeated failures.
+
+        catalog (True/False/str/ShowCatalog):
+            Resolve show names with a local catalog of shows, filled with
+            the search results of tvsubtitles.net. Names it does not know
+            are still searched on the site. If True, the catalog is saved
+            in the same private folder as the cache, a string is used as
+            its path.
+            Changes are saved every minute, by close and at exit.
+            Disabled by default.
+
+        lazy (True/False):
+            Only load the first season page of a show when it is looked
+            up, the other seasons are loaded the first time they are
+            accessed. Default is False (every season is loaded).
+
+        backend (str/CacheBackend):
+            Cache shared with other instances and processes, holding show
+            name corrections and parsed season and episode pages, see the
+            backends module. A string is a backend URL: memory://,
+            sqlite:///path or redis://host:port/db. Disabled by default.
         """
         self.shows = ShowContainer() # Holds all Show classes
         self.corrections = {} # Holds show-name to show_id mapping
+        self._complete = set() # Ids of shows with every season loaded
+        self._flight = SingleFlight() # Shares concurrent identical loads
+        self._lock = threading.RLock() # Guards self.shows updates
         self.config = {}
         if language is None:
             self.config['language'] = None
         else:
             self.config['language'] = language
         
+        if is_opener(cache) and urlopener is None:
+            urlopener, cache = cache, False
+
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+        if scheduler is None:
+            burst = None
+            if rate_limit:
+                burst = max(1, int(rate_limit * 2))
+            scheduler = RequestScheduler(rate = rate_limit, burst = burst,
+                                         retries = retries)
+        self.scheduler = scheduler
+
+        self.config['connections_per_host'] = connections_per_host
         if urlopener is None:
-            self.config['cache_enabled'] = False
-            self.urlopener = urllib2.build_opener() # default opener with no caching
-        elif isinstance(urlopener, urllib2.OpenerDirector):
+            # default opener, built by _getOpener on the first request
+            self.urlopener = None
+        elif is_opener(urlopener):
             # If passed something from urllib2.build_opener, use that
-            log().debug("Using %r as urlopener" % cache)
-            self.config['cache_enabled'] = True
-            self.urlopener = cache
+            log().debug("Using %r as urlopener", urlopener)
+            self.urlopener = urlopener
         else:
-            raise ValueError("Invalid value for URLopener %r (type was %s)" % (cache, type(cache)))
-        
+            raise ValueError("Invalid value for URLopener %r (type was %s)" % (urlopener, type(urlopener)))
+
+        if cache is True:
+            self.cache = DiskCache(os.path.join(user_directory(), "cache"),
+                                   max_size = cache_max_size)
+        elif cache is False or cache is None:
+            self.cache = None
+        elif isinstance(cache, basestring):
+            self.cache = DiskCache(cache, max_size = cache_max_size)
+        elif isinstance(cache, DiskCache):
+            self.cache = cache
+        else:
+            raise ValueError("Invalid value for Cache %r (type was %s)" % (cache, type(cache)))
+        self.config['cache_enabled'] = self.cache is not None
+        if self.cache is not None:
+            self.config['cache_location'] = self.cache.location
+
+        if catalog is True:
+            self.catalog = ShowCatalog(
+                os.path.join(user_directory(), "catalog.json"))
+        elif catalog is False or catalog is None:
+            self.catalog = None
+        elif isinstance(catalog, basestring):
+            self.catalog = ShowCatalog(catalog)
+        elif isinstance(catalog, ShowCatalog):
+            self.catalog = catalog
+        else:
+            raise ValueError("Invalid value for Catalog %r (type was %s)" % (catalog, type(catalog)))
+
+        if backend is None:
+            self.backend = None
+        else:
+            import backends
+            if isinstance(backend, basestring):
+                backend = backends.from_url(backend)
+            elif not isinstance(backend, backends.CacheBackend):
+                raise ValueError("Invalid value for Backend %r (type was %s)" % (backend, type(backend)))
+            self.backend = backend
+
+        self.config['cache_ttl'] = {
+            'search': 24 * 3600,
+            'season': 6 * 3600,
+            'episode': 6 * 3600,
+            'other': 24 * 3600,
+        }
+        if cache_ttl is not None:
+            self.config['cache_ttl'].update(cache_ttl)
+        self.config['cache_parsed'] = cache_parsed
         
+        self.config['fast_parse'] = fast_parse
+        self.config['compact'] = compact
+        self.config['lazy'] = lazy
+        if compact:
+            self._episode_class = CompactEpisode
+        else:
+            self._episode_class = Episode
         self.config['custom_ui'] =  custom_ui
+        self.config['max_workers'] = max_workers
         
         self.config['url_searchSeries'] = "http://www.tvsubtitles.net/search.php"
         self.config['url_serie_season'] = 'http://www.tvsubtitles.net/tvshow-%s-%s.html'
@@ -331,121 +857,720 @@ class TvSubtitles:
         """
         if isinstance(key, (int, long)):
             # Item is integer, treat as show id
-            if key not in self.shows:
-                self._getShowData(key, self.config['language'])
+            if key not in self._complete:
+                self._openShow(key)
             return self.shows[key]
         
         key = key.lower() # make key lower case
         sid = self._nameToSid(key)
-        log().debug('Got series id %s' % (sid))
+        log().debug('Got series id %s', sid)
         return self.shows[sid]
+
+    def iter_episodes(self, key):
+        """Yields every Episode of a show (name or id), season by season.
+        Episodes of a season are available as soon as its page is parsed,
+        without waiting for the whole show to load.
+
+        >>> t = TvSubtitles()
+        >>> for episode in t.iter_episodes('scrubs'):
+        ...     print episode
+        <Episode 01x01 - My First Day>
+        <Episode 01x02 - My Mentor>
+        ...
+        """
+        if not isinstance(key, (int, long)):
+            key = self._nameToSid(key.lower(), load = False)
+        if key in self._complete:
+            show = self.shows[key]
+            for season in sorted(show.keys()):
+                for number in sorted(show[season].keys()):
+                    yield show[season][number]
+            return
+        for episode in self._iterShowData(key):
+            yield episode
         
-    def _nameToSid(self, name):
+    def search(self, term = None, key = None):
+        """Searches the episodes of every loaded show, see Show.search.
+        Shows are not loaded by this call, and the shows of a snapshot
+        which were not accessed yet are not built.
+
+        >>> t['scrubs'], t['lost']
+        >>> t.search('pilot', key = 'episodename')
+        [<Episode 01x01 - Pilot (1)>, <Episode 01x02 - Pilot (2)>]
+        """
+        results = []
+        for sid in sorted(dict.keys(self.shows)):
+            # Only the loaded seasons, Show.search would load the others
+            show = dict.__getitem__(self.shows, sid)
+            results.extend(show._searchIndex().search(term, key = key))
+        return results
+
+    def episode(self, key, season, episode):
+        """Returns an Episode of a show (name or id), loading only the page
+        of its season. The other seasons of the show are loaded when they
+        are accessed.
+
+        >>> t = TvSubtitles()
+        >>> t.episode('scrubs', 3, 4)['languages']['en']
+        """
+        if not isinstance(key, (int, long)):
+            key = self._nameToSid(key.lower(), load = False)
+        self._loadSeason(key, season)
+        return self.shows[key][season][episode]
+
+    def prefetch_languages(self, sid, seasons = None, languages = None,
+                           max_workers = None):
+        """Loads the subtitles languages of all episodes of a show at once,
+        instead of one page per episode on first access.
+
+        sid is a show id or name. seasons limits the prefetch to a list of
+        season numbers, languages to episodes having subtitles in one of
+        the listed languages. Episode pages are fetched with max_workers
+        threads (default is the max_workers option of TvSubtitles).
+        Returns the number of loaded episodes.
+
+        >>> t = TvSubtitles(max_workers = 8)
+        >>> t.prefetch_languages('scrubs', seasons = [1], languages = ['fr'])
+        24
+        """
+        show = self[sid]
+        if seasons is None:
+            seasons = show.keys()
+        if languages is not None:
+            languages = set(languages)
+        if max_workers is None:
+            max_workers = self.config['max_workers']
+
+        getters = []
+        for season in seasons:
+            for episode in show[season].values():
+                if languages is not None and not languages.intersection(
+                        episode['available_languages']):
+                    continue
+                getter = episode['languages']
+                if getter.loaded() is None:
+                    getters.append(getter)
+
+        log().debug('Prefetching languages of %s episodes', len(getters))
+        for loaded in threaded_imap(lambda getter: getter._load(), getters,
+                                    max_workers):
+            pass
+        return len(getters)
+
+    def refresh(self, key, all_seasons = False):
+        """Updates a loaded show (name or id) with the latest data of
+        tvsubtitles.net, without reloading every season. The page of the
+        newest season is checked and new seasons are loaded. all_seasons
+        also checks the other season pages, which costs a 304 answer per
+        unchanged page when the cache is enabled.
+
+        Episodes are updated in place, the languages of episodes whose
+        available_languages changed are loaded again on next access.
+        Returns a list of (change, episode) tuples, change being 'added',
+        'updated' or 'removed'. A show which is not loaded yet is loaded
+        and [] is returned. Only the loaded seasons of a partially loaded
+        show are refreshed.
+
+        >>> t.refresh('scrubs')
+        [('updated', <Episode 09x12 - Our Driving Issues>), ('added', <Episode 09x13 - Our Thanks>)]
+        """
+        if not isinstance(key, (int, long)):
+            key = self._nameToSid(key.lower(), load = False)
+        show = self.shows.get(key)
+        if key not in self._complete and (show is None or show._seasons is None):
+            self._openShow(key)
+            return []
+        return self._flight.do(('refresh', key),
+                               lambda: self._refreshShow(key, all_seasons))
+
+    def download(self, releases, location, max_workers = 4, max_per_host = 2):
+        """Downloads the subtitles of releases (dicts of
+        episode['languages'][lang]) to location, see
+        download.SubtitleDownloader.download_all
+        """
+        import download
+        downloader = download.SubtitleDownloader(self, location,
+            max_workers = max_workers, max_per_host = max_per_host)
+        return downloader.download_all(releases)
+
+    def select(self, filenames, language = 'en', max_workers = 4, weights = None):
+        """Returns the best release in language for each video file name,
+        or None, see selection.select
+
+        >>> t.select(['Scrubs.S01E01.720p.HDTV.x264-LOL.mkv'])[0]['release']
+        'Scrubs.S01E01.720p.HDTV.x264-LOL'
+        """
+        import selection
+        return selection.select(self, filenames, language, max_workers, weights)
+
+    def dump_snapshot(self, path):
+        """Saves the loaded shows, and the loaded subtitles of their
+        episodes, in a binary snapshot file
+        """
+        import snapshot
+        snapshot.dump(self, path)
+
+    def load_snapshot(self, path):
+        """Serves the shows of a snapshot file made by dump_snapshot. The
+        file is memory-mapped and a show is only built when accessed.
+        Shows of a previously loaded snapshot are dropped, unless they
+        were accessed already.
+        """
+        import snapshot
+        return snapshot.load(self, path)
+
+    def close(self):
+        """Saves the pending changes of the catalog
+        """
+        if self.catalog is not None:
+            self.catalog.flush(force = True)
+
+    def _nameToSid(self, name, load = True):
         """Takes show name, returns the correct series ID (if the show has
         already been grabbed), or grabs all episodes and returns
-        the correct SID.
+        the correct SID. The episodes are not grabbed if load is False.
         """
         if name in self.corrections:
-            log().debug('Correcting %s to %s' % (name, self.corrections[name]) )
+            log().debug('Correcting %s to %s', name, self.corrections[name])
             sid = self.corrections[name]
         else:
-            log().debug('Getting show %s' % (name))
-            selected_series = self._getSeries( name )
-            sname, sid = selected_series['name'], selected_series['id']
-            log().debug('Got %(name)s, id %(id)s' % selected_series)
+            sid = self._flight.do(('search', name), lambda: self._searchSid(name))
+        if load and sid not in self._complete:
+            self._openShow(sid)
+        return sid
+
+    def _searchSid(self, name):
+        """Searches show name and records its id in self.corrections
+        """
+        if name in self.corrections:
+            return self.corrections[name]
+        if self.catalog is not None:
+            sid = self.catalog.lookup(name)
+            if sid is not None:
+                log().debug('Found show %s in the catalog, id %s', name, sid)
+                self.corrections[name] = sid
+                return sid
+        if self.backend is not None:
+            sid = self._backend('get', 'sid:%s' % name)
+            if sid is not None:
+                log().debug('Found show %s in the backend, id %s', name, sid)
+                self.corrections[name] = sid
+                return sid
+        log().debug('Getting show %s', name)
+        selected_series = self._getSeries( name )
+        # Search results hold string ids, shows are keyed by int
+        sid = int(selected_series['id'])
+        log().debug('Got %(name)s, id %(id)s', selected_series)
 
-            self.corrections[name] = sid
-            self._getShowData(selected_series['id'])
+        self.corrections[name] = sid
+        if self.backend is not None:
+            self._backend('set', 'sid:%s' % name, sid, self.config['cache_ttl']['search'])
+        if self.catalog is not None:
+            self.catalog.alias(name, sid)
+            self.catalog.flush()
         return sid
+
+    def _openShow(self, sid):
+        """Loads show sid, only its first season page in lazy mode
+        """
+        if not self.config['lazy']:
+            self._loadShow(sid)
+            return
+        show = self.shows.get(sid)
+        if show is None or show._seasons is None:
+            self._loadSeason(sid, 1)
+
+    def _loadShow(self, sid):
+        """Loads show sid with _getShowData unless it is complete. Threads
+        loading the same show at the same time share a single load.
+        """
+        def load():
+            if sid not in self._complete:
+                self._getShowData(sid)
+        self._flight.do(('show', sid), load)
+
+    def _loadSeason(self, sid, season):
+        """Loads the page of a season of show sid, unless the show or the
+        season is loaded already. Threads loading the same season share a
+        single load.
+        """
+        def load():
+            show = self.shows.get(sid)
+            if sid in self._complete:
+                return
+            if show is not None and (dict.__contains__(show, season) or (
+                    show._seasons is not None and season not in show._seasons)):
+                return
+            log().debug('Getting season %s of %s', season, sid)
+            self._setPage(sid, self._parse(TvSowParser,
+                self.config['url_serie_season'] % (sid, season)))
+        self._flight.do(('season', sid, season), load)
+
+    def _loadSeasons(self, sid, seasons):
+        """Loads several seasons of show sid with max_workers threads
+        """
+        for loaded in threaded_imap(lambda season: self._loadSeason(sid, season),
+                                    seasons, self.config['max_workers']):
+            pass
+
+    def _getLanguages(self, eid):
+        """Returns the subtitles of episode eid, as parsed by
+        EpisodeParser. Concurrent calls for an episode share one request.
+        """
+        return self._flight.do(('episode', eid), lambda: self._parse(EpisodeParser,
+            self.config['url_episode'] % (eid)))
     
     def _getSeries(self, term):
         """This searches TVsubtitles.net for the series name,
         If a custom_ui UI is configured, it uses this to select the correct
         series. If not BaseUI is used to select the first result.
         """
-        log().debug("Searching for show %s" % term)
-        seriesHTML = self._getetsrc(self.config['url_searchSeries'] , urllib.urlencode({'q': term}))        
-        parser = TvShowSearchParser(seriesHTML)
-        allSeries = parser.parse()
+        import urllib
+        log().debug("Searching for show %s", term)
+        allSeries = self._parse(TvShowSearchParser,
+            self.config['url_searchSeries'], urllib.urlencode({'q': term}))
+        if self.catalog is not None:
+            self.catalog.add_results(allSeries)
         
         # Sort:
-        for serie in allSeries:
-            serie['dice_coef'] = dice_coefficient(term, serie['name'].lower())
+        scores = dice_scores(term, [serie['name'].lower() for serie in allSeries])
+        for serie, score in zip(allSeries, scores):
+            serie['dice_coef'] = score
         allSeries = sorted(allSeries, key=lambda serie: serie['dice_coef'], reverse=True)
 
         if len(allSeries) == 0:
             log().debug('Series result returned zero')
-            raise tvsubtitle_shownotfound("Show-name search returned zero results (cannot find show on TVsubtitles.net)")
+            raise tvsubtitles_shownotfound("Show-name search returned zero results (cannot find show on TVsubtitles.net)")
 
         if self.config['custom_ui'] is not None:
-            log().debug("Using custom UI %s" % (repr(self.config['custom_ui'])))
+            log().debug("Using custom UI %r", self.config['custom_ui'])
             ui = self.config['custom_ui'](config = self.config)
         else:
             log().debug('Auto-selecting first search result using BaseUI')
             ui = BaseUI(config = self.config)
         return ui.selectSeries(allSeries)
         
-    def _getetsrc(self, url, data = None):
+    def _getetsrc(self, url, data = None, recache = False):
         """Loads a URL using caching, returns an ElementTree of the source
         """
-        src = self._loadUrl(url, data)
+        import lxml.html
+        src = self._loadUrl(url, data, recache)
         return lxml.html.fromstring(decode_html(src))
-        
-    def _loadUrl(self, url, data, recache = False):
-        global lastTimeout
+
+    def _parse(self, parser_class, url, data = None, recache = False,
+               revalidate = False):
+        """Loads a URL and returns the output of parser_class.parse(), see
+        _parsePage. Season and episode pages are looked up in the backend
+        first, and stored there once parsed.
+        """
+        if self.backend is None or data is not None or parser_class not in (
+                TvSowParser, EpisodeParser):
+            return self._parsePage(parser_class, url, data, recache, revalidate)
+        key = self._backendKey(parser_class, url)
+        metrics = self.metrics
+        if not (recache or revalidate):
+            result = self._backend('get', key)
+            if result is not None:
+                log().debug("Using backend %s result for %s", parser_class.__name__, url)
+                metrics.incr('tvsubtitles_cache_total', tier = 'backend', result = 'hit')
+                return result
+            metrics.incr('tvsubtitles_cache_total', tier = 'backend', result = 'miss')
+        result = self._parsePage(parser_class, url, data, recache, revalidate)
+        self._backend('set', key, result, self.config['cache_ttl'][self._pageType(url)])
+        return result
+
+    def _backendKey(self, parser_class, url):
+        return 'page:%s:%s:%s' % (parser_class.__name__, parser_class.version, url)
+
+    def _backend(self, method, *args):
+        """Calls method of self.backend. Backend errors are logged and
+        ignored, None is returned.
+        """
+        from backends import BackendError
+        try:
+            return getattr(self.backend, method)(*args)
+        except BackendError, e:
+            log().debug('Backend %s of %s failed: %s', method, args[0], e)
+            self.metrics.incr('tvsubtitles_backend_errors_total')
+            return None
+
+    def _parsePage(self, parser_class, url, data = None, recache = False,
+                   revalidate = False):
+        """Loads a URL and returns the output of parser_class.parse().
+        When the cache is enabled, parsed output is cached too, so that
+        warm lookups skip decoding and parsing. Entries are stamped with
+        the parser version and dropped when the parser changes.
+        revalidate checks the page with the server even if it is fresh,
+        it is parsed again only if its content changed.
+        """
+        metrics = self.metrics
+        name = parser_class.__name__
+        key = None
+        entry = None
+        if self.cache is not None and self.config['cache_parsed']:
+            key = self.cache.key('%s:%s' % (name, url), data)
+            if not recache:
+                entry = self.cache.get(key)
+            if entry is not None and entry.get('version') != parser_class.version:
+                entry = None
+            if entry is not None and not revalidate:
+                age = time.time() - entry['stored']
+                if 0 <= age < self.config['cache_ttl'][self._pageType(url)]:
+                    log().debug("Using cached %s result for %s", name, url)
+                    metrics.incr('tvsubtitles_cache_total', tier = 'parsed', result = 'hit')
+                    return serialize.loads(zlib.decompress(entry['data']))
+
+        page = self._loadPage(url, data, recache, revalidate)
+        digest = hashlib.sha1(page['body']).hexdigest()
+        if entry is not None and entry.get('digest') == digest:
+            log().debug("Page %s did not change, using cached %s result", url, name)
+            metrics.incr('tvsubtitles_cache_total', tier = 'parsed', result = 'revalidated')
+            entry['stored'] = time.time()
+            self.cache.set(key, entry)
+            return serialize.loads(zlib.decompress(entry['data']))
+        if key is not None:
+            metrics.incr('tvsubtitles_cache_total', tier = 'parsed', result = 'miss')
+
+        result = None
+        if self.config['fast_parse']:
+            # lxml decodes the page itself, there is no decode time
+            with metrics.timer('tvsubtitles_parse_seconds', parser = 'lxml'):
+                doc = fast_html(page['body'], page.get('content_type'))
+            if doc is not None:
+                try:
+                    with metrics.timer('tvsubtitles_parse_seconds', parser = name):
+                        result = parser_class(doc).parse()
+                except Exception, e:
+                    log().debug("Fast parsing of %s failed (%s), using "
+                                "legacy parsing", url, e)
+        if result is None:
+            import lxml.html
+            with metrics.timer('tvsubtitles_decode_seconds', method = 'unicodedammit'):
+                src = decode_html(page['body'])
+            with metrics.timer('tvsubtitles_parse_seconds', parser = 'lxml'):
+                doc = lxml.html.fromstring(src)
+            with metrics.timer('tvsubtitles_parse_seconds', parser = name):
+                result = parser_class(doc).parse()
+
+        if key is not None:
+            self.cache.set(key, {
+                'version': parser_class.version,
+                'stored': time.time(),
+                'digest': digest,
+                'data': zlib.compress(serialize.dumps(result)),
+            })
+        return result
+
+    def _pageType(self, url):
+        """Returns the type of page at url: 'search', 'season', 'episode'
+        or 'other'. Used to select the cache lifetime.
+        """
+        if url == self.config['url_searchSeries']:
+            return 'search'
+        for page, template in (('season', 'url_serie_season'),
+                               ('episode', 'url_episode')):
+            pattern = re.escape(self.config[template]).replace(re.escape('%s'), r'[^/]+')
+            if re.match(pattern + '$', url):
+                return page
+        return 'other'
+
+    def _openUrl(self, url, data = None, headers = None):
+        """Opens url with self.urlopener, through self.scheduler. A 304 Not
+        Modified answer is returned as a response, other errors raise
+        tvsubtitles_error.
+        """
+        host = urlparse.urlsplit(url)[1]
+        return self.scheduler.call(host, lambda: self._openUrlOnce(url, data, headers))
+
+    def _openUrlOnce(self, url, data = None, headers = None):
+        """Single attempt of _openUrl, raises RetryableError on failures
+        worth retrying, HostError when the request (with data) cannot be
+        sent again
+        """
+        import urllib2
+        opener = self._getOpener()
+        request = urllib2.Request(url, data or None, headers or {})
         try:
-            log().debug("Retrieving URL %s" % url)
-            if not data:
-                resp = self.urlopener.open(url)
-            else:
-                resp = self.urlopener.open(url, data)
+            log().debug("Retrieving URL %s", url)
+            return opener.open(request)
         except (IOError, urllib2.URLError), errormsg:
-            if not str(errormsg).startswith('HTTP Error'):
-                lastTimeout = datetime.datetime.now()
-            raise tvsubtitles_error("Could not connect to server: %s" % (errormsg))
-        
-        return resp.read()
+            if isinstance(errormsg, urllib2.HTTPError):
+                if errormsg.code == 304:
+                    return errormsg
+                discard_response(errormsg)
+                if errormsg.code in RETRY_CODES:
+                    retry_after = None
+                    if errormsg.hdrs is not None:
+                        retry_after = parse_retry_after(
+                            errormsg.hdrs.getheader('Retry-After'))
+                    raise RetryableError(errormsg, retry_after)
+                raise tvsubtitles_error("Could not connect to server: %s" % (errormsg))
+            if data is not None:
+                # The server may have run a POST before the connection broke
+                raise HostError("Could not connect to server: %s" % (errormsg))
+            raise RetryableError(errormsg)
+
+    def _getOpener(self):
+        """Returns self.urlopener, the default opener is built on first use
+        """
+        if self.urlopener is None:
+            import urllib2
+            from transport import KeepAliveHandler
+            self._lock.acquire()
+            try:
+                if self.urlopener is None:
+                    # default opener, with persistent connections and compression
+                    self.urlopener = urllib2.build_opener(KeepAliveHandler(
+                        maxsize = self.config['connections_per_host'],
+                        metrics = self.metrics))
+            finally:
+                self._lock.release()
+        return self.urlopener
+
+    def _loadUrl(self, url, data, recache = False):
+        """Returns the body of url. If the cache is enabled, fresh cached
+        pages are returned without connecting, expired ones are revalidated.
+        recache forces a new download of the page.
+        """
+        return self._loadPage(url, data, recache)['body']
+
+    def _loadPage(self, url, data, recache = False, revalidate = False):
+        """Same as _loadUrl, but returns a dict holding the body and the
+        validators and content type of the page. With revalidate, cached
+        pages are revalidated even if they are fresh.
+        """
+        metrics = self.metrics
+        if self.cache is None:
+            return self._fetchPage(url, data)
+
+        key = self.cache.key(url, data)
+        entry = None
+        if not recache:
+            entry = self.cache.get(key)
+        headers = {}
+        if entry is not None:
+            age = time.time() - entry['stored']
+            if not revalidate and 0 <= age < self.config['cache_ttl'][self._pageType(url)]:
+                log().debug("Using cached URL %s", url)
+                metrics.incr('tvsubtitles_cache_total', tier = 'raw', result = 'hit')
+                return entry
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        page = self._fetchPage(url, data, headers)
+        if page['code'] == 304 and entry is not None:
+            log().debug("Cached URL %s not modified", url)
+            metrics.incr('tvsubtitles_cache_total', tier = 'raw', result = 'revalidated')
+            entry['stored'] = time.time()
+        else:
+            metrics.incr('tvsubtitles_cache_total', tier = 'raw', result = 'miss')
+            entry = page
+        self.cache.set(key, entry)
+        return entry
+
+    def _fetchPage(self, url, data, headers = None):
+        """Downloads url, returns the page dict stored by the cache
+        """
+        page_type = self._pageType(url)
+        with self.metrics.timer('tvsubtitles_fetch_seconds', page = page_type):
+            resp = self._openUrl(url, data, headers)
+            info = resp.info()
+            page = {
+                'url': url,
+                'code': getattr(resp, 'code', 200),
+                'body': resp.read(),
+                'stored': time.time(),
+                'etag': info.getheader('ETag'),
+                'last_modified': info.getheader('Last-Modified'),
+                'content_type': info.getheader('Content-Type'),
+            }
+        self.metrics.incr('tvsubtitles_fetch_bytes_total', len(page['body']),
+                          page = page_type)
+        return page
     
     def _getShowData(self, sid):
         """Takes a series ID, gets the epInfo URL and parses the 
         TVsubtitles HTML into the shows dict in layout:
         shows[series_id][season_number][episode_number]
         """ 
-        log().debug('Getting all series data for %s' % (sid))
-        html = self._getetsrc(
-            self.config['url_serie_season'] % (sid, 1)
-        )
-        parser = TvSowParser(html)
-        serie = parser.parse()
-        
-        self._setShowData(sid, 'seriesname', serie['name'])
-        
-        for season in serie['other_seasons']:
-            log().debug('Getting all season %s data ' % (season))
-            html = self._getetsrc( 
-                self.config['url_serie_season'] % (sid, season) 
+        for episode in self._iterShowData(sid):
+            pass
+
+    def _iterShowData(self, sid):
+        """Loads show sid like _getShowData, yielding each Episode as soon
+        as its season page is parsed. The show is marked complete once
+        every season is loaded.
+        """
+        log().debug('Getting all series data for %s', sid)
+        show = self.shows.get(sid)
+        if show is None or show._seasons is None:
+            self._setPage(sid, self._parse(TvSowParser,
+                self.config['url_serie_season'] % (sid, 1)
+            ))
+            show = self.shows[sid]
+
+        def load_season(season):
+            log().debug('Getting all season %s data ', season)
+            return self._parse(TvSowParser,
+                self.config['url_serie_season'] % (sid, season)
             )
-            parser = TvSowParser(html)
-            tmp = parser.parse()
-            serie['seasons'].update(tmp['seasons'])
-        
-        for season, episodes in serie['seasons'].items():
+
+        # Seasons loaded already, by episode() for instance, are kept
+        missing = [season for season in show._seasons
+                   if not dict.__contains__(show, season)]
+        pages = threaded_imap(load_season, missing, self.config['max_workers'])
+        for season in show._seasons:
+            if season in missing:
+                self._setPage(sid, pages.next())
+            if dict.__contains__(show, season):
+                season = dict.__getitem__(show, season)
+                for number in sorted(season.keys()):
+                    yield season[number]
+        self._complete.add(sid)
+
+    def _refreshShow(self, sid, all_seasons = False):
+        """Revalidates the season pages of show sid, see refresh
+        """
+        show = self.shows[sid]
+        # Seasons which are not loaded yet have nothing to refresh
+        seasons = sorted(dict.keys(show))
+        if not all_seasons:
+            seasons = seasons[-1:]
+        log().debug('Refreshing seasons %s of %s', seasons, sid)
+
+        def load_season(season, revalidate = True):
+            return self._parse(TvSowParser,
+                self.config['url_serie_season'] % (sid, season),
+                revalidate = revalidate)
+
+        pages = list(threaded_imap(load_season, seasons, self.config['max_workers']))
+        new_seasons = set()
+        for page in pages:
+            new_seasons.update(season for season in page['other_seasons']
+                               if season not in show)
+        if new_seasons:
+            log().debug('New seasons %s for %s', sorted(new_seasons), sid)
+            pages.extend(threaded_imap(lambda season: load_season(season, False),
+                                       sorted(new_seasons), self.config['max_workers']))
+
+        changes = []
+        for page in pages:
+            for season, episodes in page['seasons'].items():
+                changes.extend(self._diffSeason(sid, season, episodes))
+        show._seasons = sorted(set(show.keys()).union(new_seasons, show._seasons or ()))
+        return changes
+
+    def _diffSeason(self, sid, season, episodes):
+        """Applies TvSowParser output of a season to the loaded episodes,
+        returns the (change, episode) list of refresh
+        """
+        changes = []
+        self._lock.acquire()
+        try:
+            current = dict.get(self.shows[sid], season) or {}
+            seen = set()
             for ep in episodes:
-                self._setItem(sid, season, ep['num'], 'seasonnumber', season)
-                self._setItem(sid, season, ep['num'], 'episodenumber', ep['num'])
-                self._setItem(sid, season, ep['num'], 'id', ep['id'])
-                self._setItem(sid, season, ep['num'], 'episodename', ep['name'])
-                self._setItem(sid, season, ep['num'], 'available_languages', ep['lang'])
-                self._setItem(sid, season, ep['num'], 'languages', 
-                    LanguageGetter(self, ep['id'] ) 
-                )
+                seen.add(ep['num'])
+                episode = dict.get(current, ep['num'])
+                if episode is None:
+                    for episode in self._setSeason(sid, season, [ep]):
+                        changes.append(('added', episode))
+                    continue
+
+                updated = False
+                if episode['episodename'] != ep['name']:
+                    self._setItem(sid, season, ep['num'], 'episodename', ep['name'])
+                    updated = True
+                if episode['id'] != ep['id']:
+                    self._setItem(sid, season, ep['num'], 'id', ep['id'])
+                    self._setItem(sid, season, ep['num'], 'languages',
+                        LanguageGetter(self, ep['id']))
+                    updated = True
+                languages = episode['available_languages']
+                if sorted(languages) != sorted(ep['lang']):
+                    languages[:] = ep['lang']
+                    self._setItem(sid, season, ep['num'], 'available_languages', languages)
+                    self._invalidateLanguages(episode['languages'])
+                    updated = True
+                if updated:
+                    changes.append(('updated', episode))
+
+            for num in sorted(set(current.keys()) - seen):
+                episode = current.pop(num)
+                self.shows[sid]._unindex(episode)
+                changes.append(('removed', episode))
+        finally:
+            self._lock.release()
+        return changes
+
+    def _invalidateLanguages(self, getter):
+        """Drops the loaded and cached languages of a LanguageGetter, they
+        are downloaded again on next access
+        """
+        getter._data = False
+        if self.cache is not None:
+            url = self.config['url_episode'] % (getter._eid)
+            self.cache.delete(self.cache.key(url, None))
+            self.cache.delete(self.cache.key('%s:%s' % (EpisodeParser.__name__, url), None))
+        if self.backend is not None:
+            url = self.config['url_episode'] % (getter._eid)
+            self._backend('delete', self._backendKey(EpisodeParser, url))
+
+    def _setPage(self, sid, page):
+        """Adds the seasons of a TvSowParser page to show sid, and records
+        the season numbers it lists. Seasons loaded already are kept.
+        """
+        self._setShowData(sid, 'seriesname', page['name'])
+        self._lock.acquire()
+        try:
+            show = self.shows[sid]
+            seasons = set(page['other_seasons']).union(page['seasons'])
+            show._seasons = sorted(seasons.union(show._seasons or ()))
+            for season, episodes in page['seasons'].items():
+                if not dict.__contains__(show, season):
+                    for episode in self._setSeason(sid, season, episodes):
+                        pass
+            if all(dict.__contains__(show, season) for season in show._seasons):
+                self._complete.add(sid)
+        finally:
+            self._lock.release()
+
+    def _newShow(self, sid):
+        """Returns an empty Show of id sid, its missing seasons are loaded
+        on access
+        """
+        show = Show()
+        show._loader = lambda seasons: self._loadSeasons(sid, seasons)
+        show._stream = lambda: self._iterShowData(sid)
+        return show
+
+    def _setSeason(self, sid, season, episodes):
+        """Creates the Episode instances of a season from TvSowParser
+        output, yielding them in order
+        """
+        for ep in episodes:
+            self._setItem(sid, season, ep['num'], 'seasonnumber', season)
+            self._setItem(sid, season, ep['num'], 'episodenumber', ep['num'])
+            self._setItem(sid, season, ep['num'], 'id', ep['id'])
+            self._setItem(sid, season, ep['num'], 'episodename', ep['name'])
+            self._setItem(sid, season, ep['num'], 'available_languages', ep['lang'])
+            self._setItem(sid, season, ep['num'], 'languages', 
+                LanguageGetter(self, ep['id'] ) 
+            )
+            yield self.shows[sid][season][ep['num']]
 
     def _setShowData(self, sid, key, value):
         """Sets self.shows[sid] to a new Show instance, or sets the data
         """
-        if sid not in self.shows:
-            self.shows[sid] = Show()
-        self.shows[sid].data[key] = value
+        self._lock.acquire()
+        try:
+            if sid not in self.shows:
+                self.shows[sid] = self._newShow(sid)
+            self.shows[sid].data[key] = value
+        finally:
+            self._lock.release()
                 
     def _setItem(self, sid, seas, ep, attrib, value):
         """Creates a new episode, creating Show(), Season() and
@@ -462,13 +1587,18 @@ class TvSubtitles:
         calls __getitem__ on tvsubtitles[1], there is no way to check if
         tvsubtitles.__dict__ should have a key "1" before we auto-create it
         """
-        if sid not in self.shows:
-            self.shows[sid] = Show()
-        if seas not in self.shows[sid]:
-            self.shows[sid][seas] = Season(show = self.shows[sid])
-        if ep not in self.shows[sid][seas]:
-            self.shows[sid][seas][ep] = Episode(season = self.shows[sid][seas])
-        self.shows[sid][seas][ep][attrib] = value
+        self._lock.acquire()
+        try:
+            if sid not in self.shows:
+                self.shows[sid] = self._newShow(sid)
+            if not dict.__contains__(self.shows[sid], seas):
+                self.shows[sid][seas] = Season(show = self.shows[sid])
+            if ep not in self.shows[sid][seas]:
+                self.shows[sid][seas][ep] = self._episode_class(season = self.shows[sid][seas])
+            self.shows[sid][seas][ep][attrib] = value
+            self.shows[sid]._indexField(self.shows[sid][seas][ep], attrib, value)
+        finally:
+            self._lock.release()
 
 if __name__ == '__main__':
     logging.basicConfig(level = logging.DEBUG)
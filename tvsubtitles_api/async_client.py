@@ -0,0 +1,531 @@
+# encoding: utf-8
+#       async_client.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""Non-blocking client: lookups return Future instances, their requests
+run on an asyncore event loop in the calling thread. No thread is held
+per request, a single thread can have hundreds of lookups in flight.
+At most max_per_host connections are open to the same host at a time.
+
+The loop runs while run() is called, or while the result of a Future is
+waited for:
+
+>>> t = AsyncTvSubtitles(max_per_host = 4)
+>>> futures = [t.get_show(name) for name in ('scrubs', 'lost')]
+>>> t.run(futures)
+True
+>>> [f.result()['seriesname'] for f in futures]
+['Scrubs', 'Lost']
+
+Pages are parsed by the parsers of TvSubtitles, the caches, the backend
+and the catalog are used the same way. The blocking dict interface of
+TvSubtitles is still available, its requests go through the loop too.
+"""
+import sys
+import time
+import heapq
+import errno
+import socket
+import asyncore
+import urlparse
+import mimetools
+import zlib
+import collections
+from StringIO import StringIO
+
+from api import TvSubtitles, log, RETRY_CODES
+from scheduler import HostSlots, parse_retry_after
+from tvsubtitles_exceptions import tvsubtitles_error
+
+__all__ = ['AsyncTvSubtitles', 'Future']
+
+class Future:
+    """Result of a lookup running on the event loop of client
+    """
+    def __init__(self, client):
+        self._client = client
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout = None):
+        """Runs the event loop until the lookup is finished, returns its
+        result or raises its exception. Raises RuntimeError on timeout.
+        """
+        if not self._done and not self._client.run([self], timeout):
+            raise RuntimeError("Timeout waiting for result")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout = None):
+        """Same as result, but returns the exception raised by the
+        lookup, or None
+        """
+        if not self._done and not self._client.run([self], timeout):
+            raise RuntimeError("Timeout waiting for result")
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """fn(future) is called by the event loop once the lookup is
+        finished (immediately if it is finished already)
+        """
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def _set(self, result = None, exc_info = None):
+        self._result, self._exc_info = result, exc_info
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log().exception("Exception in future callback %r" % fn)
+
+class _NeedPage(Exception):
+    """Raised by _fetchPage within a lookup when the page has to be
+    downloaded: the lookup is run again once it is
+    """
+    def __init__(self, url, data, headers):
+        Exception.__init__(self, url)
+        self.url = url
+        self.data = data
+        self.headers = headers
+
+class _HTTPRequest(asyncore.dispatcher):
+    """One HTTP/1.0 request on a non-blocking socket. callback(page,
+    error) is called once, with the page dict stored by the cache or the
+    exception the request failed with.
+    """
+    def __init__(self, sock_map, url, data, headers, timeout, callback):
+        asyncore.dispatcher.__init__(self, map = sock_map)
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme != 'http':
+            raise tvsubtitles_error("Unsupported URL scheme %r" % parsed.scheme)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+        lines = ['%s %s HTTP/1.0' % (data is None and 'GET' or 'POST', path),
+                 'Host: %s' % parsed.netloc,
+                 'Accept-Encoding: gzip',
+                 'Connection: close']
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        if data is not None:
+            lines.append('Content-Type: application/x-www-form-urlencoded')
+            lines.append('Content-Length: %d' % len(data))
+        self.url = url
+        self.deadline = time.time() + timeout
+        self._out = '\r\n'.join(lines) + '\r\n\r\n' + (data or '')
+        self._in = []
+        self._callback = callback
+        self._head = None # (code, headers, body length or None)
+        self._received = 0
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((parsed.hostname, parsed.port or 80))
+        except socket.error:
+            self.close()
+            raise
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(64 * 1024)
+        if not data:
+            return
+        self._in.append(data)
+        self._received += len(data)
+        if self._head is None:
+            buf = ''.join(self._in)
+            end = buf.find('\r\n\r\n')
+            if end < 0:
+                return
+            self._in = [buf[end + 4:]]
+            self._received = len(self._in[0])
+            status, headers = buf[:end].split('\r\n', 1)
+            headers = mimetools.Message(StringIO(headers + "\r\n"))
+            length = headers.getheader('Content-Length')
+            self._head = (int(status.split()[1]), headers,
+                          length and length.isdigit() and int(length) or None)
+        if self._head[2] is not None and self._received >= self._head[2]:
+            self._finish()
+
+    def handle_close(self):
+        if self._head is None:
+            self.fail(socket.error(errno.ECONNRESET, "Connection closed by server"))
+        else:
+            self._finish()
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def handle_expt(self):
+        self.fail(socket.error(errno.ECONNRESET, "Connection error"))
+
+    def fail(self, error):
+        self.close()
+        callback, self._callback = self._callback, None
+        if callback is not None:
+            callback(None, error)
+
+    def _finish(self):
+        self.close()
+        code, headers, length = self._head
+        body = ''.join(self._in)
+        if headers.getheader('Content-Encoding') == 'gzip':
+            body = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(body)
+        page = {
+            'url': self.url,
+            'code': code,
+            'body': body,
+            'stored': time.time(),
+            'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader('Last-Modified'),
+            'content_type': headers.getheader('Content-Type'),
+            'location': headers.getheader('Location'),
+            'retry_after': headers.getheader('Retry-After'),
+        }
+        callback, self._callback = self._callback, None
+        if callback is not None:
+            callback(page, None)
+
+class AsyncTvSubtitles(TvSubtitles):
+    """TvSubtitles whose lookups return Future instances, see the module
+    documentation. timeout is the time in seconds a request may take.
+    """
+    max_redirects = 5
+
+    def __init__(self, max_per_host = 4, timeout = 30.0, **kwargs):
+        TvSubtitles.__init__(self, **kwargs)
+        self.config['max_per_host'] = max_per_host
+        self.config['timeout'] = timeout
+        self._map = {} # sockets of the event loop
+        self._timers = [] # heap of (time, sequence, fn)
+        self._sequence = 0
+        self._slots = HostSlots(max_per_host)
+        self._waiting = {} # host -> deque of requests waiting for a slot
+        self._pages = {} # (url, data) -> downloaded page, read by _fetchPage
+        self._fetching = {} # (url, data) -> lookups waiting for the page
+        self._closed = False
+        self._lookups = 0 # depth of lookups being run
+
+    def get_series(self, term):
+        """Future of _getSeries(term), the selected search result
+        """
+        return self._lookup(lambda: self._getSeries(term.lower()))
+
+    def get_show_data(self, sid):
+        """Future of the Show with id sid, loaded like _getShowData: its
+        missing seasons are downloaded at the same time
+        """
+        def first():
+            self._loadSeason(sid, 1)
+            show = self.shows[sid]
+            return [season for season in show._seasons
+                    if not dict.__contains__(show, season)]
+        def seasons(missing):
+            return self._gather([
+                self._lookup(lambda season = season: self._loadSeason(sid, season))
+                for season in missing])
+        loaded = Future(self)
+        self._then(self._lookup(first), seasons, loaded)
+        future = Future(self)
+        self._then(loaded, lambda results: self.shows[sid], future)
+        return future
+
+    def get_show(self, key):
+        """Future of tvsubtitles_instance[key], key is a show name or id
+        """
+        if isinstance(key, (int, long)):
+            return self.get_show_data(key)
+        future = Future(self)
+        sid = self._lookup(lambda: self._nameToSid(key.lower(), load = False))
+        self._then(sid, self.get_show_data, future)
+        return future
+
+    def load_languages(self, episode):
+        """Future of the subtitles languages of episode, an Episode
+        instance or an episode id. The LanguageGetter of an Episode is
+        filled in.
+        """
+        if isinstance(episode, (int, long, basestring)):
+            return self._lookup(lambda: self._getLanguages(episode))
+        return self._lookup(episode['languages'].load)
+
+    def run(self, futures = None, timeout = None):
+        """Runs the event loop until every Future of futures is done, or
+        until no request is left if futures is None. Returns False if
+        timeout seconds passed first.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if futures is not None:
+                if all(future.done() for future in futures):
+                    return True
+            elif not self._map and not self._timers:
+                return True
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return False
+            while self._timers and self._timers[0][0] <= now:
+                heapq.heappop(self._timers)[2]()
+            for request in self._map.values():
+                if request.deadline <= now:
+                    request.fail(socket.timeout("timed out"))
+            wait = 0.1
+            if self._timers:
+                wait = max(0, min(wait, self._timers[0][0] - now))
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - now))
+            if self._map:
+                asyncore.loop(wait, map = self._map, count = 1)
+            elif self._timers:
+                time.sleep(wait)
+            elif futures is not None and not all(future.done() for future in futures):
+                raise RuntimeError("Nothing left to run, the futures cannot finish")
+
+    def close(self):
+        """Closes the connections in progress, and saves the pending
+        changes of the catalog
+        """
+        self._closed = True
+        for request in self._map.values():
+            request.fail(tvsubtitles_error("Client closed"))
+        timers, self._timers = self._timers, []
+        for when, sequence, fn in timers:
+            fn()
+        TvSubtitles.close(self)
+
+    def _later(self, delay, fn):
+        self._sequence += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._sequence, fn))
+
+    def _then(self, source, fn, future):
+        """Sets future to fn(result of source), or to the exception of
+        source. If fn returns a Future, future gets its outcome.
+        """
+        def done(source):
+            if source._exc_info is not None:
+                future._set(exc_info = source._exc_info)
+                return
+            try:
+                result = fn(source._result)
+            except Exception:
+                future._set(exc_info = sys.exc_info())
+                return
+            if isinstance(result, Future):
+                result.add_done_callback(lambda f: future._set(f._result, f._exc_info))
+            else:
+                future._set(result)
+        source.add_done_callback(done)
+
+    def _gather(self, futures):
+        """Returns the Future of the list of results of futures, or of the
+        first exception
+        """
+        future = Future(self)
+        left = [len(futures)]
+        def done(source):
+            if future.done():
+                return
+            if source._exc_info is not None:
+                future._set(exc_info = source._exc_info)
+                return
+            left[0] -= 1
+            if not left[0]:
+                future._set([f._result for f in futures])
+        if not futures:
+            future._set([])
+        for source in futures:
+            source.add_done_callback(done)
+        return future
+
+    def _lookup(self, fn):
+        """Runs fn() in the loop, returns the Future of its result. When fn
+        needs a page which is not cached, the page is downloaded and fn
+        run again: the lookups of TvSubtitles are not blocked on requests.
+        """
+        future = Future(self)
+        def step():
+            self._lookups += 1
+            try:
+                result = fn()
+            except _NeedPage, e:
+                self._waitPage(e, step, future)
+                return
+            except Exception:
+                future._set(exc_info = sys.exc_info())
+                return
+            finally:
+                self._lookups -= 1
+            future._set(result)
+        step()
+        return future
+
+    def _waitPage(self, need, step, future):
+        """Downloads the page needed by a lookup, then calls step(), or
+        sets future to the error. Lookups needing a page being downloaded
+        share its request.
+        """
+        key = (need.url, need.data)
+        waiters = self._fetching.get(key)
+        if waiters is not None:
+            waiters.append((step, future))
+            return
+        waiters = self._fetching[key] = [(step, future)]
+        def fetched(fetch):
+            del self._fetching[key]
+            if fetch._exc_info is None:
+                self._pages[key] = fetch._result
+            try:
+                for step, future in waiters:
+                    if fetch._exc_info is not None:
+                        future._set(exc_info = fetch._exc_info)
+                    else:
+                        step()
+            finally:
+                self._pages.pop(key, None)
+        fetch = Future(self)
+        fetch.add_done_callback(fetched)
+        self._request(need.url, need.data, need.headers, fetch)
+
+    def _fetchPage(self, url, data, headers = None):
+        page = self._pages.get((url, data))
+        if page is None:
+            if self._lookups:
+                raise _NeedPage(url, data, headers)
+            # Blocking call, made outside of a lookup
+            future = Future(self)
+            self._request(url, data, headers, future)
+            page = future.result()
+        self.metrics.incr('tvsubtitles_fetch_bytes_total', len(page['body']),
+                          page = self._pageType(page['url']))
+        return page
+
+    def _request(self, url, data, headers, future, attempt = 0, redirects = 0,
+                 started = None):
+        """Downloads url through the scheduler of the host: the request is
+        delayed by the rate limit and retried like in _openUrl, future is
+        set to the page
+        """
+        if self._closed:
+            future._set(exc_info = (tvsubtitles_error, tvsubtitles_error(
+                "Client closed"), None))
+            return
+        host = urlparse.urlsplit(url)[1]
+        scheduler = self.scheduler
+        state = scheduler._state(host)
+        if started is None:
+            started = time.time()
+        try:
+            probe = scheduler._admit(host, state)
+        except tvsubtitles_error:
+            future._set(exc_info = sys.exc_info())
+            return
+
+        def retry(error, retry_after = None):
+            scheduler._done(state, probe, True)
+            # Data may have been received by the server, it is not sent twice.
+            # Retry codes are refusals, they are retried.
+            if (attempt >= scheduler.retries or self._closed or
+                    data is not None and not isinstance(error, int)):
+                future._set(exc_info = (tvsubtitles_error, tvsubtitles_error(
+                    "Could not connect to server: %s" % error), None))
+                return
+            delay = scheduler.delay(attempt, retry_after)
+            log().debug("Request to %s failed (%s), retrying in %.1fs", host, error, delay)
+            self._later(delay, lambda: self._request(url, data, headers, future,
+                                                     attempt + 1, redirects, started))
+
+        def done(page, error):
+            self._releaseHost(url)
+            if error is not None:
+                retry(error)
+                return
+            code = page['code']
+            if code in RETRY_CODES:
+                retry(code, parse_retry_after(page['retry_after']))
+                return
+            if code in (301, 302, 303, 307) and page['location'] and redirects < self.max_redirects:
+                scheduler._done(state, probe, False)
+                location = urlparse.urljoin(url, page['location'])
+                self._request(location, code == 307 and data or None, headers, future,
+                              0, redirects + 1, started)
+                return
+            if code >= 400:
+                scheduler._done(state, probe, None)
+                future._set(exc_info = (tvsubtitles_error, tvsubtitles_error(
+                    "Could not connect to server: HTTP Error %s" % code), None))
+                return
+            scheduler._done(state, probe, False)
+            self.metrics.observe('tvsubtitles_fetch_seconds', time.time() - started,
+                                 page = self._pageType(url))
+            future._set(page)
+
+        def start():
+            try:
+                _HTTPRequest(self._map, url, data, headers, self.config['timeout'], done)
+            except socket.error, e:
+                done(None, e)
+            except tvsubtitles_error:
+                self._releaseHost(url)
+                scheduler._done(state, probe, None)
+                future._set(exc_info = sys.exc_info())
+
+        wait = 0
+        if state.bucket is not None:
+            wait = state.bucket.reserve()
+        self._later(wait, lambda: self._acquireHost(url, start))
+
+    def _acquireHost(self, url, start):
+        """Calls start() once less than max_per_host requests to the host
+        of url are in progress
+        """
+        if self._slots.slot(url).acquire(False):
+            start()
+        else:
+            host = urlparse.urlsplit(url)[1]
+            self._waiting.setdefault(host, collections.deque()).append(start)
+
+    def _releaseHost(self, url):
+        waiting = self._waiting.get(urlparse.urlsplit(url)[1])
+        if waiting:
+            # The slot goes to the next waiting request
+            self._later(0, waiting.popleft())
+        else:
+            self._slots.slot(url).release()
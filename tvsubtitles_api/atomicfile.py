@@ -0,0 +1,52 @@
+# encoding: utf-8
+#       atomicfile.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""Files written atomically: the content goes to a temporary file of the
+destination directory, then renamed over the destination. Readers see
+the previous file or the new one, never a partial one.
+"""
+import os
+import tempfile
+
+__all__ = ['write_atomic', 'replace_file']
+
+def write_atomic(dirname, write, commit):
+    """Calls write(f) with a new temporary file of dirname, then, once it
+    is closed, commit(path of the temporary file) which moves it into
+    place. Returns what commit returns. The temporary file is removed if
+    it is still there afterwards, or if write or commit fail.
+    """
+    fd, tmp = tempfile.mkstemp(dir = dirname, prefix = '.tmp')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            write(f)
+        finally:
+            f.close()
+        return commit(tmp)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def replace_file(path, write):
+    """Writes path atomically, write(f) writes the content to f
+    """
+    write_atomic(os.path.dirname(os.path.abspath(path)), write,
+                 lambda tmp: os.rename(tmp, path))
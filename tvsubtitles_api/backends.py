@@ -0,0 +1,362 @@
+# encoding: utf-8
+#       backends.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Cache backends shared by TvSubtitles instances, holding show name
+corrections and the parsed season and episode pages.
+
+>>> t = TvSubtitles(backend = 'sqlite:///var/cache/tvsubtitles.db')
+>>> t = TvSubtitles(backend = RedisBackend('cache.local', 6379))
+
+MemoryBackend is private to a process, SQLiteBackend is shared by the
+processes of a host and RedisBackend by every process reaching the
+Redis server. Values are stored as JSON (see the serialize module),
+each get returns a new copy.
+"""
+import time
+import socket
+import collections
+import urlparse
+import threading
+
+import serialize
+from api import log
+
+__all__ = ['BackendError', 'CacheBackend', 'MemoryBackend', 'SQLiteBackend',
+           'RedisBackend', 'from_url']
+
+class BackendError(Exception):
+    """Raised when a backend cannot be reached or answers an error
+    """
+    pass
+
+class CacheBackend:
+    """Base class of the backends. Subclasses store strings with _get,
+    _set and _delete, keys are prefixed with namespace so that several
+    users can share a store.
+    """
+    def __init__(self, namespace = 'tvsubtitles'):
+        self.namespace = namespace
+
+    def _key(self, key):
+        return '%s:%s' % (self.namespace, key)
+
+    def get(self, key):
+        """Returns the value stored under key, or None
+        """
+        data = self._get(self._key(key))
+        if data is None:
+            return None
+        try:
+            return serialize.loads(data)
+        except Exception:
+            log().debug('Dropping unreadable backend entry %s', key)
+            self.delete(key)
+            return None
+
+    def set(self, key, value, ttl = None):
+        """Stores value under key, for ttl seconds if ttl is given
+        """
+        self._set(self._key(key), serialize.dumps(value), ttl)
+
+    def delete(self, key):
+        """Removes the value stored under key, if any
+        """
+        self._delete(self._key(key))
+
+    def close(self):
+        pass
+
+class MemoryBackend(CacheBackend):
+    """Backend held in the process, at most max_entries values are kept,
+    the least recently used are evicted first
+    """
+    def __init__(self, max_entries = 10000, namespace = 'tvsubtitles',
+                 clock = time.time):
+        CacheBackend.__init__(self, namespace)
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() # key -> (expires, data)
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= self._clock():
+                return None
+            # Most recently used entries are last
+            self._entries[key] = entry
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def _set(self, key, data, ttl):
+        expires = None
+        if ttl is not None:
+            expires = self._clock() + ttl
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, data)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+        finally:
+            self._lock.release()
+
+    def _delete(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+class SQLiteBackend(CacheBackend):
+    """Backend stored in a SQLite database file, which processes of a
+    host can share. Each thread uses its own connection.
+    """
+    def __init__(self, path, namespace = 'tvsubtitles', timeout = 30.0,
+                 clock = time.time):
+        CacheBackend.__init__(self, namespace)
+        self.path = path
+        self.timeout = timeout
+        self._clock = clock
+        self._local = threading.local()
+        self._execute('CREATE TABLE IF NOT EXISTS cache ('
+                      'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout = self.timeout,
+                                   isolation_level = None)
+            try:
+                # Readers do not block the writer of another process
+                conn.execute('PRAGMA journal_mode = WAL')
+            except sqlite3.Error:
+                pass
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql, args = ()):
+        import sqlite3
+        try:
+            return self._connection().execute(sql, args).fetchall()
+        except sqlite3.Error, e:
+            raise BackendError("SQLite backend %s: %s" % (self.path, e))
+
+    def _get(self, key):
+        rows = self._execute('SELECT value, expires FROM cache WHERE key = ?', (key,))
+        if not rows:
+            return None
+        value, expires = rows[0]
+        if expires is not None and expires <= self._clock():
+            self._execute('DELETE FROM cache WHERE key = ? AND expires <= ?',
+                          (key, self._clock()))
+            return None
+        return str(value)
+
+    def _set(self, key, data, ttl):
+        import sqlite3
+        expires = None
+        if ttl is not None:
+            expires = self._clock() + ttl
+        self._execute('INSERT OR REPLACE INTO cache (key, value, expires) '
+                      'VALUES (?, ?, ?)', (key, sqlite3.Binary(data), expires))
+
+    def _delete(self, key):
+        self._execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def purge(self):
+        """Removes the expired entries
+        """
+        self._execute('DELETE FROM cache WHERE expires <= ?', (self._clock(),))
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+class RedisBackend(CacheBackend):
+    """Backend stored on a Redis server, or any server speaking its
+    protocol (RESP). Connections are kept open, at most one per thread is
+    in use at a time.
+    """
+    def __init__(self, host = '127.0.0.1', port = 6379, db = 0, password = None,
+                 namespace = 'tvsubtitles', timeout = 5.0):
+        CacheBackend.__init__(self, namespace)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except socket.error, e:
+            raise BackendError("Could not connect to Redis %s:%s: %s" % (
+                self.host, self.port, e))
+        conn = _RedisConnection(sock)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.password is not None:
+                conn.command('AUTH', self.password)
+            if self.db:
+                conn.command('SELECT', self.db)
+        except Exception, e:
+            # Never keep a connection with a failed handshake
+            conn.close()
+            raise BackendError("Redis %s:%s handshake failed: %s" % (
+                self.host, self.port, e))
+        return conn
+
+    def command(self, *args):
+        """Sends a command, returns its reply. Errors answered by the
+        server raise BackendError.
+        """
+        self._lock.acquire()
+        try:
+            conn = self._idle and self._idle.pop() or None
+        finally:
+            self._lock.release()
+        if conn is None:
+            conn = self._connect()
+        try:
+            reply = conn.command(*args)
+        except (socket.error, BackendError), e:
+            if isinstance(e, BackendError) and not conn.broken:
+                # Error answered by the server, the connection is fine
+                self._release(conn)
+                raise
+            conn.close()
+            raise BackendError("Redis %s:%s: %s" % (self.host, self.port, e))
+        self._release(conn)
+        return reply
+
+    def _release(self, conn):
+        self._lock.acquire()
+        try:
+            self._idle.append(conn)
+        finally:
+            self._lock.release()
+
+    def _get(self, key):
+        return self.command('GET', key)
+
+    def _set(self, key, data, ttl):
+        if ttl is not None:
+            self.command('SET', key, data, 'EX', max(1, int(ttl)))
+        else:
+            self.command('SET', key, data)
+
+    def _delete(self, key):
+        self.command('DEL', key)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            conn.close()
+
+class _RedisConnection:
+    """Socket speaking RESP, the Redis protocol
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+        self.broken = False
+
+    def command(self, *args):
+        parts = ['*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode('utf-8')
+            arg = str(arg)
+            parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        try:
+            self.sock.sendall(''.join(parts))
+            return self._reply()
+        except socket.error:
+            self.broken = True
+            raise
+
+    def _reply(self):
+        line = self.file.readline()
+        if not line.endswith('\r\n'):
+            self.broken = True
+            raise socket.error("Connection closed by server")
+        kind, value = line[0], line[1:-2]
+        if kind == '+':
+            return value
+        if kind == '-':
+            raise BackendError(value)
+        if kind == ':':
+            return int(value)
+        if kind == '$':
+            length = int(value)
+            if length < 0:
+                return None
+            data = self.file.read(length + 2)
+            if len(data) != length + 2:
+                self.broken = True
+                raise socket.error("Connection closed by server")
+            return data[:-2]
+        if kind == '*':
+            count = int(value)
+            if count < 0:
+                return None
+            return [self._reply() for i in range(count)]
+        self.broken = True
+        raise BackendError("Invalid reply %r" % line)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def from_url(url):
+    """Returns the backend described by url: memory://, sqlite:///path or
+    redis://[:password@]host[:port][/db]
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if scheme == 'memory':
+        return MemoryBackend()
+    if scheme == 'sqlite':
+        return SQLiteBackend(netloc + path)
+    if scheme == 'redis':
+        parsed = urlparse.urlsplit(url)
+        db = 0
+        if path.strip('/'):
+            db = int(path.strip('/'))
+        return RedisBackend(parsed.hostname or '127.0.0.1', parsed.port or 6379,
+                            db = db, password = parsed.password)
+    raise ValueError("Invalid backend URL %r" % url)
@@ -0,0 +1,231 @@
+# encoding: utf-8
+#       cache.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""On-disk cache used by TvSubtitles to store HTTP responses
+"""
+import os
+import stat
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+import serialize
+from atomicfile import write_atomic
+
+__all__ = ['DiskCache', 'private_directory', 'user_directory']
+
+def private_directory(path):
+    """Creates the directory path accessible to the current user only, or
+    checks that the existing one belongs to the user, removing the access
+    of other users. Raises OSError if it is not a directory or belongs to
+    another user.
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError(errno.ENOTDIR, "Not a directory (or a link)", path)
+    if hasattr(os, 'getuid'):
+        if st.st_uid != os.getuid():
+            raise OSError(errno.EPERM, "Directory owned by another user", path)
+        if st.st_mode & 077:
+            os.chmod(path, 0700)
+    return path
+
+def user_directory():
+    """Returns the private directory of the current user in the system
+    temp directory, holding the default cache and catalog
+    """
+    if hasattr(os, 'getuid'):
+        user = str(os.getuid())
+    else:
+        import getpass
+        user = getpass.getuser()
+    return private_directory(
+        os.path.join(tempfile.gettempdir(), "tvsubtitles_api-%s" % user))
+
+class DiskCache:
+    """Stores entries on disk as JSON (see the serialize module), one file
+    per key. Directories are created accessible to the current user only.
+
+    Entries are plain dicts, DiskCache does not interpret them. The total
+    size of the stored files is capped to max_size bytes, least recently
+    used entries are evicted first (the modification time of a file is
+    updated each time it is read). Once max_size is exceeded, entries are
+    evicted until the cache is down to low_water * max_size bytes.
+
+    The size is counted by this instance, other processes sharing the
+    location make it drift. The files are only listed again to evict.
+    """
+    def __init__(self, location, max_size = 100 * 1024 * 1024, low_water = 0.8):
+        self.location = location
+        self.max_size = max_size
+        self.low_water = low_water
+        self._lock = threading.RLock()
+        self._size = None
+        if not os.path.isdir(location):
+            try:
+                os.makedirs(location, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def key(self, url, data = None):
+        """Returns the cache key of a request, POST data is part of the key
+        """
+        return hashlib.sha1('%s\0%s' % (url, data or '')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def _files(self):
+        """Returns a list of (path, size, mtime) of all stored entries
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.location):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, st.st_size, st.st_mtime))
+        return files
+
+    def size(self):
+        """Total size in bytes of the stored entries
+        """
+        self._lock.acquire()
+        try:
+            if self._size is None:
+                self._size = sum(size for path, size, mtime in self._files())
+            return self._size
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """Returns the entry stored under key, or None
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                entry = serialize.loads(f.read())
+            except Exception:
+                # Truncated or foreign file, forget it
+                f.close()
+                self.delete(key)
+                return None
+        finally:
+            f.close()
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry
+
+    def set(self, key, entry):
+        """Stores entry under key, then evicts old entries if needed
+        """
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        data = serialize.dumps(entry)
+        def commit(tmp):
+            self._lock.acquire()
+            try:
+                old = self.size() - self._filesize(path)
+                os.rename(tmp, path)
+                self._size = old + self._filesize(path)
+                if self._size > self.max_size:
+                    self._evict()
+            finally:
+                self._lock.release()
+        write_atomic(dirname, lambda f: f.write(data), commit)
+
+    def delete(self, key):
+        """Removes the entry stored under key, if any
+        """
+        path = self._path(key)
+        self._lock.acquire()
+        try:
+            size = self._filesize(path)
+            try:
+                os.remove(path)
+            except OSError:
+                return
+            if self._size is not None:
+                self._size -= size
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes every stored entry
+        """
+        self._lock.acquire()
+        try:
+            for path, size, mtime in self._files():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def _filesize(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _evict(self):
+        """Removes least recently used entries until the cache fits in
+        low_water * max_size bytes, if it does not fit in max_size
+        """
+        files = sorted(self._files(), key = lambda f: f[2])
+        total = sum(size for path, size, mtime in files)
+        if total <= self.max_size:
+            # Counted too much, entries were removed by another process
+            self._size = total
+            return
+        target = self.max_size * self.low_water
+        for path, size, mtime in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
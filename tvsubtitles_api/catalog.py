@@ -0,0 +1,260 @@
+# encoding: utf-8
+#       catalog.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Local catalog of the shows of tvsubtitles.net, resolving show names
+without searching the site.
+
+>>> catalog = ShowCatalog('shows.json')
+>>> catalog.seed([(51, 'Scrubs (2001-2010)', ['en', 'fr'])])
+>>> catalog.lookup('scrubs')
+51
+>>> catalog.save()
+
+Catalogs with a path save their changes with flush at most every
+save_interval seconds, and when the interpreter exits.
+
+Names are matched exactly (ignoring case and the years following the
+name), then fuzzily with the dice coefficient of their bigrams, ranked
+by a BigramRanker.
+"""
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import weakref
+import threading
+
+from ranking import BigramRanker
+from atomicfile import replace_file
+
+__all__ = ['ShowCatalog']
+
+_years = re.compile(r'\s*\(\d{4}(-\d{4})?\)$')
+_spaces = re.compile(r'\s+')
+
+_unsaved = weakref.WeakKeyDictionary() # catalogs flushed at exit
+
+def log():
+    return logging.getLogger("tvsubtitles_api")
+
+def _flush_all():
+    for catalog in list(_unsaved.keys()):
+        try:
+            catalog.flush(force = True)
+        except (IOError, OSError), e:
+            log().warning("Could not save the catalog %s: %s", catalog.path, e)
+
+atexit.register(_flush_all)
+
+def normalize(name):
+    """Lower case name with collapsed white spaces
+    """
+    return _spaces.sub(u' ', unicode(name).strip().lower())
+
+class ShowCatalog:
+    """Show ids and languages by name, persisted as JSON in path.
+
+    Shows are added with add, add_results (TvShowSearchParser output) or
+    seed. Search terms resolved on the site are remembered with alias.
+    lookup accepts a fuzzy match scoring at least min_score, and only if
+    no other show scores as well.
+    """
+    version = 1
+
+    def __init__(self, path = None, min_score = 0.85, save_interval = 60.0):
+        self.path = path
+        self.min_score = min_score
+        self.save_interval = save_interval
+        self._saved = time.time()
+        self._shows = {} # id -> {'name': , 'languages': }
+        self._aliases = {} # normalized search term -> id
+        self._names = {} # normalized name -> set of ids
+        self._ranker = BigramRanker() # ranks the normalized names
+        self._lock = threading.RLock()
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            self.load()
+        if path is not None:
+            _unsaved[self] = True
+
+    def __len__(self):
+        return len(self._shows)
+
+    def __contains__(self, sid):
+        return int(sid) in self._shows
+
+    def get(self, sid):
+        """Returns a dict with the id, name and languages of show sid, or
+        None
+        """
+        show = self._shows.get(int(sid))
+        if show is None:
+            return None
+        return dict(show, id = int(sid))
+
+    def _index(self, name, sid):
+        if name not in self._names:
+            self._names[name] = set()
+            self._ranker.add(name)
+        self._names[name].add(sid)
+
+    def add(self, sid, name, languages = None):
+        """Adds or updates a show
+        """
+        sid = int(sid)
+        self._lock.acquire()
+        try:
+            show = self._shows.get(sid)
+            if show is not None and show['name'] == name and (
+                    languages is None or show['languages'] == list(languages)):
+                return
+            if show is None:
+                show = self._shows[sid] = {'name': name, 'languages': []}
+            show['name'] = name
+            if languages is not None:
+                show['languages'] = list(languages)
+            full = normalize(name)
+            self._index(full, sid)
+            short = _years.sub(u'', full)
+            if short and short != full:
+                self._index(short, sid)
+            self.changed = True
+        finally:
+            self._lock.release()
+
+    def add_results(self, results):
+        """Adds the shows of TvShowSearchParser results
+        """
+        for result in results:
+            self.add(result['id'], result['name'], result.get('languages'))
+
+    def seed(self, shows):
+        """Adds many shows at once, given as (id, name) or (id, name,
+        languages) tuples or as dicts with id, name and languages keys
+        """
+        self._lock.acquire()
+        try:
+            for show in shows:
+                if isinstance(show, dict):
+                    self.add(show['id'], show['name'], show.get('languages'))
+                else:
+                    self.add(*show)
+        finally:
+            self._lock.release()
+
+    def alias(self, term, sid):
+        """Remembers that the search term resolves to show sid
+        """
+        term, sid = normalize(term), int(sid)
+        self._lock.acquire()
+        try:
+            if self._aliases.get(term) != sid:
+                self._aliases[term] = sid
+                self.changed = True
+        finally:
+            self._lock.release()
+
+    def search(self, term, k = 10):
+        """Returns the k best matching shows for term as a list of
+        (score, id, name) tuples, best first
+        """
+        self._lock.acquire()
+        try:
+            # a show has at most two indexed names
+            matches = self._ranker.top(normalize(term), k * 2)
+            names = self._ranker.names
+            results, seen = [], set()
+            for score, index in matches:
+                for sid in sorted(self._names[names[index]]):
+                    if sid not in seen:
+                        seen.add(sid)
+                        results.append((score, sid, self._shows[sid]['name']))
+            return results[:k]
+        finally:
+            self._lock.release()
+
+    def lookup(self, term):
+        """Returns the id of the show named term, or None if the catalog
+        does not know it for sure
+        """
+        term = normalize(term)
+        sid = self._aliases.get(term)
+        if sid is not None:
+            return sid
+        sids = self._names.get(term) or self._names.get(_years.sub(u'', term))
+        if sids:
+            if len(sids) == 1:
+                return iter(sids).next()
+            return None # several shows have this name
+        matches = self.search(term, k = 2)
+        if not matches or matches[0][0] < self.min_score:
+            return None
+        if len(matches) > 1 and matches[1][0] == matches[0][0]:
+            return None
+        return matches[0][1]
+
+    def load(self, path = None):
+        """Adds the shows and aliases saved in path (default self.path)
+        """
+        f = open(path or self.path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+        if data.get('version') != self.version:
+            return
+        self._lock.acquire()
+        try:
+            for sid, show in data['shows'].iteritems():
+                self.add(sid, show['name'], show['languages'])
+            for term, sid in data['aliases'].iteritems():
+                self.alias(term, sid)
+            self.changed = False
+        finally:
+            self._lock.release()
+
+    def flush(self, force = False):
+        """Saves the changes to self.path if the last save is older than
+        save_interval seconds, or if force is True
+        """
+        if self.path is None or not self.changed:
+            return
+        if force or time.time() - self._saved >= self.save_interval:
+            self.save()
+
+    def save(self, path = None):
+        """Writes the catalog to path (default self.path) as JSON
+        """
+        path = path or self.path
+        self._lock.acquire()
+        try:
+            data = {
+                'version': self.version,
+                'shows': dict((str(sid), show) for sid, show in self._shows.iteritems()),
+                'aliases': self._aliases,
+            }
+            replace_file(path, lambda f: json.dump(data, f))
+            self.changed = False
+            self._saved = time.time()
+        finally:
+            self._lock.release()
@@ -0,0 +1,270 @@
+# encoding: utf-8
+#       crawler.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Bulk crawler loading many shows with a pool of processes, so that
+parsing uses every core.
+
+    python -m tvsubtitles_api.crawler --store shows/ --languages scrubs 51 "the office"
+    python -m tvsubtitles_api.crawler --store shows/ --input names.txt --cache cache/
+
+Each show is saved as store/<id>.json. Crawled names are appended to
+store/checkpoint.log as they complete, and merged into
+store/checkpoint.json when the crawl ends. Running the same command
+again resumes the crawl (--retry-failed also retries the failed names).
+"""
+import os
+import sys
+import json
+import time
+import logging
+import optparse
+import datetime
+import multiprocessing
+
+from api import TvSubtitles
+from cache import DiskCache
+from atomicfile import replace_file
+
+__all__ = ['export_show', 'crawl', 'main']
+
+CHECKPOINT = 'checkpoint.json'
+CHECKPOINT_LOG = 'checkpoint.log'
+
+def log():
+    return logging.getLogger("tvsubtitles_api")
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def write_json(path, data):
+    """Writes data as JSON to path, atomically
+    """
+    replace_file(path, lambda f: json.dump(data, f, default = _json_default,
+                                           sort_keys = True))
+
+def export_show(sid, show):
+    """Returns show as plain dicts and lists. The subtitles of episodes
+    whose languages were loaded are in their 'subtitles' key.
+    """
+    seasons = {}
+    for season_number, season in show.items():
+        episodes = seasons[str(season_number)] = {}
+        for number, episode in season.items():
+            data = dict((k, v) for k, v in episode.items() if k != 'languages')
+            getter = episode.get('languages')
+            if getter is not None and getter.loaded() is not None:
+                data['subtitles'] = getter.loaded()
+            episodes[str(number)] = data
+    return {'id': sid, 'seriesname': show.data.get('seriesname'),
+            'seasons': seasons}
+
+# Per process TvSubtitles, created by _init_worker
+_tvsubtitles = None
+_options = None
+
+def _init_worker(options):
+    global _tvsubtitles, _options
+    _options = options
+    cache = False
+    if options.get('cache'):
+        cache = DiskCache(options['cache'])
+    rate_limit = options.get('rate_limit')
+    if rate_limit:
+        # Every process sends its share of the requests
+        rate_limit = rate_limit / float(options['processes'])
+    _tvsubtitles = TvSubtitles(cache = cache,
+                               max_workers = options.get('max_workers', 1),
+                               rate_limit = rate_limit,
+                               **options.get('tvsubtitles', {}))
+
+def _crawl(key):
+    """Loads the show named key (or with id key) and saves it in the
+    store. Returns (key, show id, number of episodes, error)
+    """
+    t = _tvsubtitles
+    try:
+        if key.isdigit():
+            sid = int(key)
+        else:
+            sid = t._nameToSid(key.lower(), load = False)
+        show = t[sid]
+        if _options.get('languages'):
+            t.prefetch_languages(sid)
+        data = export_show(sid, show)
+        write_json(os.path.join(_options['store'], '%s.json' % sid), data)
+        count = sum(len(season) for season in show.values())
+        # Loaded shows are not needed anymore in this process
+        t.shows.pop(sid, None)
+        t._complete.discard(sid)
+        return key, sid, count, None
+    except Exception, e:
+        log().debug('Crawling %s failed: %s', key, e)
+        return key, None, 0, '%s: %s' % (e.__class__.__name__, e)
+
+def _record(checkpoint, key, sid, error):
+    if error is None:
+        checkpoint['done'][key] = sid
+        checkpoint['failed'].pop(key, None)
+    else:
+        checkpoint['failed'][key] = error
+
+def load_checkpoint(store):
+    """Returns the checkpoint of a store, {'done': {key: id}, 'failed':
+    {key: error}}, including the results logged by an interrupted crawl
+    """
+    checkpoint = {'done': {}, 'failed': {}}
+    path = os.path.join(store, CHECKPOINT)
+    if os.path.exists(path):
+        f = open(path)
+        try:
+            checkpoint = json.load(f)
+        finally:
+            f.close()
+    path = os.path.join(store, CHECKPOINT_LOG)
+    if os.path.exists(path):
+        f = open(path)
+        try:
+            for line in f:
+                try:
+                    key, sid, error = json.loads(line)
+                except ValueError:
+                    # Last line cut by the interruption
+                    continue
+                _record(checkpoint, key, sid, error)
+        finally:
+            f.close()
+    return checkpoint
+
+def save_checkpoint(store, checkpoint):
+    """Writes checkpoint to store/checkpoint.json, and empties the log
+    it includes
+    """
+    write_json(os.path.join(store, CHECKPOINT), checkpoint)
+    path = os.path.join(store, CHECKPOINT_LOG)
+    if os.path.exists(path):
+        os.remove(path)
+
+def crawl(keys, store, processes = None, languages = False, cache = None,
+          max_workers = 1, rate_limit = 5.0, retry_failed = False,
+          tvsubtitles = None, progress = None):
+    """Crawls the shows named (or with ids) keys into the store
+    directory, skipping those already done according to its checkpoint.
+    tvsubtitles holds extra TvSubtitles arguments, progress is called
+    with each (key, id, episodes, error) result. Returns the checkpoint.
+    rate_limit is the number of requests per second of the whole crawl.
+    """
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    checkpoint = load_checkpoint(store)
+    done, failed = checkpoint['done'], checkpoint['failed']
+    pending = []
+    seen = set()
+    for key in keys:
+        key = unicode(key).strip()
+        if not key or key in done or key in seen:
+            continue
+        if key in failed and not retry_failed:
+            continue
+        pending.append(key)
+        seen.add(key)
+    log().debug('Crawling %s shows, %s already done', len(pending), len(done))
+
+    processes = processes or multiprocessing.cpu_count()
+    options = {
+        'processes': processes,
+        'store': store,
+        'languages': languages,
+        'cache': cache,
+        'max_workers': max_workers,
+        'rate_limit': rate_limit,
+        'tvsubtitles': tvsubtitles or {},
+    }
+    # Results are appended to the log, the checkpoint is rewritten once
+    save_checkpoint(store, checkpoint)
+    journal = open(os.path.join(store, CHECKPOINT_LOG), 'a')
+    pool = multiprocessing.Pool(processes, _init_worker, (options,))
+    try:
+        for key, sid, count, error in pool.imap_unordered(_crawl, pending):
+            _record(checkpoint, key, sid, error)
+            journal.write(json.dumps([key, sid, error]) + '\n')
+            journal.flush()
+            if progress is not None:
+                progress(key, sid, count, error)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        journal.close()
+    save_checkpoint(store, checkpoint)
+    return checkpoint
+
+def main(argv = None):
+    parser = optparse.OptionParser(
+        usage = '%prog --store DIR [options] [show name or id...]')
+    parser.add_option('--store', help = 'directory receiving the shows and the checkpoint')
+    parser.add_option('--input', help = 'file listing show names or ids, one per line')
+    parser.add_option('--processes', type = 'int', help = 'number of processes '
+                      '(default: number of CPUs)')
+    parser.add_option('--threads', type = 'int', default = 1,
+                      help = 'threads loading the seasons of a show (default 1)')
+    parser.add_option('--languages', action = 'store_true', default = False,
+                      help = 'also load the subtitles of every episode')
+    parser.add_option('--cache', help = 'directory of a page cache shared by the processes')
+    parser.add_option('--backend', help = 'URL of a cache backend shared by the '
+                      'processes: sqlite:///path or redis://host:port/db')
+    parser.add_option('--rate-limit', type = 'float', default = 5.0,
+                      help = 'requests per second of all processes (default 5)')
+    parser.add_option('--retry-failed', action = 'store_true', default = False,
+                      help = 'retry the shows which failed in a previous run')
+    parser.add_option('--verbose', action = 'store_true', default = False,
+                      help = 'log requests and parsing')
+    opts, args = parser.parse_args(argv)
+    if not opts.store:
+        parser.error('--store is required')
+    keys = list(args)
+    if opts.input:
+        keys.extend(line.decode('utf-8') for line in open(opts.input))
+    if opts.verbose:
+        logging.basicConfig(level = logging.DEBUG)
+
+    started = time.time()
+    def progress(key, sid, count, error):
+        if error is None:
+            print "%s: show %s, %d episodes" % (key.encode('utf-8'), sid, count)
+        else:
+            print "%s: failed, %s" % (key.encode('utf-8'), error)
+        sys.stdout.flush()
+    tvsubtitles = {}
+    if opts.backend:
+        tvsubtitles['backend'] = opts.backend
+    checkpoint = crawl(keys, opts.store, opts.processes, opts.languages, opts.cache,
+                       opts.threads, opts.rate_limit or None, opts.retry_failed,
+                       tvsubtitles, progress = progress)
+    print "%d shows crawled, %d failed, in %.1fs" % (
+        len(checkpoint['done']), len(checkpoint['failed']), time.time() - started)
+    return 1 if checkpoint['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# encoding: utf-8
+#       download.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Download of the subtitles listed by EpisodeParser.
+
+>>> episode = t['scrubs'][1][1]
+>>> downloader = SubtitleDownloader(t, 'subtitles/')
+>>> downloader.download(episode['languages']['en'][0])
+[{'name': u'Scrubs - 1x01 - My First Day.en.srt', 'digest': '2f1d...',
+  'path': 'subtitles/2f/2f1d....srt', 'size': 31024, 'url': ...}]
+
+Archives are streamed to a temporary file in chunks, then the files of
+zip archives are copied to a SubtitleStore. Files are stored under the
+sha1 of their content, a subtitle found in several archives is stored
+once.
+"""
+import os
+import re
+import errno
+import socket
+import hashlib
+import zipfile
+import tempfile
+import urlparse
+
+from api import threaded_imap, log
+from atomicfile import write_atomic
+from scheduler import HostSlots
+from tvsubtitles_exceptions import tvsubtitles_error
+
+__all__ = ['SubtitleStore', 'SubtitleDownloader']
+
+_filename = re.compile(r'filename\s*=\s*"?([^";]+)"?', re.I)
+
+class SubtitleStore:
+    """Content addressed files: a file is stored once, as
+    location/ab/abcdef...ext, ab... being the sha1 of its content
+    """
+    def __init__(self, location):
+        self.location = location
+        if not os.path.isdir(location):
+            try:
+                os.makedirs(location)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def path(self, digest, ext = ''):
+        return os.path.join(self.location, digest[:2], digest + ext)
+
+    def __contains__(self, digest):
+        try:
+            names = os.listdir(os.path.join(self.location, digest[:2]))
+        except OSError:
+            return False
+        return any(os.path.splitext(name)[0] == digest for name in names)
+
+    def put(self, fileobj, ext = '', chunk_size = 64 * 1024):
+        """Copies fileobj to the store in chunks, returns its (digest,
+        path, size). Nothing is written if the content is stored already.
+        """
+        sha1 = hashlib.sha1()
+        size = [0]
+        def write(f):
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                size[0] += len(chunk)
+                f.write(chunk)
+        def commit(tmp):
+            digest = sha1.hexdigest()
+            path = self.path(digest, ext)
+            # Stored already, the temporary file is dropped
+            if not os.path.exists(path):
+                dirname = os.path.dirname(path)
+                if not os.path.isdir(dirname):
+                    try:
+                        os.makedirs(dirname)
+                    except OSError, e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                os.rename(tmp, path)
+            return digest, path, size[0]
+        return write_atomic(self.location, write, commit)
+
+class SubtitleDownloader:
+    """Downloads releases (dicts from episode['languages'][lang]) with the
+    urlopener, rate limiting and retries of a TvSubtitles instance.
+
+    max_workers downloads run at the same time, at most max_per_host of
+    them on the same host. With unzip, the files of zip archives are
+    stored instead of the archives.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, tvsubtitles, location, max_workers = 4, max_per_host = 2,
+                 unzip = True):
+        self.tvsubtitles = tvsubtitles
+        self.store = SubtitleStore(location)
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.unzip = unzip
+        self._host_slots = HostSlots(max_per_host)
+
+    def _spool(self, url):
+        """Streams url to a temporary file, returns (file, name given by
+        the server)
+        """
+        metrics = self.tvsubtitles.metrics
+        spool = tempfile.TemporaryFile(dir = self.store.location)
+        slot = self._host_slots.slot(url)
+        slot.acquire()
+        try:
+            try:
+                with metrics.timer('tvsubtitles_download_seconds'):
+                    resp = self.tvsubtitles._openUrl(url)
+                    try:
+                        disposition = resp.info().getheader('Content-Disposition') or ''
+                        final_url = resp.geturl()
+                        size = 0
+                        while True:
+                            chunk = resp.read(self.chunk_size)
+                            if not chunk:
+                                break
+                            size += len(chunk)
+                            spool.write(chunk)
+                    finally:
+                        resp.close()
+            except (IOError, socket.error), e:
+                spool.close()
+                raise tvsubtitles_error("Could not download %s: %s" % (url, e))
+            except:
+                spool.close()
+                raise
+        finally:
+            slot.release()
+        metrics.incr('tvsubtitles_download_bytes_total', size)
+        spool.seek(0)
+        match = _filename.search(disposition)
+        if match:
+            name = match.group(1).strip()
+        else:
+            name = os.path.basename(urlparse.urlsplit(final_url)[2])
+        return spool, name
+
+    def download(self, release):
+        """Downloads a release (or an URL), returns the list of stored
+        files as dicts with the url, name, digest, path and size keys
+        """
+        url = release
+        if isinstance(release, dict):
+            url = release['download_url']
+        log().debug('Downloading %s', url)
+        spool, name = self._spool(url)
+        try:
+            files = []
+            if self.unzip and zipfile.is_zipfile(spool):
+                spool.seek(0)
+                archive = zipfile.ZipFile(spool)
+                for info in archive.infolist():
+                    if info.filename.endswith('/'):
+                        continue
+                    member = archive.open(info)
+                    try:
+                        files.append(self._store(url, info.filename, member))
+                    finally:
+                        member.close()
+            else:
+                spool.seek(0)
+                files.append(self._store(url, name, spool))
+            return files
+        finally:
+            spool.close()
+
+    def _store(self, url, name, fileobj):
+        if isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+        name = os.path.basename(name.replace('\\', '/'))
+        ext = os.path.splitext(name)[1].lower()
+        if not re.match(r'^\.\w{1,5}$', ext):
+            ext = ''
+        digest, path, size = self.store.put(fileobj, ext, self.chunk_size)
+        return {'url': url, 'name': name, 'digest': digest, 'path': path, 'size': size}
+
+    def download_all(self, releases, max_workers = None):
+        """Downloads many releases at once. Returns, in order, a dict per
+        release with its url, its files (see download) and the error
+        message if it failed.
+        """
+        if max_workers is None:
+            max_workers = self.max_workers
+
+        def download(release):
+            url = release
+            if isinstance(release, dict):
+                url = release['download_url']
+            try:
+                return {'url': url, 'files': self.download(release), 'error': None}
+            except tvsubtitles_error, e:
+                log().debug('Download of %s failed: %s', url, e)
+                return {'url': url, 'files': [], 'error': str(e)}
+        return list(threaded_imap(download, releases, max_workers))
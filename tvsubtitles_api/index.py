@@ -0,0 +1,214 @@
+# encoding: utf-8
+#       index.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""Inverted index used by Show.search
+"""
+import re
+from array import array
+
+__all__ = ['SearchIndex']
+
+_token = re.compile(r'\w+', re.UNICODE)
+
+def index_value(value):
+    """Returns the lower case unicode string indexed for value, or None
+    if value is not searchable (LanguageGetter for example)
+    """
+    if isinstance(value, basestring):
+        return unicode(value).lower()
+    if isinstance(value, (int, long)):
+        return unicode(value)
+    if isinstance(value, (list, tuple)):
+        return u' '.join(unicode(v).lower() for v in value)
+    return None
+
+def matches(episode, term, key = None):
+    """Returns True if the key field (or any field) of episode contains
+    term, the way SearchIndex.search finds it
+    """
+    term = unicode(term).lower()
+    if key is not None:
+        key = unicode(key).lower()
+    for cur_key, value in episode.items():
+        if key is not None and unicode(cur_key).lower() != key:
+            continue
+        value = index_value(value)
+        if value is not None and term in value:
+            return True
+    return False
+
+class SearchIndex:
+    """Trigram and token index over the text fields of episodes.
+
+    Episodes are added field by field with add(), Show builds its index
+    on the first search and keeps it up to date afterwards. Substring
+    searches of text_fields intersect the trigram postings of the term
+    and check the remaining candidates. Terms shorter than a trigram and
+    the other fields (numbers, language lists), which are short, are
+    scanned. Postings are arrays of docids.
+    """
+    gram = 3
+    text_fields = frozenset([u'episodename'])
+
+    def __init__(self):
+        self._episodes = [] # docid -> episode
+        self._docids = {} # id(episode) -> docid
+        # key -> {docid: value}, lower case for text fields, else as given
+        self._values = {}
+        self._grams = {} # text key -> {gram: array of docids}
+        self._tokens = {} # text key -> {token: array of docids}
+
+    def __len__(self):
+        return len(self._docids)
+
+    def _grams_of(self, value):
+        n = self.gram
+        return set(value[i:i + n] for i in range(len(value) - n + 1))
+
+    def _docid(self, episode):
+        docid = self._docids.get(id(episode))
+        if docid is None:
+            docid = len(self._episodes)
+            self._docids[id(episode)] = docid
+            self._episodes.append(episode)
+        return docid
+
+    def add(self, episode, key, value):
+        """Indexes value as the key field of episode, replacing the value
+        previously indexed for this field
+        """
+        self.remove(episode, key)
+        if index_value(value) is None:
+            return
+        docid = self._docid(episode)
+        key = unicode(key).lower()
+        if key not in self.text_fields:
+            # Scanned, kept as is: converted on search
+            self._values.setdefault(key, {})[docid] = value
+            return
+        value = index_value(value)
+        self._values.setdefault(key, {})[docid] = value
+        for postings, items in ((self._grams, self._grams_of(value)),
+                                (self._tokens, set(_token.findall(value)))):
+            postings = postings.setdefault(key, {})
+            for item in items:
+                docids = postings.get(item)
+                if docids is None:
+                    docids = postings[item] = array('i')
+                docids.append(docid)
+
+    def remove(self, episode, key):
+        """Removes the key field of episode from the index
+        """
+        docid = self._docids.get(id(episode))
+        if docid is None:
+            return
+        key = unicode(key).lower()
+        values = self._values.get(key, {})
+        value = values.pop(docid, None)
+        if value is None:
+            return
+        if not values:
+            del self._values[key]
+        if not any(docid in values for values in self._values.itervalues()):
+            # Last field of the episode, forget it
+            del self._docids[id(episode)]
+            self._episodes[docid] = None
+        if key not in self.text_fields:
+            return
+        for postings, items in ((self._grams, self._grams_of(value)),
+                                (self._tokens, set(_token.findall(value)))):
+            postings = postings.get(key, {})
+            for item in items:
+                docids = postings.get(item)
+                if docids is not None and docid in docids:
+                    docids.remove(docid)
+                    if not docids:
+                        del postings[item]
+
+    def _keys(self, key):
+        if key is not None:
+            return [unicode(key).lower()]
+        return list(self._values)
+
+    def _results(self, docids):
+        seasons = self._values.get(u'seasonnumber', {})
+        numbers = self._values.get(u'episodenumber', {})
+        def order(docid):
+            try:
+                return (int(seasons.get(docid, 0)), int(numbers.get(docid, 0)), docid)
+            except ValueError:
+                return (0, 0, docid)
+        return [self._episodes[docid] for docid in sorted(docids, key = order)]
+
+    def _intersect(self, postings, items):
+        """Returns the set of docids found in the postings of every item
+        """
+        lists = sorted((postings.get(item, ()) for item in items), key = len)
+        candidates = set(lists[0])
+        for docids in lists[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(docids)
+        return candidates
+
+    def search(self, term, key = None):
+        """Returns the episodes whose key field (or any field) contains
+        term, ordered by season and episode number
+        """
+        if term == None:
+            raise TypeError("must supply string to search for (contents)")
+        term = unicode(term).lower()
+        found = set()
+        for cur_key in self._keys(key):
+            values = self._values.get(cur_key, {})
+            if cur_key not in self.text_fields:
+                for docid, value in values.iteritems():
+                    if docid not in found and term in index_value(value):
+                        found.add(docid)
+                continue
+            if len(term) >= self.gram:
+                candidates = self._intersect(self._grams.get(cur_key, {}),
+                                             self._grams_of(term))
+            else:
+                candidates = values
+            for docid in candidates:
+                if docid not in found and term in values[docid]:
+                    found.add(docid)
+        return self._results(found)
+
+    def search_tokens(self, term, key = None):
+        """Returns the episodes whose key field (or any field) contains
+        every word of term as a whole word
+        """
+        if term == None:
+            raise TypeError("must supply string to search for (contents)")
+        tokens = _token.findall(unicode(term).lower())
+        found = set()
+        if not tokens:
+            return []
+        for cur_key in self._keys(key):
+            if cur_key in self.text_fields:
+                found.update(self._intersect(self._tokens.get(cur_key, {}), tokens))
+                continue
+            for docid, value in self._values.get(cur_key, {}).iteritems():
+                if set(tokens).issubset(_token.findall(index_value(value))):
+                    found.add(docid)
+        return self._results(found)
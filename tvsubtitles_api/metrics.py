@@ -0,0 +1,179 @@
+# encoding: utf-8
+#       metrics.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""Counters and timers collected on the hot paths of tvsubtitles_api.
+
+Each TvSubtitles instance has a Metrics registry in its metrics
+attribute:
+
+>>> t = TvSubtitles()
+>>> t.metrics.add_listener(lambda kind, name, value, labels: ...)
+>>> print t.metrics.prometheus()
+# TYPE tvsubtitles_cache_total counter
+tvsubtitles_cache_total{result="hit",tier="raw"} 12
+...
+
+Collected metrics:
+    tvsubtitles_http_seconds{phase, host}: dns, connect, wait (time to
+        first byte) and transfer time of requests sent by KeepAliveHandler
+    tvsubtitles_http_bytes_total{host}: bytes received, before decompression
+    tvsubtitles_fetch_seconds{page}: time spent by _loadPage on the network
+    tvsubtitles_decode_seconds{method}: decode_html time
+    tvsubtitles_parse_seconds{parser}: lxml tree building time (decoding
+        included with fast_parse), then parse time per parser class
+    tvsubtitles_cache_total{tier, result}: raw and parsed cache lookups
+"""
+import threading
+import timeit
+
+__all__ = ['Metrics']
+
+timer = timeit.default_timer
+
+class _Timer:
+    """Context manager recording its duration in a Metrics registry
+    """
+    def __init__(self, metrics, name, labels):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.started = timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, timer() - self.started, **self.labels)
+
+class Metrics:
+    """Registry of counters and timers, identified by a name and labels.
+
+    Listeners added with add_listener are called for each update with
+    (kind, name, value, labels), kind being 'counter' or 'timer'.
+    """
+    def __init__(self):
+        self._counters = {}
+        self._timers = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        self._listeners.remove(fn)
+
+    def _notify(self, kind, name, value, labels):
+        for fn in self._listeners:
+            fn(kind, name, value, labels)
+
+    def incr(self, name, value = 1, **labels):
+        """Adds value to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            self._counters[key] = self._counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+        if self._listeners:
+            self._notify('counter', name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration in seconds
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self._lock.acquire()
+        try:
+            stats = self._timers.get(key)
+            if stats is None:
+                stats = self._timers[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        finally:
+            self._lock.release()
+        if self._listeners:
+            self._notify('timer', name, seconds, labels)
+
+    def timer(self, name, **labels):
+        """Returns a context manager timing its block:
+
+        >>> with metrics.timer('tvsubtitles_parse_seconds', parser = 'TvSowParser'):
+        ...     parser.parse()
+        """
+        return _Timer(self, name, labels)
+
+    def counter(self, name, **labels):
+        """Current value of a counter
+        """
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def timing(self, name, **labels):
+        """Returns a dict with the count, total and max of a timer
+        """
+        stats = self._timers.get((name, tuple(sorted(labels.items()))), (0, 0.0, 0.0))
+        return {'count': stats[0], 'total': stats[1], 'max': stats[2]}
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._counters.clear()
+            self._timers.clear()
+        finally:
+            self._lock.release()
+
+    def prometheus(self):
+        """Returns every metric in the Prometheus text exposition format,
+        timers are exposed as summaries (_count and _sum) and their longest
+        observation as a _max gauge
+        """
+        def fmt(labels):
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                     .replace('"', '\\"')) for k, v in labels)
+
+        self._lock.acquire()
+        try:
+            counters = sorted(self._counters.items())
+            timers = sorted((key, list(stats)) for key, stats in self._timers.items())
+        finally:
+            self._lock.release()
+
+        lines = []
+        maxima = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, fmt(labels), value))
+        for (name, labels), (count, total, biggest) in timers:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s summary' % name)
+            lines.append('%s_count%s %d' % (name, fmt(labels), count))
+            lines.append('%s_sum%s %.6f' % (name, fmt(labels), total))
+            if not maxima or maxima[-1][0] != name:
+                maxima.append((name, []))
+            maxima[-1][1].append('%s_max%s %.6f' % (name, fmt(labels), biggest))
+        for name, values in maxima:
+            lines.append('# TYPE %s_max gauge' % name)
+            lines.extend(values)
+        return '\n'.join(lines) + '\n'
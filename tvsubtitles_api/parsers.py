@@ -20,8 +20,60 @@
 import re
 import datetime
 
-__all__ = ['TvShowSearchParser','TvSowParser','EpisodeParser']
+__all__ = ['TvShowSearchParser','TvSowParser','EpisodeParser', 'content_document']
+
+# Parsed data only holds plain strings: text_content() returns "smart"
+# strings keeping the whole document alive, and cached results are
+# stored as JSON
+
+class _XPath(object):
+    """XPath expression compiled once, on first use. lxml is imported
+    then, not when the parsers are imported.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._xpath = None
+
+    def __call__(self, doc):
+        if self._xpath is None:
+            from lxml import etree
+            self._xpath = etree.XPath(self.path)
+        return self._xpath(doc)
+
+_search_results = _XPath('/html/body/div/div[3]/div/ul')
+_show_name = _XPath('/html/body/div/div[3]/div/h2')
+_show_seasons = _XPath('/html/body/div/div[3]/div/p')
+_show_episodes = _XPath('//table[@id="table5"]')
+_episode_subtitles = _XPath('//div[@class="subtitlen"]')
+# Every parser only reads the content box of the page
+_content_box = _XPath('/html/body/div/div[3]/div')
+
+def content_document(html_string, encoding, chunk_size = 4096):
+    """Parses html_string, bytes in encoding, up to the end of the
+    content box read by the parsers: the rest of the page is not parsed.
+    Returns the root of the partial document, or None if the content box
+    was not found.
+    """
+    from lxml import etree, html
+    parser = etree.HTMLPullParser(events = ('end',), tag = 'div', encoding = encoding)
+    # Elements with text_content(), as built by lxml.html
+    parser.set_element_class_lookup(html.HtmlElementClassLookup())
+    for start in xrange(0, len(html_string), chunk_size):
+        parser.feed(html_string[start:start + chunk_size])
+        for event, elem in parser.read_events():
+            # The content box is a div nested in two others
+            parent = elem.getparent()
+            if parent is None or parent.tag != 'div' or parent.getparent().tag != 'div':
+                continue
+            root = elem.getroottree().getroot()
+            boxes = _content_box(root)
+            if boxes and boxes[0] is elem:
+                return root
+    return None
+
 class TvShowSearchParser:
+    # Bump when the parsed output changes, invalidates cached results
+    version = 2
         
     def __init__(self, doc):
         self.doc = doc
@@ -31,7 +83,7 @@ class TvShowSearchParser:
         Return search result:
         [ {'name': , 'link': ,  'id': , 'languages': , }, ...]
         """
-        res_list = self.doc.xpath('/html/body/div/div[3]/div/ul')[0]
+        res_list = _search_results(self.doc)[0]
         data = []
         for li in res_list.iterchildren():
             data.append(self.parse_li(li.getchildren()[0]))
@@ -48,12 +100,13 @@ class TvShowSearchParser:
         for ele in li.iterchildren():
             if ele.tag == 'a':
                 data['id'] = re.findall(r"\d+", ele.get('href'))[0]
-                data['name'] = ele.text_content()
+                data['name'] = unicode(ele.text_content())
             elif ele.tag == 'img':
                 data['languages'].append(ele.get('alt'))
         return data
 
 class TvSowParser:
+    version = 2
         
     def __init__(self, doc):
         self.doc = doc
@@ -67,10 +120,10 @@ class TvSowParser:
             * known_season  [1, 2, ...]
         """
         data = {}
-        data['name'] = self.doc.xpath('/html/body/div/div[3]/div/h2')[0].text_content()
-        p = self.doc.xpath('/html/body/div/div[3]/div/p')[0]
+        data['name'] = unicode(_show_name(self.doc)[0].text_content())
+        p = _show_seasons(self.doc)[0]
         cur, other_seasons = self.parse_seasons(p)
-        table = self.doc.xpath('//table[@id="table5"]')[0]
+        table = _show_episodes(self.doc)[0]
         episodes = self.parse_ep(table)
         data['seasons'] = {cur: episodes}
         data['other_seasons'] = other_seasons
@@ -104,7 +157,7 @@ class TvSowParser:
             ep['num'] = int(td[0].text_content().split('x')[1])
             a = td[1].find('a')
             ep['id'] = int(re.findall(r"\d+", a.get('href'))[0])
-            ep['name'] = a.text_content()
+            ep['name'] = unicode(a.text_content())
             ep['lang'] = []
             for ele in td[3].find('nobr'):
                 if ele.tag == 'a':
@@ -113,6 +166,8 @@ class TvSowParser:
         return episodes
 
 class EpisodeParser:
+    version = 2
+
     def __init__(self, doc):
         self.doc = doc
     
@@ -132,7 +187,7 @@ class EpisodeParser:
         }
         """
         data = {}
-        divs = self.doc.xpath('//div[@class="subtitlen"]')
+        divs = _episode_subtitles(self.doc)
         for div in divs:
             release = {}
             release['download_url']= 'http://www.tvsubtitles.net'+ div.getparent().get('href')
@@ -140,13 +195,16 @@ class EpisodeParser:
             for ele in div.iterchildren():
                 if ele.tag == 'div':
                     ele = ele.find('span')
+                    if ele is None:
+                        # Not rated yet
+                        continue
                     for span in ele.findall('span'):
                         if span.get('style') == 'color:red':
                             release['bad'] = int(span.text_content())
                         if span.get('style')== 'color:green':
                             release['good'] = int(span.text_content())
                 if ele.tag == 'h5':
-                    release['name'] = ele.text_content()
+                    release['name'] = unicode(ele.text_content())
                     lang = ele.find('img').get('src').split('/')[-1].split('.')[0]
                 if ele.tag == 'p':
                     if ele.get('title') == 'rip':
@@ -168,7 +226,7 @@ class EpisodeParser:
         return self.sort_by_rate(data)
 
     def sort_by_rate(self,data):
-    	"""Sorting subtitles by rate"""
-	for lang,list_sub in data.items():
-		data[lang] = sorted(list_sub, key=lambda k: k['good'], reverse=True) 
-    	return data
+        """Sorting subtitles by rate, releases without rating last"""
+        for lang,list_sub in data.items():
+            data[lang] = sorted(list_sub, key=lambda k: k.get('good', 0), reverse=True)
+        return data
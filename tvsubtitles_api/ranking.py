@@ -0,0 +1,201 @@
+# encoding: utf-8
+#       ranking.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Batched fuzzy ranking of show names with the dice coefficient of
+their bigrams (the same score as api.dice_coefficient).
+
+>>> ranker = BigramRanker([u'scrubs', u'lost', u'the office'])
+>>> ranker.top(u'scrub', k = 2)
+[(0.888..., 0)]
+
+The bigrams of the names are computed once. The postings of the query
+bigrams are counted with numpy when it is installed, in pure Python
+otherwise.
+"""
+import heapq
+
+# numpy is imported by the first BigramRanker, see _numpy
+numpy = None
+_numpy_checked = False
+
+__all__ = ['bigrams', 'dice_scores', 'rank', 'BigramRanker']
+
+_cache = {}
+_cache_size = 10000
+
+def _numpy():
+    """Imports numpy on first call, returns it or None if it is not
+    installed
+    """
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_checked = True
+    return numpy
+
+def bigrams(name):
+    """Set of the bigrams of name, a single character is padded with a
+    dot. Results are cached.
+    """
+    grams = _cache.get(name)
+    if grams is None:
+        if len(_cache) >= _cache_size:
+            _cache.clear()
+        padded = name
+        if len(name) == 1:
+            padded = name + u'.'
+        grams = _cache[name] = frozenset(
+            padded[i:i + 2] for i in range(len(padded) - 1))
+    return grams
+
+def dice_scores(term, names):
+    """Returns the list of the dice coefficients of term and each name
+    """
+    query = bigrams(term)
+    if not query:
+        return [0.0] * len(names)
+    scores = []
+    for name in names:
+        grams = bigrams(name)
+        if grams:
+            scores.append(len(query & grams) * 2.0 / (len(query) + len(grams)))
+        else:
+            scores.append(0.0)
+    return scores
+
+def rank(term, names):
+    """Returns the indexes of names, best match of term first. Names
+    scoring the same keep their order.
+    """
+    scores = dice_scores(term, names)
+    return sorted(range(len(names)), key = scores.__getitem__, reverse = True)
+
+class BigramRanker:
+    """Index of names, scoring a query against all of them at once.
+    Names are identified by their index in self.names.
+
+    use_numpy defaults to True when numpy is installed.
+    """
+    def __init__(self, names = (), use_numpy = None):
+        if use_numpy is None or use_numpy:
+            use_numpy = _numpy() is not None
+        self.use_numpy = use_numpy
+        self.names = []
+        self._sizes = [] # index -> number of bigrams
+        self._postings = {} # bigram -> list of indexes
+        self._arrays = {} # bigram -> numpy array of the postings
+        self._size_array = None
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        """Adds name, returns its index
+        """
+        index = len(self.names)
+        grams = bigrams(name)
+        self.names.append(name)
+        self._sizes.append(len(grams))
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(index)
+            self._arrays.pop(gram, None)
+        if self._size_array is not None:
+            if index >= len(self._size_array):
+                self._size_array = numpy.concatenate(
+                    (self._size_array, numpy.zeros(len(self._size_array) + 1)))
+            self._size_array[index] = len(grams)
+        return index
+
+    def _counts(self, query):
+        """Returns {index: number of query bigrams in the name}
+        """
+        counts = {}
+        get = counts.get
+        for gram in query:
+            for index in self._postings.get(gram, ()):
+                counts[index] = get(index, 0) + 1
+        return counts
+
+    def _numpy_scores(self, query):
+        n = len(self.names)
+        if self._size_array is None:
+            self._size_array = numpy.array(self._sizes + [0] * n, dtype = float)
+        arrays = []
+        for gram in query:
+            postings = self._arrays.get(gram)
+            if postings is None:
+                if gram not in self._postings:
+                    continue
+                postings = self._arrays[gram] = numpy.array(
+                    self._postings[gram], dtype = numpy.intp)
+            arrays.append(postings)
+        if not arrays:
+            return numpy.zeros(n)
+        counts = numpy.bincount(numpy.concatenate(arrays), minlength = n)
+        return counts * 2.0 / (len(query) + self._size_array[:n])
+
+    def scores(self, term):
+        """Returns the dice coefficient of term and each name, as a list
+        or a numpy array
+        """
+        query = bigrams(term)
+        if not query or not self.names:
+            return [0.0] * len(self.names)
+        if self.use_numpy:
+            return self._numpy_scores(query)
+        scores = [0.0] * len(self.names)
+        sizes = self._sizes
+        for index, count in self._counts(query).iteritems():
+            scores[index] = count * 2.0 / (len(query) + sizes[index])
+        return scores
+
+    def top(self, term, k = 10):
+        """Returns the k best matches of term as (score, index) tuples,
+        best first. Names sharing no bigram with term are left out.
+        """
+        query = bigrams(term)
+        if not query or not self.names or k < 1:
+            return []
+        order = lambda match: (-match[0], match[1])
+        if self.use_numpy:
+            scores = self._numpy_scores(query)
+            n = len(scores)
+            if n > k:
+                # k-th best score, names scoring the same are taken by index
+                kth = scores[numpy.argpartition(scores, n - k)[n - k]]
+                candidates = numpy.flatnonzero(scores > kth)
+                ties = numpy.flatnonzero(scores == kth)[:k - len(candidates)]
+                candidates = numpy.concatenate((candidates, ties))
+            else:
+                candidates = numpy.arange(n)
+            matches = [(float(scores[index]), int(index)) for index in candidates
+                       if scores[index] > 0]
+            return sorted(matches, key = order)
+        sizes = self._sizes
+        total = len(query)
+        return heapq.nsmallest(k, ((count * 2.0 / (total + sizes[index]), index)
+                               for index, count in self._counts(query).iteritems()),
+                               key = order)
@@ -0,0 +1,265 @@
+# encoding: utf-8
+#       scheduler.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""Throttling, retries and circuit breaking of the requests sent by
+TvSubtitles
+"""
+import time
+import random
+import logging
+import threading
+import urlparse
+
+from tvsubtitles_exceptions import tvsubtitles_error
+
+__all__ = ['RetryableError', 'HostError', 'TokenBucket', 'HostSlots', 'RequestScheduler']
+
+def log():
+    return logging.getLogger("tvsubtitles_api")
+
+class RetryableError(Exception):
+    """Raised by a scheduled call when it failed in a way worth retrying
+    (connection error, 503...). retry_after is the delay in seconds asked
+    by the server, or None.
+    """
+    def __init__(self, message, retry_after = None):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+class HostError(tvsubtitles_error):
+    """Raised by a scheduled call when the host failed but the request
+    must not be sent again (POST...): counts as a failure of the host
+    without being retried
+    """
+
+def parse_retry_after(value, now = None):
+    """Returns the delay in seconds of a Retry-After header, given in
+    seconds or as an HTTP date, or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    import email.utils
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, email.utils.mktime_tz(date) - now)
+
+class TokenBucket:
+    """Allows rate calls per second on average, and bursts of burst calls
+    """
+    def __init__(self, rate, burst = 1, clock = time.time, sleep = time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for it if needed. Returns the time waited
+        """
+        wait = self.reserve()
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def reserve(self):
+        """Takes a token without waiting, returns the seconds to wait
+        before using it
+        """
+        self._lock.acquire()
+        try:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Taking the token now reserves it, even if it is not there yet
+            self.tokens -= 1
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+        finally:
+            self._lock.release()
+        return wait
+
+class HostSlots:
+    """Limits the connections open to each host to limit: slot(url)
+    returns the BoundedSemaphore of the host of url
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url):
+        host = urlparse.urlsplit(url)[1]
+        self._lock.acquire()
+        try:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.limit)
+            return self._slots[host]
+        finally:
+            self._lock.release()
+
+class _HostState:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.failures = 0
+        self.last_failure = None
+        self.probing = False # a request is checking whether the host is back
+        self.lock = threading.Lock()
+
+class RequestScheduler:
+    """Runs the requests of TvSubtitles, per host:
+
+    * at most rate requests per second (token bucket allowing bursts of
+      burst requests), rate None disables throttling
+    * calls raising RetryableError are retried up to retries times, with
+      an exponential backoff (backoff * 2 ** attempt seconds, at most
+      max_backoff) and full jitter, or after the Retry-After delay given
+      by the server
+    * after failure_threshold failed requests in a row, the circuit of the
+      host opens: requests fail immediately with tvsubtitles_error until
+      reset_timeout seconds have passed since the last failure. A single
+      request is then let through, its success closes the circuit.
+    """
+    def __init__(self, rate = 5.0, burst = 10, retries = 3, backoff = 0.5,
+                 max_backoff = 30.0, max_retry_after = 120.0,
+                 failure_threshold = 5, reset_timeout = 60.0,
+                 clock = time.time, sleep = time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._sleep = sleep
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _state(self, host):
+        self._lock.acquire()
+        try:
+            state = self._hosts.get(host)
+            if state is None:
+                bucket = None
+                if self.rate:
+                    bucket = TokenBucket(self.rate, self.burst, self._clock, self._sleep)
+                state = self._hosts[host] = _HostState(bucket)
+            return state
+        finally:
+            self._lock.release()
+
+    def is_open(self, host):
+        """True if requests to host are currently refused
+        """
+        state = self._state(host)
+        state.lock.acquire()
+        try:
+            return (state.failures >= self.failure_threshold
+                    and (state.probing or
+                         self._clock() - state.last_failure < self.reset_timeout))
+        finally:
+            state.lock.release()
+
+    def last_failure(self, host):
+        """Time of the last failed request to host, or None
+        """
+        return self._state(host).last_failure
+
+    def _admit(self, host, state):
+        """Returns True if the request is the probe of a circuit open for
+        long enough, raises tvsubtitles_error if the circuit is open
+        """
+        state.lock.acquire()
+        try:
+            if state.failures < self.failure_threshold:
+                return False
+            if (not state.probing and
+                    self._clock() - state.last_failure >= self.reset_timeout):
+                state.probing = True
+                return True
+        finally:
+            state.lock.release()
+        raise tvsubtitles_error("Could not connect to server: too many "
+            "failures, %s is blocked for %ds after the last one" % (
+            host, self.reset_timeout))
+
+    def _done(self, state, probe, failed):
+        """Records the outcome of a request, failed is None when it does
+        not tell whether the host works
+        """
+        state.lock.acquire()
+        try:
+            if failed:
+                state.failures += 1
+                state.last_failure = self._clock()
+            elif failed is not None:
+                state.failures = 0
+            if probe:
+                state.probing = False
+        finally:
+            state.lock.release()
+
+    def delay(self, attempt, retry_after = None):
+        """Seconds to wait before retry number attempt (starting at 0)
+        """
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, host, fn):
+        """Returns fn(), scheduled and retried as described above
+        """
+        state = self._state(host)
+        attempt = 0
+        while True:
+            probe = self._admit(host, state)
+            try:
+                if state.bucket is not None:
+                    state.bucket.acquire()
+                result = fn()
+            except RetryableError, e:
+                self._done(state, probe, True)
+                if attempt >= self.retries:
+                    raise tvsubtitles_error("Could not connect to server: %s" % (e))
+                delay = self.delay(attempt, e.retry_after)
+                log().debug("Request to %s failed (%s), retrying in %.1fs",
+                            host, e, delay)
+                self._sleep(delay)
+                attempt += 1
+                continue
+            except HostError:
+                self._done(state, probe, True)
+                raise
+            except:
+                # Not a failure of the host, let the next request probe it
+                self._done(state, probe, None)
+                raise
+            self._done(state, probe, False)
+            return result
@@ -0,0 +1,218 @@
+# encoding: utf-8
+#       selection.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Choice of the subtitles matching video files.
+
+>>> parse_filename('Scrubs.S01E01.720p.HDTV.x264-LOL.mkv')['group']
+'lol'
+>>> selector = ReleaseSelector(t['scrubs'][1][1]['languages']['en'])
+>>> selector.best('Scrubs.S01E01.720p.HDTV.x264-LOL.mkv')['release']
+'Scrubs.S01E01.720p.HDTV.x264-LOL'
+
+Releases are scored by a weighted sum of how well their name matches the
+file (release group, source, resolution, other tokens), their good/bad
+ratings and how many times they were downloaded, see WEIGHTS.
+"""
+import os
+import re
+import math
+
+from api import threaded_imap, log
+from tvsubtitles_exceptions import tvsubtitles_exception
+
+__all__ = ['WEIGHTS', 'parse_filename', 'parse_release', 'ReleaseSelector', 'select']
+
+WEIGHTS = {
+    'group': 4.0,
+    'source': 2.0,
+    'resolution': 1.0,
+    'tokens': 1.0,
+    'rating': 1.0,
+    'downloaded': 0.5,
+}
+
+VIDEO_EXTENSIONS = ('.avi', '.mkv', '.mp4', '.m4v', '.mpg', '.mpeg', '.ogm',
+                    '.ts', '.wmv', '.divx')
+
+SOURCES = {
+    'hdtv': 'hdtv', 'pdtv': 'hdtv', 'dsr': 'hdtv', 'tvrip': 'hdtv',
+    'dvdrip': 'dvd', 'dvd': 'dvd', 'dvdscr': 'dvd',
+    'bdrip': 'bluray', 'brrip': 'bluray', 'bluray': 'bluray',
+    'webdl': 'web', 'webrip': 'web', 'web': 'web',
+}
+
+_joined = re.compile(r'(web|blu)[ ._-]?(dl|rip|ray)')
+_split = re.compile(r'[^a-z0-9]+')
+_resolution = re.compile(r'^(\d{3,4})[pi]$')
+_group = re.compile(r'-([a-z0-9]+)(?:\[[^\]]*\])?$')
+_episode = (re.compile(r'^(.*?)[ ._-]*s(\d{1,2})[ ._-]?e(\d{1,3})(?!\d)'),
+            re.compile(r'^(.*?)[ ._-]*(\d{1,2})x(\d{2,3})(?!\d)'))
+
+def _parse(name):
+    """Returns the group, source, resolution and set of other tokens of a
+    release name
+    """
+    name = _joined.sub(r'\1\2', name.lower())
+    group = None
+    match = _group.search(name)
+    if match:
+        group = match.group(1)
+    source = resolution = None
+    tokens = set()
+    for token in _split.split(name):
+        if not token:
+            continue
+        if token in SOURCES:
+            source = source or SOURCES[token]
+        elif _resolution.match(token):
+            resolution = resolution or token[:-1] + 'p'
+        tokens.add(token)
+    return group, source, resolution, frozenset(tokens)
+
+def parse_filename(filename):
+    """Returns the tokens of a video file name as a dict with the show,
+    season, episode, group, source, resolution and tokens keys. show,
+    season and episode are None if the name does not give them.
+    """
+    name = os.path.basename(filename)
+    base, ext = os.path.splitext(name)
+    if ext.lower() in VIDEO_EXTENSIONS:
+        name = base
+    group, source, resolution, tokens = _parse(name)
+    info = {'show': None, 'season': None, 'episode': None, 'group': group,
+            'source': source, 'resolution': resolution, 'tokens': tokens}
+    lowered = name.lower()
+    for pattern in _episode:
+        match = pattern.match(lowered)
+        if match:
+            info['show'] = _split.sub(' ', match.group(1)).strip() or None
+            info['season'] = int(match.group(2))
+            info['episode'] = int(match.group(3))
+            break
+    return info
+
+def parse_release(release):
+    """Tokens of a release dict made by EpisodeParser, as parse_filename
+    without the show, season and episode. The rip field gives the source
+    when the release name does not.
+    """
+    group, source, resolution, tokens = _parse(release.get('release') or '')
+    if source is None and release.get('rip'):
+        source = _parse(release['rip'])[1]
+    return {'group': group, 'source': source, 'resolution': resolution,
+            'tokens': tokens}
+
+class ReleaseSelector:
+    """Scores the releases of an episode against video files. Releases
+    are tokenized once, when the selector is built.
+    """
+    def __init__(self, releases, weights = None):
+        self.weights = dict(WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        most = max([release.get('downloaded', 0) for release in releases] + [0])
+        w = self.weights
+        self._releases = []
+        for release in releases:
+            good, bad = release.get('good', 0), release.get('bad', 0)
+            # Bayesian average, an unrated release counts as 1 good, 1 bad
+            base = w['rating'] * (good + 1.0) / (good + bad + 2.0)
+            if most:
+                base += (w['downloaded'] * math.log1p(release.get('downloaded', 0))
+                         / math.log1p(most))
+            info = parse_release(release)
+            self._releases.append((base, info['group'], info['source'],
+                                   info['resolution'], info['tokens'], release))
+
+    def __len__(self):
+        return len(self._releases)
+
+    def scores(self, video):
+        """Returns the (score, release) pairs of the releases, best first.
+        video is a file name or a dict made by parse_filename.
+        """
+        if isinstance(video, basestring):
+            video = parse_filename(video)
+        w = self.weights
+        group, source, resolution = video['group'], video['source'], video['resolution']
+        tokens = video['tokens']
+        scored = []
+        for position, (base, r_group, r_source, r_resolution, r_tokens,
+                       release) in enumerate(self._releases):
+            score = base
+            if group is not None and group == r_group:
+                score += w['group']
+            if source is not None and source == r_source:
+                score += w['source']
+            if resolution is not None and resolution == r_resolution:
+                score += w['resolution']
+            if tokens and r_tokens:
+                score += w['tokens'] * len(tokens & r_tokens) / float(len(tokens | r_tokens))
+            scored.append((-score, position, release))
+        scored.sort()
+        return [(-score, release) for score, position, release in scored]
+
+    def best(self, video):
+        """Best release for video, or None if there is no release
+        """
+        if not self._releases:
+            return None
+        return self.scores(video)[0][1]
+
+def select(tvsubtitles, filenames, language = 'en', max_workers = 4, weights = None):
+    """Returns the best release in language for every file name, or None
+    when the episode or its subtitles cannot be found. Only the season
+    and episode pages of the files are loaded, with max_workers threads,
+    and the releases of an episode are tokenized once for the whole
+    batch.
+    """
+    videos = [parse_filename(filename) for filename in filenames]
+
+    def load_sid(name):
+        try:
+            return tvsubtitles._nameToSid(name, load = False)
+        except tvsubtitles_exception, e:
+            log().debug('No show for %r: %s', name, e)
+            return None
+    names = sorted(set(video['show'] for video in videos if video['show']))
+    sids = dict(zip(names, threaded_imap(load_sid, names, max_workers)))
+
+    def load_selector(key):
+        # Only the season page of the episode is fetched
+        name, season, number = key
+        try:
+            subtitles = tvsubtitles.episode(sids[name], season, number)['languages'].load()
+        except tvsubtitles_exception, e:
+            log().debug('No subtitles for %dx%02d of %r: %s', season, number, name, e)
+            return None
+        return ReleaseSelector(subtitles.get(language, []), weights)
+    keys = sorted(set((video['show'], video['season'], video['episode'])
+                      for video in videos if sids.get(video['show']) is not None))
+    selectors = dict(zip(keys, threaded_imap(load_selector, keys, max_workers)))
+
+    best = []
+    for video in videos:
+        selector = selectors.get((video['show'], video['season'], video['episode']))
+        if selector is None:
+            best.append(None)
+        else:
+            best.append(selector.best(video))
+    return best
@@ -0,0 +1,99 @@
+# encoding: utf-8
+#       serialize.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""JSON serialization of the cached entries and backend values.
+
+Cache entries are read from files and servers other processes can
+write to, so they are never unpickled. Values are made of dicts, lists,
+strings, numbers and dates. Byte strings that are not ASCII, dates and
+dicts whose keys are not all strings are stored as tagged JSON objects.
+ASCII strings are loaded as str, other text as unicode.
+
+>>> dumps({'body': '\\xff', 'seasons': {1: []}})
+'{"body":{"$bytes":"/w=="},"seasons":{"$dict":[[1,[]]]}}'
+"""
+import json
+import base64
+import datetime
+import binascii
+
+__all__ = ['dumps', 'loads']
+
+_date_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _isascii(value):
+    try:
+        value.decode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+def _encode(value):
+    if isinstance(value, str):
+        if _isascii(value):
+            return value
+        return {'$bytes': base64.b64encode(value)}
+    if value is None or isinstance(value, (unicode, bool, int, long, float)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.strftime(_date_format)}
+    if isinstance(value, dict):
+        if all(isinstance(key, unicode) or isinstance(key, str) and _isascii(key)
+               for key in value):
+            return dict((key, _encode(item)) for key, item in value.iteritems())
+        return {'$dict': [[_encode(key), _encode(item)]
+                          for key, item in value.iteritems()]}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    raise TypeError("Cannot serialize %r" % (value,))
+
+def _decode(value):
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        tag, data = value.items()[0]
+        if tag == '$bytes':
+            return base64.b64decode(data)
+        if tag == '$datetime':
+            return datetime.datetime.strptime(data, _date_format)
+        if tag == '$dict':
+            return dict((_decode(key), _decode(item)) for key, item in data)
+    return dict((_decode(key), _decode(item)) for key, item in value.iteritems())
+
+def dumps(value):
+    """Returns value as a JSON string
+    """
+    return json.dumps(_encode(value), separators = (',', ':'), sort_keys = True)
+
+def loads(data):
+    """Returns the value of a string made by dumps. Raises ValueError if
+    data is not valid.
+    """
+    try:
+        return _decode(json.loads(data))
+    except (TypeError, KeyError, AttributeError, binascii.Error), e:
+        raise ValueError("Invalid serialized value: %s" % e)
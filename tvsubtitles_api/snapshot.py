@@ -0,0 +1,290 @@
+# encoding: utf-8
+#       snapshot.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+"""Binary snapshots of the shows loaded by TvSubtitles.
+
+>>> t.dump_snapshot('shows.snap')
+>>> t = TvSubtitles()
+>>> t.load_snapshot('shows.snap')
+>>> t['scrubs'][1][1]['languages']['en'] # no request if it was loaded
+
+Layout of a snapshot file, integers are little endian:
+
+    header      magic, version, number of shows, offsets of the tables
+    blobs       one pickled blob per show: show data, episode fields, the
+                loaded subtitles (EpisodeParser output) and the season
+                numbers of the show
+    sids        sorted show ids, int32
+    flags       flags of each show, int32
+    records     (blob offset, blob length) of each show
+
+The file is memory-mapped on load and only the sids and flags tables
+are read. A
+show is unpickled and its Season and Episode objects created the first
+time it is accessed.
+"""
+import os
+import sys
+import mmap
+import array
+import itertools
+import bisect
+import struct
+import cPickle as pickle
+
+from api import ShowContainer, Season, LanguageGetter
+from atomicfile import replace_file
+
+__all__ = ['dump', 'load', 'Snapshot', 'SnapshotContainer']
+
+MAGIC = 'TVSUBSNP'
+VERSION = 2
+HEADER = struct.Struct('<8sIIQ') # magic, version, count, offset of sids
+RECORD = struct.Struct('<QQ') # offset, length
+
+COMPLETE = 1 # flag of shows with every season loaded
+
+def _pack_show(show):
+    """Returns the pickled blob of a Show
+    """
+    seasons = []
+    for season_number in sorted(dict.keys(show)):
+        season = dict.__getitem__(show, season_number)
+        episodes = []
+        for number in sorted(season.keys()):
+            episode = dict.__getitem__(season, number)
+            fields = dict((k, v) for k, v in episode.items() if k != 'languages')
+            getter = episode.get('languages')
+            subtitles = None
+            if isinstance(getter, LanguageGetter):
+                subtitles = getter.loaded()
+            episodes.append((number, fields, subtitles))
+        seasons.append((season_number, episodes))
+    return pickle.dumps((show.data, seasons, show._seasons), pickle.HIGHEST_PROTOCOL)
+
+def _unpack_show(blob, tvsubtitles, sid):
+    """Builds the Show of a blob made by _pack_show
+    """
+    data, seasons, numbers = pickle.loads(blob)
+    show = tvsubtitles._newShow(sid)
+    show.data.update(data)
+    show._seasons = numbers
+    for season_number, episodes in seasons:
+        season = Season(show = show)
+        dict.__setitem__(show, season_number, season)
+        for number, fields, subtitles in episodes:
+            episode = tvsubtitles._episode_class(season = season)
+            dict.__setitem__(season, number, episode)
+            for attrib, value in fields.items():
+                episode[attrib] = value
+            episode['languages'] = LanguageGetter(tvsubtitles, fields.get('id'), subtitles)
+    return show
+
+def dump(tvsubtitles, path):
+    """Writes the shows of tvsubtitles to a snapshot file
+    """
+    shows = tvsubtitles.shows
+    def write(f):
+        f.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        records = []
+        for sid in sorted(shows.keys()):
+            flags = 0
+            if sid in tvsubtitles._complete:
+                flags |= COMPLETE
+            if isinstance(shows, SnapshotContainer) and not shows.materialized(sid):
+                # Copied as is, without building the show
+                blob = shows.snapshot.blob(sid)
+            else:
+                blob = _pack_show(shows[sid])
+            records.append((sid, flags, f.tell(), len(blob)))
+            f.write(blob)
+
+        sids_offset = f.tell()
+        for column in (0, 1):
+            values = array.array('i', [record[column] for record in records])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            f.write(values.tostring())
+        for sid, flags, offset, length in records:
+            f.write(RECORD.pack(offset, length))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), sids_offset))
+    replace_file(path, write)
+
+class Snapshot:
+    """Read only, memory-mapped snapshot file
+    """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if len(self._map) < HEADER.size:
+            raise ValueError("%s is not a snapshot" % path)
+        magic, version, count, offset = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        if version != VERSION:
+            raise ValueError("%s is a version %s snapshot, %s is supported" % (
+                path, version, VERSION))
+        self.sids = self._column(offset, count)
+        self.flags = self._column(offset + 4 * count, count)
+        self._records = offset + 8 * count
+
+    def _column(self, offset, count):
+        column = array.array('i')
+        column.fromstring(self._map[offset:offset + count * column.itemsize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+    def __len__(self):
+        return len(self.sids)
+
+    def _position(self, sid):
+        i = bisect.bisect_left(self.sids, sid)
+        if i < len(self.sids) and self.sids[i] == sid:
+            return i
+        return None
+
+    def __contains__(self, sid):
+        return isinstance(sid, (int, long)) and self._position(sid) is not None
+
+    def complete(self):
+        """Ids of the shows saved with every season loaded
+        """
+        return itertools.compress(self.sids, (flags & COMPLETE for flags in self.flags))
+
+    def blob(self, sid):
+        """Returns the pickled blob of show sid
+        """
+        i = self._position(sid)
+        if i is None:
+            raise KeyError(sid)
+        offset, length = RECORD.unpack_from(self._map, self._records + i * RECORD.size)
+        return self._map[offset:offset + length]
+
+    def show(self, sid, tvsubtitles):
+        """Builds the Show of show sid
+        """
+        return _unpack_show(self.blob(sid), tvsubtitles, sid)
+
+    def close(self):
+        self._map.close()
+
+class SnapshotContainer(ShowContainer):
+    """ShowContainer holding the shows of a Snapshot in addition to its
+    own, they are built on first access
+    """
+    def __init__(self, snapshot, tvsubtitles, shows = None):
+        ShowContainer.__init__(self, shows or {})
+        self.snapshot = snapshot
+        self._tvsubtitles = tvsubtitles
+        self._removed = set() # snapshot shows removed from the container
+
+    def _in_snapshot(self, sid):
+        return sid in self.snapshot and sid not in self._removed
+
+    def materialized(self, sid):
+        """True if show sid is not only in the snapshot
+        """
+        return dict.__contains__(self, sid)
+
+    def __missing__(self, sid):
+        if not self._in_snapshot(sid):
+            raise KeyError(sid)
+        t = self._tvsubtitles
+        t._lock.acquire()
+        try:
+            if dict.__contains__(self, sid):
+                return dict.__getitem__(self, sid)
+            show = self.snapshot.show(sid, t)
+            dict.__setitem__(self, sid, show)
+            return show
+        finally:
+            t._lock.release()
+
+    def __contains__(self, sid):
+        return dict.__contains__(self, sid) or self._in_snapshot(sid)
+
+    def __setitem__(self, sid, show):
+        self._removed.discard(sid)
+        dict.__setitem__(self, sid, show)
+
+    def __delitem__(self, sid):
+        if not self._in_snapshot(sid):
+            dict.__delitem__(self, sid)
+            return
+        self._removed.add(sid)
+        dict.pop(self, sid, None)
+
+    def pop(self, sid, *default):
+        if sid in self:
+            show = self[sid]
+            del self[sid]
+            return show
+        return dict.pop(self, sid, *default)
+
+    def get(self, sid, default = None):
+        if sid in self:
+            return self[sid]
+        return default
+
+    def keys(self):
+        sids = set(dict.keys(self))
+        sids.update(sid for sid in self.snapshot.sids if sid not in self._removed)
+        return sorted(sids)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[sid] for sid in self.keys()]
+
+    def items(self):
+        return [(sid, self[sid]) for sid in self.keys()]
+
+def load(tvsubtitles, path):
+    """Adds the shows of a snapshot file to tvsubtitles, shows already
+    loaded are kept. Returns the Snapshot.
+    """
+    snapshot = Snapshot(path)
+    t = tvsubtitles
+    t._lock.acquire()
+    try:
+        shows = dict((sid, dict.__getitem__(t.shows, sid))
+                     for sid in t.shows.keys() if dict.__contains__(t.shows, sid))
+        if isinstance(t.shows, SnapshotContainer):
+            t._complete.difference_update(sid for sid in t.shows.snapshot.sids
+                                          if sid not in shows)
+        # Shows loaded already stay as they are
+        partial = [sid for sid in shows if sid not in t._complete]
+        t.shows = SnapshotContainer(snapshot, t, shows)
+        t._complete.update(snapshot.complete())
+        t._complete.difference_update(partial)
+    finally:
+        t._lock.release()
+    return snapshot
@@ -0,0 +1,295 @@
+# encoding: utf-8
+#       transport.py
+#
+#       Copyright 2011 nicolas <nicolas@jombi.fr>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+"""urllib2 handler keeping HTTP connections alive between requests and
+decoding gzip/deflate compressed responses.
+
+>>> opener = urllib2.build_opener(KeepAliveHandler(maxsize = 4))
+"""
+import zlib
+import socket
+import httplib
+import urllib
+import urllib2
+import threading
+import timeit
+
+__all__ = ['ConnectionPool', 'KeepAliveHandler']
+
+timer = timeit.default_timer
+
+class _HTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection recording the time spent resolving the host name
+    and connecting in self.timings
+    """
+    def connect(self):
+        self.timings = {}
+        started = timer()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = timer()
+        self.timings['dns'] = resolved - started
+        error = socket.error("getaddrinfo returns an empty list")
+        for family, socktype, proto, canonname, address in addresses:
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                sock.connect(address)
+                self.sock = sock
+                break
+            except socket.error, error:
+                if sock is not None:
+                    sock.close()
+        else:
+            raise error
+        self.timings['connect'] = timer() - resolved
+
+class ConnectionPool:
+    """Holds idle HTTP connections, at most maxsize per host
+    """
+    def __init__(self, maxsize = 4):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, timeout):
+        """Returns a (connection, reused) pair for host
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(host)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+        return self._connect(host, timeout), False
+
+    def _connect(self, host, timeout):
+        return _HTTPConnection(host, timeout = timeout)
+
+    def put(self, host, conn):
+        """Gives back an idle connection, it is closed if the pool of
+        host is full
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        """Closes every idle connection
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+class _PooledResponse:
+    """File-like body of a response. The body is decompressed while it is
+    read, and the connection goes back to the pool once the body is
+    entirely read.
+    """
+    chunk_size = 16 * 1024
+
+    def __init__(self, resp, conn, release, encoding = None, done = None):
+        self._resp = resp
+        self._done = done
+        self._conn = conn
+        self._release = release
+        self._chunks = [] # decoded data not read yet
+        self._buffered = 0
+        self._eof = False
+        self._decoder = None
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        self.bytes_read = 0
+
+    def _decode(self, chunk):
+        if self._decoder is None:
+            return chunk
+        try:
+            return self._decoder.decompress(chunk)
+        except zlib.error:
+            if self._encoding != 'deflate' or self.bytes_read != len(chunk):
+                raise
+            # Some servers send raw deflate data without zlib header
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(chunk)
+
+    def _fill(self):
+        """Reads a chunk from the network, returns the decoded data"""
+        chunk = self._resp.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            data = ''
+            if self._decoder is not None:
+                data = self._decoder.flush()
+            self._finish(reusable = not self._resp.will_close)
+            if self._done is not None:
+                self._done(self.bytes_read)
+        else:
+            self.bytes_read += len(chunk)
+            data = self._decode(chunk)
+        if data:
+            self._chunks.append(data)
+            self._buffered += len(data)
+        return data
+
+    def _take(self, end):
+        """Returns the first end bytes of the buffered data"""
+        buffered = ''.join(self._chunks)
+        data, rest = buffered[:end], buffered[end:]
+        self._chunks = rest and [rest] or []
+        self._buffered = len(rest)
+        return data
+
+    def _finish(self, reusable):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if reusable:
+            self._release(conn)
+        else:
+            conn.close()
+
+    def read(self, amt = None):
+        if amt is None or amt < 0:
+            while not self._eof:
+                self._fill()
+            return self._take(self._buffered)
+        while self._buffered < amt and not self._eof:
+            self._fill()
+        return self._take(amt)
+
+    def readline(self, limit = -1):
+        found = any('\n' in chunk for chunk in self._chunks)
+        while not found and not self._eof:
+            found = '\n' in self._fill()
+        self._chunks = [''.join(self._chunks)]
+        end = self._chunks[0].find('\n') + 1 or self._buffered
+        if limit >= 0:
+            end = min(end, limit)
+        return self._take(end)
+
+    def readlines(self, sizehint = 0):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def close(self):
+        # A partially read response leaves the connection unusable
+        self._finish(reusable = self._eof and not self._resp.will_close)
+        self._resp.close()
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """HTTP handler reusing connections from a ConnectionPool and asking
+    for compressed responses. Use it in place of urllib2.HTTPHandler:
+
+    >>> opener = urllib2.build_opener(KeepAliveHandler())
+    """
+    def __init__(self, maxsize = 4, pool = None, debuglevel = 0, metrics = None):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        if pool is None:
+            pool = ConnectionPool(maxsize)
+        self.pool = pool
+        self.metrics = metrics
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        headers['Connection'] = 'keep-alive'
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if req._tunnel_host:
+            raise urllib2.URLError('proxy tunnels are not supported')
+
+        timeout = getattr(req, 'timeout', socket._GLOBAL_DEFAULT_TIMEOUT)
+        while True:
+            conn, reused = self.pool.get(host, timeout)
+            conn.timings = {}
+            try:
+                started = timer()
+                conn.request(req.get_method(), req.get_selector(),
+                             req.data, headers)
+                resp = conn.getresponse(buffering = True)
+                first_byte = timer()
+                break
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                if not reused or req.get_method() not in ('GET', 'HEAD'):
+                    raise urllib2.URLError(err)
+                # The server closed an idle connection, retry on a new one,
+                # other methods may have had an effect already
+
+        done = None
+        if self.metrics is not None:
+            metrics = self.metrics
+            timings = conn.timings
+            for phase in ('dns', 'connect'):
+                if phase in timings:
+                    metrics.observe('tvsubtitles_http_seconds', timings[phase],
+                                    phase = phase, host = host)
+            metrics.observe('tvsubtitles_http_seconds',
+                            first_byte - started - sum(timings.values()),
+                            phase = 'wait', host = host)
+            def done(nbytes):
+                metrics.observe('tvsubtitles_http_seconds', timer() - first_byte,
+                                phase = 'transfer', host = host)
+                metrics.incr('tvsubtitles_http_bytes_total', nbytes, host = host)
+
+        encoding = resp.msg.getheader('Content-Encoding', '').strip().lower()
+        if encoding in ('gzip', 'deflate'):
+            for name in ('content-encoding', 'content-length'):
+                if name in resp.msg:
+                    del resp.msg[name]
+        else:
+            encoding = None
+        release = lambda conn: self.pool.put(host, conn)
+        fp = _PooledResponse(resp, conn, release, encoding, done)
+        response = urllib.addinfourl(fp, resp.msg, req.get_full_url())
+        response.code = resp.status
+        response.msg = resp.reason
+        return response
+
+    def close(self):
+        """Closes the idle connections of the pool
+        """
+        self.pool.close()